@@ -0,0 +1,1494 @@
+"""Общая инфраструктура ботов: снимок каталога рынков, колоночная таблица
+для фильтрации, кэш результатов, доставка сообщений в Telegram и базовые
+классы клиента API площадки и бота"""
+import asyncio
+import heapq
+import logging
+import signal
+import time
+import aiohttp
+import numpy as np
+from aiohttp import web
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.filters import Command
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Разделитель карточек на странице результатов
+PAGE_SEPARATOR = "\n\n"
+
+# Текст страницы результатов, когда показывать нечего
+NO_RESULTS_TEXT = "❌ Нет рынков для показа"
+
+# Подсказка в конце каждого поиска
+SEARCH_AGAIN_TEXT = (
+    "🔍 Хотите найти другие рынки?\n"
+    "Используйте /filters для изменения критериев поиска\n"
+    "Используйте /search для повторного поиска с текущими фильтрами"
+)
+
+
+def telegram_length(text: str) -> int:
+    """Длина текста так, как ее считает Telegram: в кодовых единицах UTF-16
+    (эмодзи занимают по две)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def truncate_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> str:
+    """Обрезает текст до limit кодовых единиц UTF-16 (не разрывая эмодзи)"""
+    encoded = text.encode('utf-16-le')
+    if len(encoded) <= limit * 2:
+        return text
+    # Половина суррогатной пары на границе отбрасывается при декодировании
+    return encoded[:limit * 2].decode('utf-16-le', errors='ignore')
+
+
+class RangeFilter(NamedTuple):
+    """Скомпилированный фильтр-диапазон: границы разобраны один раз, проверка - два сравнения"""
+    low: float
+    high: float
+
+    @classmethod
+    def from_parsed(cls, parsed: Dict) -> 'RangeFilter':
+        """Создает фильтр из результата _parse_filter_input (None - граница не задана)"""
+        low = parsed['min'] if parsed['min'] is not None else float('-inf')
+        high = parsed['max'] if parsed['max'] is not None else float('inf')
+        return cls(low, high)
+
+    def contains(self, value: float) -> bool:
+        return self.low <= value <= self.high
+
+    def mask(self, values: np.ndarray) -> np.ndarray:
+        """Векторная проверка колонки; NaN (нет данных) в диапазон не попадает"""
+        return (values >= self.low) & (values <= self.high)
+
+
+class SingleFlight:
+    """Реестр текущих загрузок: одновременные вызовы ждут одну и ту же задачу"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.coalesced = 0
+
+    def is_running(self, key: str) -> bool:
+        """Проверяет, идет ли сейчас загрузка по ключу"""
+        task = self._inflight.get(key)
+        return task is not None and not task.done()
+
+    async def run(self, key: str, factory: Callable[[], Awaitable]):
+        """Запускает загрузку или присоединяется к уже идущей"""
+        task = self._inflight.get(key)
+        # Завершенная задача может еще числиться в реестре до вызова _finish
+        if task is None or task.done():
+            task = asyncio.create_task(factory())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self._waiters[key] += 1
+            self.coalesced += 1
+
+        # shield: отмена одного ожидающего не должна отменять общую загрузку
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        """Убирает завершенную загрузку из реестра"""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            waiters = self._waiters.pop(key, 0)
+            if waiters:
+                logger.info(f"Fetch '{key}' served {waiters} coalesced callers")
+
+class PageStream:
+    """Страницы каталога из идущей загрузки; читатели получают их по мере поступления"""
+
+    def __init__(self):
+        self.pages: List[List[Dict]] = []
+        self.done = False
+        self._changed = asyncio.Event()
+
+    def publish(self, page: List[Dict]):
+        """Добавляет загруженную страницу и будит читателей"""
+        self.pages.append(page)
+        self._wake()
+
+    def finish(self):
+        """Отмечает конец загрузки"""
+        self.done = True
+        self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def __aiter__(self) -> AsyncIterator[List[Dict]]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[List[Dict]]:
+        index = 0
+        while True:
+            while index < len(self.pages):
+                yield self.pages[index]
+                index += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+class SearchResult(NamedTuple):
+    """Результат поиска по снимку, пригодный для повторного использования.
+
+    Окно времени расширено вверх на horizon секунд, поэтому в течение horizon
+    после computed_at точный результат на текущий момент получается из него
+    бинарными поисками по времени окончания, без повторной фильтрации.
+    """
+    # Рынки, прошедшие все этапы в расширенном окне, по возрастанию close_ts
+    markets: List[Dict]
+    # Этап воронки -> отсортированные close_ts рынков, прошедших все этапы до него включительно
+    closes: Dict[str, np.ndarray]
+    total: int
+    computed_at: float
+    horizon: float
+
+    def resolve(self, hours: RangeFilter, now: Optional[float] = None
+                ) -> Optional[Tuple[List[Dict], Dict[str, int]]]:
+        """Рынки и воронка для фильтра времени hours на момент now;
+        None, если результат устарел"""
+        now = time.time() if now is None else now
+        if not 0 <= now - self.computed_at <= self.horizon:
+            return None
+
+        low, high = now + hours.low * 3600, now + hours.high * 3600
+        counts = {'total': self.total}
+        for name, close in self.closes.items():
+            counts[name] = int(np.searchsorted(close, high, side='right') - np.searchsorted(close, low, side='left'))
+
+        # Последний массив closes - времена окончания самих рынков markets
+        close = next(reversed(self.closes.values()))
+        start = int(np.searchsorted(close, low, side='left'))
+        end = int(np.searchsorted(close, high, side='right'))
+        return self.markets[start:end], counts
+
+
+class MarketTable:
+    """Колонковое представление рынков: NumPy-массивы по полям и исходные строки.
+
+    Строится один раз при публикации снимка, фильтры работают масками по колонкам,
+    а словари рынков достаются только для отобранных строк через select().
+    """
+
+    # Доля таблицы в срезе по времени, начиная с которой search() сканирует масками
+    SCAN_FRACTION = 0.5
+    # Сколько наборов фильтров batch_search() проверяет одной матрицей масок
+    BATCH_SIZE = 64
+
+    def __init__(self, markets: List[Dict], columns: Dict[str, np.ndarray]):
+        self.markets = markets
+        self.columns = columns
+
+        # Индекс по времени окончания: позиции рынков по возрастанию close_ts
+        # (рынки без даты, NaN, уходят в конец и в диапазоны не попадают)
+        self.close_order = np.argsort(columns['close_ts'], kind='stable')
+        self.close_sorted = columns['close_ts'][self.close_order]
+
+    def __len__(self) -> int:
+        return len(self.markets)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def select(self, mask: np.ndarray) -> List[Dict]:
+        """Возвращает рынки, отмеченные маской"""
+        markets = self.markets
+        return [markets[i] for i in np.flatnonzero(mask)]
+
+    def closing_slice(self, hours: RangeFilter) -> slice:
+        """Срез индекса close_order с рынками, до окончания которых осталось
+        заданное число часов: два бинарных поиска вместо сравнения каждой строки"""
+        now = time.time()
+        start = np.searchsorted(self.close_sorted, now + hours.low * 3600, side='left')
+        end = np.searchsorted(self.close_sorted, now + hours.high * 3600, side='right')
+        return slice(int(start), int(end))
+
+    def closing_within(self, hours: RangeFilter) -> np.ndarray:
+        """Маска рынков, до окончания которых осталось заданное число часов"""
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.close_order[self.closing_slice(hours)]] = True
+        return mask
+
+    def select_by_close(self, mask: np.ndarray) -> List[Dict]:
+        """Как select(), но рынки идут по возрастанию времени окончания"""
+        markets = self.markets
+        order = self.close_order
+        return [markets[i] for i in order[mask[order]]]
+
+    def funnel(self, stages: List[Tuple[str, np.ndarray]], counts: Dict[str, int]) -> np.ndarray:
+        """Оценивает все этапы фильтрации за один проход и возвращает маску прошедших рынков.
+
+        Для каждого рынка запоминается первый не пройденный этап, поэтому счетчики
+        воронки (сколько рынков осталось после каждого этапа) получаются точными
+        без промежуточных списков и повторных проходов по данным.
+        """
+        counts['total'] += len(self)
+        if not stages:
+            return np.ones(len(self), dtype=bool)
+
+        passed = np.stack([mask for _, mask in stages])
+        first_failed = np.where(passed.all(axis=0), len(stages), passed.argmin(axis=0))
+
+        # Рынок, отсеянный на этапе k, доходит до всех этапов раньше k
+        dropped = np.bincount(first_failed, minlength=len(stages) + 1)
+        remaining = len(self) - np.cumsum(dropped[:-1])
+        for (name, _), count in zip(stages, remaining):
+            counts[name] += int(count)
+
+        return first_failed == len(stages)
+
+    def take(self, positions: np.ndarray) -> 'MarketTable':
+        """Подтаблица из строк positions (в указанном порядке)"""
+        markets = self.markets
+        columns = {name: values[positions] for name, values in self.columns.items()}
+        return MarketTable([markets[i] for i in positions], columns)
+
+    def search(self, hours: RangeFilter,
+               stages: Callable[['MarketTable'], List[Tuple[str, np.ndarray]]],
+               counts: Dict[str, int]) -> List[Dict]:
+        """Рынки, прошедшие фильтр времени и этапы stages, по возрастанию времени окончания.
+
+        Время - ведущее измерение запроса: индекс close_order сразу дает срез кандидатов,
+        и остальные диапазоны (stages строит маски по переданной таблице) проверяются
+        только на нем. Фильтр времени идет в воронке первым, поэтому счетчики остаются
+        точными. Если срез покрывает больше SCAN_FRACTION таблицы, копировать колонки
+        невыгодно, и все этапы считаются масками по полной таблице.
+        """
+        window = self.closing_slice(hours)
+        if window.stop - window.start > len(self) * self.SCAN_FRACTION:
+            passed = self.funnel([('time', self.closing_within(hours))] + stages(self), counts)
+            return self.select_by_close(passed)
+
+        candidates = self.take(self.close_order[window])
+        counts['total'] += len(self) - len(candidates)
+        passed = candidates.funnel([('time', np.ones(len(candidates), dtype=bool))] + stages(candidates), counts)
+        return candidates.select(passed)
+
+    def search_ahead(self, hours: RangeFilter,
+                     stages: Callable[['MarketTable'], List[Tuple[str, np.ndarray]]],
+                     horizon: float) -> SearchResult:
+        """search() с окном времени, расширенным вверх на horizon секунд, в виде
+        SearchResult, из которого resolve() дает точный результат в течение horizon"""
+        now = time.time()
+        window = self.closing_slice(RangeFilter(hours.low, hours.high + horizon / 3600))
+        rows = self.close_order[window]
+        # Как в search(): широкий срез дешевле проверить масками по полной таблице
+        if len(rows) > len(self) * self.SCAN_FRACTION:
+            masks = [(name, mask[rows]) for name, mask in stages(self)]
+        else:
+            masks = stages(self.take(rows))
+
+        close = self.close_sorted[window]
+        closes = {'time': close}
+        passed = np.ones(len(rows), dtype=bool)
+        for name, mask in masks:
+            passed = passed & mask
+            closes[name] = close[passed]
+
+        markets = self.markets
+        return SearchResult([markets[i] for i in rows[passed]], closes, len(self), now, horizon)
+
+    def batch_search(self, filter_sets: List[Dict[str, Any]],
+                     stages: Callable[['MarketTable', Dict[str, Any]], List[Tuple[str, np.ndarray]]]
+                     ) -> List[Tuple[List[Dict], Dict[str, int]]]:
+        """search() сразу для многих наборов скомпилированных фильтров (например, всех пользователей).
+        Для каждого набора возвращает рынки по возрастанию времени окончания и воронку."""
+        results: List[Optional[Tuple[List[Dict], Dict[str, int]]]] = [None] * len(filter_sets)
+        for batch in self.iter_batch_search(filter_sets, stages):
+            for index, result in batch:
+                results[index] = result.resolve(filter_sets[index]['time'], now=result.computed_at)
+        return results
+
+    def iter_batch_search(self, filter_sets: List[Dict[str, Any]],
+                          stages: Callable[['MarketTable', Dict[str, Any]], List[Tuple[str, np.ndarray]]],
+                          horizon: float = 0.0) -> Iterator[List[Tuple[int, SearchResult]]]:
+        """search_ahead() для многих наборов по одной пачке за шаг: между шагами
+        вызывающий код может отдать управление циклу событий.
+
+        Границы одноименных RangeFilter складываются в столбцы формы (F, 1), и те же
+        функции stages строят маски (F, N) для целой пачки наборов за один проход по
+        колонкам вместо F отдельных сканов. Наборы в пачке упорядочены по времени, так
+        что проверяется только общее окно их срезов индекса close_order. Наборы с разными
+        полями None проверяются разными пачками, так как у них разный список этапов.
+        Отдает списки пар (номер набора в filter_sets, SearchResult).
+        """
+        ordered = self.take(self.close_order)
+        now = time.time()
+
+        groups: Dict[Tuple, List[int]] = {}
+        for index, compiled in enumerate(filter_sets):
+            shape = tuple(sorted(name for name, value in compiled.items() if value is None))
+            groups.setdefault(shape, []).append(index)
+
+        for indexes in groups.values():
+            indexes.sort(key=lambda i: (filter_sets[i]['time'].low, filter_sets[i]['time'].high))
+            for offset in range(0, len(indexes), self.BATCH_SIZE):
+                chunk = indexes[offset:offset + self.BATCH_SIZE]
+                stacked = dict(filter_sets[chunk[0]])
+                for name, value in stacked.items():
+                    if isinstance(value, RangeFilter):
+                        stacked[name] = RangeFilter(
+                            np.array([[filter_sets[i][name].low] for i in chunk], dtype=float),
+                            np.array([[filter_sets[i][name].high] for i in chunk], dtype=float),
+                        )
+
+                # Фильтр времени - те же два бинарных поиска, что в closing_slice(), для всей пачки
+                hours = stacked['time']
+                starts = np.searchsorted(self.close_sorted, now + hours.low * 3600, side='left')
+                ends = np.searchsorted(self.close_sorted, now + hours.high * 3600 + horizon, side='right')
+                first, last = int(starts.min()), int(ends.max())
+                window = MarketTable(
+                    ordered.markets[first:last],
+                    {name: values[first:last] for name, values in ordered.columns.items()}
+                )
+
+                rank = np.arange(first, last)
+                passed = (rank >= starts) & (rank < ends)
+                stage_passed = [('time', passed)]
+                for name, mask in stages(window, stacked):
+                    passed = passed & mask
+                    stage_passed.append((name, passed))
+
+                close = window['close_ts']
+                batch = []
+                for row, index in enumerate(chunk):
+                    closes = {name: close[masks[row]] for name, masks in stage_passed}
+                    batch.append((index, SearchResult(window.select(passed[row]), closes, len(self), now, horizon)))
+                yield batch
+
+    def patched(self, markets: List[Dict], positions: List[int],
+                builder: Callable[[List[Dict]], 'MarketTable']) -> 'MarketTable':
+        """Таблица для нового списка markets, в котором изменились только строки positions
+        (новые рынки дописаны в конец); пересчитываются лишь эти строки"""
+        update = builder([markets[i] for i in positions])
+        index = np.asarray(positions, dtype=np.intp)
+        columns = {}
+        for name, values in self.columns.items():
+            column = np.empty(len(markets), dtype=values.dtype)
+            column[:len(values)] = values
+            column[index] = update.columns[name]
+            columns[name] = column
+        return MarketTable(markets, columns)
+
+
+class MarketSnapshot:
+    """Снимок каталога рынков, общий для всех пользователей"""
+
+    def __init__(self, markets: List[Dict], version: int, table: Optional[MarketTable] = None):
+        self.markets = markets
+        self.version = version
+        self.table = table
+        self.created_at = time.time()
+        self.refreshed_monotonic = time.monotonic()
+
+    def age(self) -> float:
+        """Сколько секунд прошло с последней сверки снимка с API"""
+        return time.monotonic() - self.refreshed_monotonic
+
+    def touch(self):
+        """Отмечает, что снимок сверен с API и не изменился"""
+        self.refreshed_monotonic = time.monotonic()
+
+class MarketSnapshotCache:
+    """Кэш каталога рынков с TTL и stale-while-revalidate.
+
+    Пока снимок свежий, все поиски работают по нему без обращения к API.
+    Устаревший снимок отдается сразу, а обновление запускается в фоне.
+    Полная загрузка идет постранично из page_source, и при холодном старте
+    поиски читают страницы по мере поступления через iter_pages().
+    Ошибку загрузки page_source сообщает исключением; тогда предыдущий
+    снимок остается в силе.
+    Если задан delta_fetcher, обновления между полными загрузками
+    инкрементальные: он возвращает только перекачанные рынки, и они
+    сливаются с предыдущим снимком по полю key_field.
+    Если задан table_builder, к каждому снимку строится колонковая таблица
+    для векторной фильтрации; при инкрементальном обновлении в ней
+    пересчитываются только изменившиеся строки.
+    """
+
+    def __init__(self, page_source: Callable[[], AsyncIterator[List[Dict]]], ttl: float = 60.0,
+                 delta_fetcher: Optional[Callable[[], Awaitable[Optional[List[Dict]]]]] = None,
+                 key_field: str = 'id', full_refresh_every: int = 10,
+                 table_builder: Optional[Callable[[List[Dict]], MarketTable]] = None,
+                 on_publish: Optional[Callable[[MarketSnapshot], None]] = None):
+        self.page_source = page_source
+        self.ttl = ttl
+        self.delta_fetcher = delta_fetcher
+        self.key_field = key_field
+        self.full_refresh_every = max(1, full_refresh_every)
+        self.table_builder = table_builder
+        self.on_publish = on_publish
+        self.snapshot: Optional[MarketSnapshot] = None
+        self.version = 0
+        self.flight = SingleFlight()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._refresher_task: Optional[asyncio.Task] = None
+        self._stream: Optional[PageStream] = None
+
+        # Позиции рынков в текущем снимке по ключу, для слияния обновлений
+        self._positions: Dict = {}
+        self._deltas_since_full = 0
+
+        # Статистика последнего обновления
+        self.last_refresh_at: Optional[float] = None
+        self.last_refresh_duration: Optional[float] = None
+        self.last_refresh_count = 0
+        self.last_refresh_mode: Optional[str] = None
+        self.last_refresh_changed = 0
+
+    def is_fresh(self) -> bool:
+        """Проверяет, не истек ли TTL текущего снимка"""
+        return self.snapshot is not None and self.snapshot.age() < self.ttl
+
+    async def iter_pages(self) -> AsyncIterator[List[Dict]]:
+        """Отдает рынки постранично: готовый снимок сразу, иначе по мере загрузки"""
+        snapshot = self.snapshot
+        if snapshot is not None:
+            if not self.is_fresh():
+                self._schedule_refresh()
+            yield snapshot.markets
+            return
+
+        # Холодный старт: читаем страницы общей загрузки, не дожидаясь ее конца
+        stream = self._ensure_stream()
+        async for page in stream:
+            yield page
+
+    async def iter_tables(self) -> AsyncIterator[MarketTable]:
+        """Как iter_pages(), но отдает колонковые таблицы (нужен table_builder)"""
+        snapshot = self.snapshot
+        if snapshot is not None:
+            if not self.is_fresh():
+                self._schedule_refresh()
+            yield snapshot.table
+            return
+
+        # Холодный старт: таблица строится для каждой пришедшей страницы
+        stream = self._ensure_stream()
+        async for page in stream:
+            yield self.table_builder(page)
+
+    def _ensure_stream(self) -> PageStream:
+        """Возвращает поток текущей полной загрузки; если загрузка не идет, заводит
+        новый поток и сразу запускает загрузку, которая будет его наполнять"""
+        if self._stream is None or self._stream.done:
+            self._stream = PageStream()
+        if not self.flight.is_running('catalog'):
+            self._refresh_task = asyncio.create_task(self.refresh())
+        return self._stream
+
+    def _schedule_refresh(self):
+        """Запускает фоновое обновление, если оно еще не идет"""
+        if self.flight.is_running('catalog'):
+            return
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+
+    async def refresh(self) -> Optional[MarketSnapshot]:
+        """Обновляет снимок; одновременные вызовы объединяются в одну загрузку"""
+        return await self.flight.run('catalog', self._load)
+
+    async def _load(self) -> Optional[MarketSnapshot]:
+        """Загружает каталог (целиком или инкрементально) и публикует новый снимок"""
+        started = time.monotonic()
+
+        if self._should_refresh_incrementally():
+            updates = await self.delta_fetcher()
+            # None означает, что инкрементальное обновление невозможно
+            if updates is not None:
+                return self._publish_delta(updates, time.monotonic() - started)
+
+        # Поток, который уже читают поиски холодного старта, или новый
+        if self._stream is None or self._stream.done:
+            self._stream = PageStream()
+        stream = self._stream
+        markets = []
+        error = None
+        try:
+            async for page in self.page_source():
+                markets.extend(page)
+                stream.publish(page)
+        except Exception as e:
+            error = e
+        finally:
+            # Поток закрывается и снимается вместе с завершением загрузки, без await
+            # до публикации снимка: следующий поиск увидит либо снимок, либо новый поток
+            stream.finish()
+            if self._stream is stream:
+                self._stream = None
+        duration = time.monotonic() - started
+
+        # Прерванная загрузка - не полный каталог: публиковать ее часть как снимок нельзя
+        if error is not None:
+            logger.error(
+                f"Catalog refresh failed after {len(markets)} markets, keeping previous snapshot: {error}"
+            )
+            return self.snapshot
+
+        # Пустой каталог - скорее сбой API, чем отсутствие рынков
+        if not markets:
+            logger.warning("Catalog refresh returned no markets, keeping previous snapshot")
+            return self.snapshot
+
+        self._positions = {market.get(self.key_field): i for i, market in enumerate(markets)}
+        self._deltas_since_full = 0
+        return self._publish(markets, duration, 'full', len(markets))
+
+    def _should_refresh_incrementally(self) -> bool:
+        """Решает, можно ли обойтись инкрементальным обновлением"""
+        return (
+            self.delta_fetcher is not None
+            and self.snapshot is not None
+            and self._deltas_since_full < self.full_refresh_every - 1
+        )
+
+    def _publish_delta(self, updates: List[Dict], duration: float) -> MarketSnapshot:
+        """Сливает перекачанные рынки с текущим снимком"""
+        self._deltas_since_full += 1
+        previous = self.snapshot.markets
+        merged = None
+        changed_positions = []
+
+        for market in updates:
+            key = market.get(self.key_field)
+            position = self._positions.get(key)
+            if position is not None and previous[position] == market:
+                continue
+
+            # Копируем список ссылок только при первом изменении:
+            # старый снимок может в этот момент читаться поиском
+            if merged is None:
+                merged = list(previous)
+
+            if position is None:
+                position = self._positions[key] = len(merged)
+                merged.append(market)
+            else:
+                merged[position] = market
+            changed_positions.append(position)
+
+        if merged is None:
+            self.snapshot.touch()
+            self.last_refresh_mode = 'delta'
+            self.last_refresh_duration = duration
+            self.last_refresh_changed = 0
+            logger.info(f"Delta refresh: {len(updates)} markets checked, snapshot v{self.version} unchanged")
+            return self.snapshot
+
+        table = None
+        if self.snapshot.table is not None:
+            table = self.snapshot.table.patched(merged, changed_positions, self.table_builder)
+        return self._publish(merged, duration, 'delta', len(changed_positions), table)
+
+    def _publish(self, markets: List[Dict], duration: float, mode: str, changed: int,
+                 table: Optional[MarketTable] = None) -> MarketSnapshot:
+        """Публикует новый снимок и обновляет статистику"""
+        if table is None and self.table_builder is not None:
+            table = self.table_builder(markets)
+
+        # Снимок публикуется одним присваиванием, поиски видят либо старый, либо новый
+        self.version += 1
+        self.snapshot = MarketSnapshot(markets, self.version, table)
+
+        self.last_refresh_at = self.snapshot.created_at
+        self.last_refresh_duration = duration
+        self.last_refresh_count = len(markets)
+        self.last_refresh_mode = mode
+        self.last_refresh_changed = changed
+        logger.info(
+            f"Published snapshot v{self.version} ({mode}) with {len(markets)} markets, "
+            f"{changed} changed, in {duration:.1f}s"
+        )
+
+        if self.on_publish is not None:
+            try:
+                self.on_publish(self.snapshot)
+            except Exception as e:
+                logger.error(f"Snapshot publish hook failed: {e}", exc_info=True)
+
+        return self.snapshot
+
+    def start_refresher(self, interval: float):
+        """Запускает фоновое обновление каталога с заданным периодом"""
+        if self._refresher_task is None or self._refresher_task.done():
+            self._refresher_task = asyncio.create_task(self._refresher_loop(interval))
+
+    async def stop_refresher(self):
+        """Останавливает фоновое обновление каталога"""
+        if self._refresher_task is not None:
+            self._refresher_task.cancel()
+            try:
+                await self._refresher_task
+            except asyncio.CancelledError:
+                pass
+            self._refresher_task = None
+
+    async def _refresher_loop(self, interval: float):
+        """Периодически обновляет снимок, чтобы /search не ждал загрузки"""
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Background catalog refresh failed: {e}", exc_info=True)
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict:
+        """Возвращает статистику последнего обновления"""
+        return {
+            'version': self.version,
+            'last_refresh_at': self.last_refresh_at,
+            'last_refresh_duration': self.last_refresh_duration,
+            'last_refresh_count': self.last_refresh_count,
+            'last_refresh_mode': self.last_refresh_mode,
+            'last_refresh_changed': self.last_refresh_changed,
+            'coalesced': self.flight.coalesced,
+        }
+
+
+class SearchResultCache:
+    """LRU-кэш результатов фильтрации снимка.
+
+    Ключ - площадка, версия снимка и канонизированные скомпилированные фильтры.
+    Записи - SearchResult с окном времени, расширенным на horizon секунд: в течение
+    этого времени повторный поиск с теми же фильтрами по неизменному снимку получает
+    точный на текущий момент результат без фильтрации, затем запись считается устаревшей.
+    """
+
+    def __init__(self, venue: str, maxsize: int = 4096, horizon: float = 600.0):
+        self.venue = venue
+        self.maxsize = maxsize
+        self.horizon = horizon
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, version: int, compiled: Dict) -> Tuple:
+        """Ключ кэша для версии снимка и скомпилированных фильтров"""
+        return (self.venue, version, tuple(sorted(compiled.items())))
+
+    def get(self, key: Tuple, hours: RangeFilter) -> Optional[Tuple[List[Dict], Dict[str, int]]]:
+        """Возвращает рынки и воронку для фильтра времени hours на текущий момент
+        или None, если записи нет или она устарела"""
+        entry = self._entries.get(key)
+        resolved = entry.resolve(hours) if entry is not None else None
+        if resolved is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return resolved
+
+    def put(self, key: Tuple, result: SearchResult):
+        """Сохраняет результат, вытесняя давно не использованные записи"""
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        """Возвращает размер кэша и счетчики попаданий"""
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class TopK:
+    """Потоковый отбор k лучших рынков (с наименьшим ключом) за O(n log k).
+
+    Рынки можно добавлять страницами по мере загрузки; в куче держатся только k
+    лучших, поэтому полный список совпадений никогда не сортируется. При равных
+    ключах раньше добавленный рынок считается лучше.
+    """
+
+    def __init__(self, k: int, key: Callable[[Dict], float]):
+        self.k = k
+        self.key = key
+        self.count = 0
+        # Max-куча по (ключ, порядок добавления): в корне худший из отобранных
+        self._heap: List[Tuple[float, int, Dict]] = []
+
+    def push(self, markets: List[Dict]):
+        """Добавляет рынки в отбор"""
+        heap, key = self._heap, self.key
+        for market in markets:
+            entry = (-key(market), -self.count, market)
+            self.count += 1
+            if len(heap) < self.k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+    def result(self) -> List[Dict]:
+        """Отобранные рынки по возрастанию ключа"""
+        return [market for _, _, market in sorted(self._heap, reverse=True)]
+
+
+class ResultCursor:
+    """Сохраненный результат поиска для постраничного просмотра без повторной фильтрации.
+
+    Первые страницы берутся из уже отобранных TopK рынков; полный список
+    сортируется, только если пользователь долистал дальше них.
+    """
+
+    def __init__(self, markets: List[Dict], top: List[Dict], key: Callable[[Dict], float], detailed: bool):
+        self.markets = markets
+        self.top = top
+        self.key = key
+        self.detailed = detailed
+        self.created = time.monotonic()
+        # Начала уже просмотренных страниц: страница - столько карточек, сколько влезает в сообщение
+        self.page_starts = [0]
+        self._ranked: Optional[List[Dict]] = None
+
+    def __len__(self) -> int:
+        return len(self.markets)
+
+    def market(self, index: int) -> Dict:
+        """Рынок на позиции index в порядке выдачи"""
+        if index < len(self.top):
+            return self.top[index]
+        if self._ranked is None:
+            self._ranked = sorted(self.markets, key=self.key)
+        return self._ranked[index]
+
+    def render_page(self, page: int, render: Callable[[Dict, int, bool], str],
+                    limit: int = TELEGRAM_MESSAGE_LIMIT) -> Tuple[str, int, int]:
+        """Текст страницы page и диапазон ее рынков [start, end).
+
+        Для пустого результата и страницы за пределами выдачи возвращает
+        NO_RESULTS_TEXT и пустой диапазон.
+        """
+        if not 0 <= page < len(self.page_starts) or self.page_starts[page] >= len(self):
+            return NO_RESULTS_TEXT, 0, 0
+
+        start = self.page_starts[page]
+        cards: List[str] = []
+        length = 0
+        end = start
+        while end < len(self):
+            # Карточка длиннее сообщения обрезается и занимает страницу целиком
+            card = truncate_text(render(self.market(end), end + 1, self.detailed), limit)
+            card_length = telegram_length(card) + (len(PAGE_SEPARATOR) if cards else 0)
+            if cards and length + card_length > limit:
+                break
+            cards.append(card)
+            length += card_length
+            end += 1
+
+        if page + 1 == len(self.page_starts) and end < len(self):
+            self.page_starts.append(end)
+        return PAGE_SEPARATOR.join(cards), start, end
+
+
+class ResultCursorStore:
+    """Курсоры результатов поиска с TTL; кнопки листания ссылаются на них по id"""
+
+    def __init__(self, ttl: float = 900.0, max_cursors: int = 1000):
+        self.ttl = ttl
+        self.max_cursors = max_cursors
+        self._cursors: OrderedDict = OrderedDict()
+        self._next_id = 0
+
+    def put(self, cursor: ResultCursor) -> str:
+        """Сохраняет курсор и возвращает его id"""
+        self._prune()
+        self._next_id += 1
+        cursor_id = format(self._next_id, 'x')
+        self._cursors[cursor_id] = cursor
+        return cursor_id
+
+    def get(self, cursor_id: str) -> Optional[ResultCursor]:
+        """Возвращает курсор или None, если он истек"""
+        self._prune()
+        return self._cursors.get(cursor_id)
+
+    def _prune(self):
+        """Удаляет истекшие курсоры и самые старые сверх лимита"""
+        now = time.monotonic()
+        while self._cursors:
+            cursor = next(iter(self._cursors.values()))
+            if now - cursor.created < self.ttl and len(self._cursors) < self.max_cursors:
+                break
+            self._cursors.popitem(last=False)
+
+
+class ProgressMessage:
+    """Одно сообщение о ходе поиска, которое редактируется вместо отправки новых.
+
+    update() не ждет Telegram: он запоминает последний текст, а единственная
+    фоновая задача показывает его не чаще раза в min_interval секунд, заменяя
+    промежуточные тексты последним. finish() останавливает эту задачу
+    и только после этого показывает итоговый текст.
+    """
+
+    def __init__(self, message: types.Message, min_interval: float = 0.5):
+        self.message = message
+        self.min_interval = min_interval
+        self._status: Optional[types.Message] = None
+        self._shown: Optional[str] = None
+        self._pending: Optional[str] = None
+        self._last_edit = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def start(self, text: str):
+        """Отправляет сообщение о прогрессе"""
+        await self._show(text)
+
+    def update(self, text: str):
+        """Запоминает промежуточный этап; показывает его фоновая задача"""
+        self._pending = text
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def finish(self, text: str, reply_markup=None):
+        """Показывает итоговый текст в том же сообщении"""
+        self._pending = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self._show(text, reply_markup)
+
+    async def _flush(self):
+        """Показывает последний запомненный текст, пока появляются новые"""
+        while self._pending is not None:
+            delay = self._last_edit + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text, self._pending = self._pending, None
+            if text is None:
+                break
+            try:
+                await self._show(text)
+            except Exception as e:
+                # Промежуточный этап не важен: поиск продолжается, итог покажет finish()
+                logger.warning(f"Progress update failed: {e}")
+
+    async def _show(self, text: str, reply_markup=None):
+        self._last_edit = time.monotonic()
+        if self._status is None:
+            self._status = await self.message.answer(text, reply_markup=reply_markup)
+        elif text != self._shown or reply_markup is not None:
+            await self._status.edit_text(text, reply_markup=reply_markup)
+        self._shown = text
+
+
+class TokenBucket:
+    """Корзина токенов: пополняется со скоростью rate в секунду, хранит не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления целого токена"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        """Забирает токен (вызывать, когда delay() вернул 0)"""
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        """Корзина полная: чат давно ничего не отправлял"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendScheduler:
+    """Центральная очередь исходящих запросов к Bot API.
+
+    Разрешения на отправку выдаются по корзинам токенов: своей для каждого чата
+    и общей для бота. Чаты обслуживаются по кругу, по одному запросу за проход,
+    поэтому длинная выдача одного пользователя не задерживает остальных.
+    После 429 все отправки ставятся на паузу на retry_after, а общая скорость
+    уменьшается вдвое и затем плавно восстанавливается с каждой отправкой.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 min_global_rate: float = 1.0):
+        self.global_rate = global_rate
+        self.min_global_rate = min_global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: Dict = {}
+        self.paused_until = 0.0
+        self.sent = 0
+        self.throttled = 0
+        # Очереди ожидающих по чатам; порядок ключей - порядок обхода по кругу
+        self._queues: OrderedDict = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopped = False
+
+    async def acquire(self, chat_id):
+        """Ждет разрешения отправить запрос в чат chat_id"""
+        if self._stopped:
+            raise RuntimeError("SendScheduler is stopped")
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(chat_id, deque()).append(waiter)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        await waiter
+
+    def retry_after(self, seconds: float):
+        """Учитывает ответ 429: пауза для всех чатов и снижение общей скорости"""
+        self.throttled += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.global_bucket.rate = max(self.min_global_rate, self.global_bucket.rate / 2)
+        logger.warning(
+            f"Telegram flood control: pausing sends for {seconds}s, "
+            f"global rate lowered to {self.global_bucket.rate:.1f}/s"
+        )
+
+    async def stop(self):
+        """Останавливает диспетчер очереди; ожидающие отправки завершаются ошибкой"""
+        self._stopped = True
+        for queue in self._queues.values():
+            for waiter in queue:
+                if not waiter.done():
+                    waiter.set_exception(RuntimeError("SendScheduler is stopped"))
+        self._queues.clear()
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Корзины давно молчащих чатов не нужны: полная корзина равна новой
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items()
+                    if key in self._queues or not value.is_full(now)
+                }
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _dispatch(self) -> Optional[float]:
+        """Выдает разрешения по кругу чатов, пока хватает токенов.
+
+        Возвращает, через сколько секунд появится следующее разрешение,
+        или None, если очередь пуста.
+        """
+        while True:
+            wait = None
+            granted = False
+            for chat_id in list(self._queues):
+                queue = self._queues[chat_id]
+                # Отмененные ожидания (например, поиск прерван) пропускаются
+                while queue and queue[0].done():
+                    queue.popleft()
+                if not queue:
+                    del self._queues[chat_id]
+                    continue
+
+                now = time.monotonic()
+                bucket = self._chat_bucket(chat_id, now)
+                delay = max(self.paused_until - now, bucket.delay(now), self.global_bucket.delay(now))
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+
+                bucket.take(now)
+                self.global_bucket.take(now)
+                self.global_bucket.rate = min(self.global_rate, self.global_bucket.rate + self.global_rate / 100)
+                self.sent += 1
+                queue.popleft().set_result(None)
+                granted = True
+
+                # Обслуженный чат уходит в конец круга
+                if queue:
+                    self._queues.move_to_end(chat_id)
+                else:
+                    del self._queues[chat_id]
+
+            if not granted:
+                return wait
+
+    async def _run(self):
+        """Диспетчер: выдает разрешения и спит до следующего токена или нового запроса"""
+        while True:
+            self._wakeup.clear()
+            wait = self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+class SendSchedulerMiddleware(BaseRequestMiddleware):
+    """Пропускает запросы Bot API, адресованные чатам, через SendScheduler
+    и повторяет их после 429 с учетом retry_after"""
+
+    def __init__(self, scheduler: SendScheduler, max_retries: int = 3):
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.scheduler.retry_after(e.retry_after)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+
+
+class VenueAPI:
+    """Клиент API площадки: долгоживущая HTTP-сессия с пулом соединений и загрузка каталога.
+
+    Площадка реализует iter_market_pages(), fetch_changed_markets() и build_market_table();
+    key_field - поле, по которому обновленные рынки сливаются со снимком.
+    """
+
+    key_field = 'id'
+
+    def __init__(self, connection_limit: int = 20, keepalive_timeout: float = 30.0, dns_cache_ttl: int = 300):
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает долгоживущую HTTP-сессию, создавая ее при необходимости"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close_session(self):
+        """Закрывает HTTP-сессию и пул соединений"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def iter_market_pages(self) -> AsyncIterator[List[Dict]]:
+        """Отдает рынки каталога постранично по мере загрузки"""
+        raise NotImplementedError
+
+    async def fetch_changed_markets(self) -> Optional[List[Dict]]:
+        """Перекачивает часть каталога для инкрементального обновления; None - если это невозможно"""
+        raise NotImplementedError
+
+    def build_market_table(self, markets: List[Dict]) -> MarketTable:
+        """Строит колонковую таблицу нормализованных рынков для векторной фильтрации"""
+        raise NotImplementedError
+
+    async def fetch_all_markets(self) -> List[Dict]:
+        """Получает весь каталог одним списком"""
+        all_markets = []
+        async for page in self.iter_market_pages():
+            all_markets.extend(page)
+        return all_markets
+
+
+class MarketBot:
+    """Общая часть ботов площадок: доставка обновлений (long polling или вебхук),
+    очередь отправки, общий снимок каталога с прогревом результатов, поиск
+    с воронкой и постраничный вывод.
+
+    Площадка задает клиент API (api), разбор фильтров (_compile_filters), маски
+    этапов (_filter_stages), карточку рынка (format_market_card) и свои команды
+    (register_handlers); итог поиска описывают funnel_stages и funnel_report.
+    """
+
+    # Название площадки в сообщениях и логах
+    venue_title = ""
+    # Этапы воронки после фильтра времени
+    funnel_stages: Tuple[str, ...] = ()
+    # Заголовок итога поиска
+    results_title = "📊 Результаты поиска:"
+    # Строки воронки в итоге: (этап, подпись или None, сообщение, если на этапе не осталось рынков)
+    funnel_report: List[Tuple[str, Optional[str], str]] = []
+
+    def __init__(self, token: str, api: VenueAPI, venue: str, results_limit: int = 50,
+                 cache_ttl: float = 60.0, refresh_interval: float = 45.0, full_refresh_every: int = 10,
+                 webhook_url: Optional[str] = None, webhook_path: str = '/webhook',
+                 webhook_host: str = '0.0.0.0', webhook_port: int = 8080,
+                 webhook_secret: Optional[str] = None, api_server: Optional[str] = None):
+        # Собственный сервер Bot API (локальный или тестовый), иначе api.telegram.org
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api_server)) if api_server else None
+        self.bot = Bot(token=token, session=session)
+        # Все отправки в чаты идут через общую очередь с ограничением частоты
+        self.send_scheduler = SendScheduler()
+        self.bot.session.middleware(SendSchedulerMiddleware(self.send_scheduler))
+        self.dp = Dispatcher(storage=MemoryStorage())
+        # Режим доставки обновлений: вебхук, если задан публичный URL, иначе long polling
+        self.webhook_url = webhook_url.rstrip('/') if webhook_url else None
+        self.webhook_path = webhook_path
+        self.webhook_host = webhook_host
+        self.webhook_port = webhook_port
+        self.webhook_secret = webhook_secret
+        self.user_filters = {}
+        # Фильтры, скомпилированные в диапазоны при завершении /filters
+        self.compiled_filters: Dict[int, Dict[str, Any]] = {}
+        # Сколько лучших результатов отбирать без полной сортировки (первые страницы выдачи)
+        self.results_limit = results_limit
+        # Пользователи, выбравшие компактные карточки результатов (/compact)
+        self.compact_users: set = set()
+        # Сохраненные результаты поисков для листания кнопками
+        self.result_cursors = ResultCursorStore()
+        # Результаты фильтрации по версии снимка, общие для всех пользователей
+        self.result_cache = SearchResultCache(venue)
+        # Фоновый прогрев результатов после публикации снимка
+        self._prewarm_task: Optional[asyncio.Task] = None
+
+        # Общий снимок каталога для всех пользователей
+        self.api = api
+        self.market_cache = MarketSnapshotCache(
+            api.iter_market_pages,
+            ttl=cache_ttl,
+            delta_fetcher=api.fetch_changed_markets,
+            key_field=api.key_field,
+            full_refresh_every=full_refresh_every,
+            table_builder=self.build_market_table,
+            on_publish=self._prewarm_results
+        )
+        self.refresh_interval = refresh_interval
+
+        # Регистрация обработчиков
+        self.register_handlers()
+
+    def register_handlers(self):
+        """Регистрирует команды бота площадки"""
+        raise NotImplementedError
+
+    def _register_result_handlers(self):
+        """Регистрирует /compact и листание результатов (вызывается из register_handlers)"""
+        @self.dp.message(Command("compact"))
+        async def cmd_compact(message: types.Message):
+            """Переключаем компактный вид карточек в результатах поиска"""
+            user_id = message.from_user.id
+            if user_id in self.compact_users:
+                self.compact_users.discard(user_id)
+                await message.answer("✅ Результаты будут показаны подробными карточками.")
+            else:
+                self.compact_users.add(user_id)
+                await message.answer("✅ Результаты будут показаны компактно, по несколько строк на рынок.")
+
+        @self.dp.callback_query(F.data.startswith("page:"))
+        async def on_result_page(callback: types.CallbackQuery):
+            """Листаем сохраненные результаты поиска, редактируя одно сообщение"""
+            _, cursor_id, page = callback.data.split(":")
+            page = int(page)
+            cursor = self.result_cursors.get(cursor_id)
+            if cursor is None or page >= len(cursor.page_starts):
+                await callback.answer("⌛ Результаты устарели, повторите /search", show_alert=True)
+                return
+
+            text, has_next = self._page_text(cursor, page)
+            await callback.message.edit_text(text, reply_markup=self._page_keyboard(cursor_id, page, has_next))
+            await callback.answer()
+
+    def _compile_filters(self, filters: Dict) -> Dict[str, Any]:
+        """Один раз разбирает строки фильтров пользователя в диапазоны"""
+        raise NotImplementedError
+
+    def _get_compiled_filters(self, user_id: int, filters: Dict) -> Dict[str, Any]:
+        """Возвращает скомпилированные фильтры пользователя, компилируя их при отсутствии"""
+        compiled = self.compiled_filters.get(user_id)
+        if compiled is None:
+            compiled = self.compiled_filters[user_id] = self._compile_filters(filters)
+        return compiled
+
+    def _format_filters_text(self, filters: Dict) -> str:
+        """Форматирует текст с фильтрами для итога поиска"""
+        raise NotImplementedError
+
+    def build_market_table(self, markets: List[Dict]) -> MarketTable:
+        """Строит колонковую таблицу рынков для векторной фильтрации"""
+        return self.api.build_market_table(markets)
+
+    def _filter_stages(self, table: MarketTable, compiled: Dict[str, Any]) -> List[Tuple[str, np.ndarray]]:
+        """Маски этапов после фильтра времени (для пачки фильтров - формы (F, N))"""
+        raise NotImplementedError
+
+    def _new_counts(self) -> Dict[str, int]:
+        """Пустая воронка: сколько рынков проверено и сколько прошло каждый этап"""
+        return dict.fromkeys(('total', 'time') + self.funnel_stages, 0)
+
+    def _filter_table(self, table: MarketTable, compiled: Dict[str, Any], counts: Dict[str, int]) -> List[Dict]:
+        """Проверяет все этапы фильтрации за один проход и пополняет воронку"""
+        # Рынки без времени окончания (NaN) не проходят фильтр времени
+        return table.search(compiled['time'], lambda candidates: self._filter_stages(candidates, compiled), counts)
+
+    def filter_markets(self, markets: List[Dict], filters: Dict) -> List[Dict]:
+        """Фильтрует рынки по заданным критериям (тот же скомпилированный путь, что и поиск)"""
+        return self._filter_table(self.build_market_table(markets), self._compile_filters(filters), self._new_counts())
+
+    @staticmethod
+    def _close_key(market: Dict) -> float:
+        """Ключ сортировки по времени окончания (рынки без даты - в конце)"""
+        close_ts = market.get('close_ts')
+        return close_ts if close_ts is not None else float('inf')
+
+    def _prewarm_results(self, snapshot: MarketSnapshot):
+        """После публикации снимка запускает в фоне пакетную фильтрацию по сохраненным
+        фильтрам всех пользователей, чтобы /search сразу выводил готовый результат"""
+        if snapshot.table is None or not self.compiled_filters:
+            return
+
+        # Прогрев предыдущего снимка больше не нужен
+        if self._prewarm_task is not None and not self._prewarm_task.done():
+            self._prewarm_task.cancel()
+        self._prewarm_task = asyncio.create_task(self._prewarm(snapshot))
+
+    async def _prewarm(self, snapshot: MarketSnapshot):
+        """Фильтрует снимок по фильтрам всех пользователей и кладет результаты в result_cache"""
+        started = time.monotonic()
+        # Одинаковые фильтры разных пользователей проверяются один раз
+        distinct = {}
+        for compiled in list(self.compiled_filters.values()):
+            distinct.setdefault(self.result_cache.key(snapshot.version, compiled), compiled)
+
+        keys = list(distinct)
+        filter_sets = [distinct[key] for key in keys]
+        # Пачки проверяются по одной с передачей управления циклу между ними,
+        # чтобы прогрев не задерживал обработчики бота
+        batches = snapshot.table.iter_batch_search(filter_sets, self._filter_stages, self.result_cache.horizon)
+        for batch in batches:
+            for index, result in batch:
+                self.result_cache.put(keys[index], result)
+            await asyncio.sleep(0)
+
+        logger.info(
+            f"Prewarmed search results for {len(self.compiled_filters)} users "
+            f"({len(keys)} distinct filters) in {time.monotonic() - started:.3f}s"
+        )
+
+    async def perform_search(self, message: types.Message, filters: dict, intro: str = ""):
+        """Выполняет поиск рынков по фильтрам; intro - начало сообщения о прогрессе"""
+        progress = ProgressMessage(message)
+        try:
+            await self._search(message, filters, progress, intro)
+        except Exception as e:
+            logger.error(f"Search error: {e}", exc_info=True)
+            await progress.finish(
+                f"❌ Произошла ошибка при поиске:\n\n"
+                f"Ошибка: {str(e)}\n\n"
+                f"Пожалуйста, попробуйте позже или измените фильтры."
+            )
+
+    async def _search(self, message: types.Message, filters: dict, progress: ProgressMessage, intro: str):
+        """Поиск с итогом по воронке funnel_report в сообщении о прогрессе и выводом результатов"""
+        # Шаг 1: Получаем рынки и фильтруем их постранично, по мере загрузки
+        await progress.start(intro + f"1️⃣ Получаю активные рынки с {self.venue_title} и фильтрую их по мере загрузки...")
+
+        compiled = self._get_compiled_filters(message.from_user.id, filters)
+        final_markets, counts = await self._collect_matches(compiled, progress)
+
+        total_markets = counts['total']
+        if not total_markets:
+            await progress.finish("❌ Не удалось получить список рынков. Попробуйте позже.")
+            return
+
+        checked_text = self._checked_text(total_markets)
+
+        # Шаг 2: Сообщаем, на каком этапе не осталось рынков
+        for stage, _, stage_message in self.funnel_report:
+            if counts[stage] == 0:
+                await progress.finish(f"{checked_text}\n{stage_message}\n\n{SEARCH_AGAIN_TEXT}")
+                return
+
+        final_count = len(final_markets)
+        funnel_text = "".join(f"{label}: {counts[stage]}\n" for stage, label, _ in self.funnel_report if label)
+
+        # Итог и воронка - в том же сообщении о прогрессе
+        await progress.finish(
+            f"{checked_text}\n🎉 Найдено {final_count} подходящих рынков!\n\n"
+            f"{self.results_title}\n"
+            f"🔍 Всего проверено: {total_markets} рынков\n"
+            f"{funnel_text}"
+            f"✅ Итоговых результатов: {final_count}\n\n"
+            f"{self._format_filters_text(filters)}\n"
+            f"{SEARCH_AGAIN_TEXT}\n\n"
+            "Вот лучшие результаты:"
+        )
+
+        # Выводим результаты постранично, ближайшие к окончанию - первыми
+        top_markets = TopK(self.results_limit, self._close_key)
+        top_markets.push(final_markets)
+        await self.send_result_pages(message, final_markets, top_markets.result(), top_markets.key)
+
+    async def _collect_matches(self, compiled: Dict[str, Any], progress: ProgressMessage
+                               ) -> Tuple[List[Dict], Dict[str, int]]:
+        """Рынки, прошедшие фильтры, и воронка: по готовому снимку - через result_cache,
+        при холодном старте - фильтрацией страниц по мере загрузки"""
+        counts = self._new_counts()
+        final_markets = []
+        hit = None
+
+        async for table in self.market_cache.iter_tables():
+            snapshot = self.market_cache.snapshot
+            if snapshot is not None and table is snapshot.table:
+                # Тот же снимок с теми же фильтрами уже отфильтрован - берем готовый результат
+                cache_key = self.result_cache.key(snapshot.version, compiled)
+                cached = self.result_cache.get(cache_key, compiled['time'])
+                hit = cached is not None
+                if not hit:
+                    stages = lambda candidates: self._filter_stages(candidates, compiled)
+                    result = table.search_ahead(compiled['time'], stages, self.result_cache.horizon)
+                    self.result_cache.put(cache_key, result)
+                    cached = result.resolve(compiled['time'], now=result.computed_at)
+                final_markets, snapshot_counts = cached
+                counts.update(snapshot_counts)
+            else:
+                # Холодный старт: страницы фильтруются по мере загрузки
+                final_markets.extend(self._filter_table(table, compiled, counts))
+
+                # Частые правки сообщения о прогрессе объединяет ProgressMessage
+                progress.update(
+                    f"⏳ Проверено {counts['total']} рынков, подходит пока {len(final_markets)}..."
+                )
+
+        if hit is not None:
+            logger.info(f"Search result cache {'hit' if hit else 'miss'}: {self.result_cache.stats()}")
+        return final_markets, counts
+
+    def _checked_text(self, total_markets: int) -> str:
+        """Первая строка итога: сколько рынков проверено и насколько свежи данные"""
+        snapshot = self.market_cache.snapshot
+        age_text = f" (данные обновлены {int(snapshot.age())} с назад)" if snapshot else ""
+        return f"✅ Проверено {total_markets} активных рынков{age_text}"
+
+    def _page_keyboard(self, cursor_id: str, page: int, has_next: bool) -> Optional[InlineKeyboardMarkup]:
+        """Кнопки листания страниц результатов"""
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"page:{cursor_id}:{page - 1}"))
+        if has_next:
+            buttons.append(InlineKeyboardButton(text="Далее ▶️", callback_data=f"page:{cursor_id}:{page + 1}"))
+        return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+    def _page_text(self, cursor: ResultCursor, page: int) -> Tuple[str, bool]:
+        """Текст страницы результатов с подписью; второй элемент - есть ли следующая"""
+        footer_limit = TELEGRAM_MESSAGE_LIMIT - 100
+        text, start, end = cursor.render_page(page, self.format_market_card, footer_limit)
+        if start == end:
+            return text, False
+        return f"{text}\n\n📄 Рынки {start + 1}-{end} из {len(cursor)}", end < len(cursor)
+
+    async def send_result_pages(self, message: types.Message, markets: List[Dict], top: List[Dict],
+                                key: Callable[[Dict], float]):
+        """Сохраняет результат поиска в курсор и отправляет первую страницу с кнопками листания"""
+        cursor = ResultCursor(markets, top, key, detailed=message.from_user.id not in self.compact_users)
+        cursor_id = self.result_cursors.put(cursor)
+        text, has_next = self._page_text(cursor, 0)
+        await message.answer(text, reply_markup=self._page_keyboard(cursor_id, 0, has_next))
+
+    def format_market_card(self, market: Dict, index: int, detailed: bool = True) -> str:
+        """Форматирует карточку рынка: подробную или компактную"""
+        raise NotImplementedError
+
+    def build_webhook_app(self) -> web.Application:
+        """aiohttp-приложение, которое принимает обновления Telegram на webhook_path"""
+        app = web.Application()
+        SimpleRequestHandler(
+            dispatcher=self.dp,
+            bot=self.bot,
+            secret_token=self.webhook_secret
+        ).register(app, path=self.webhook_path)
+        # Запуск/остановка приложения вызывают startup/shutdown диспетчера и закрывают сессию бота
+        setup_application(app, self.dp, bot=self.bot)
+        return app
+
+    async def run_webhook(self):
+        """Принимает обновления через вебхук на встроенном aiohttp-сервере вместо long polling"""
+        app = self.build_webhook_app()
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            site = web.TCPSite(runner, self.webhook_host, self.webhook_port)
+            await site.start()
+            logger.info(f"Webhook server listening on {self.webhook_host}:{self.webhook_port}{self.webhook_path}")
+
+            # Регистрируем вебхук только после того, как сервер готов принимать запросы
+            await self.bot.set_webhook(
+                f"{self.webhook_url}{self.webhook_path}",
+                secret_token=self.webhook_secret,
+                allowed_updates=self.dp.resolve_used_update_types()
+            )
+            await stop.wait()
+        finally:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.remove_signal_handler(sig)
+                except (NotImplementedError, RuntimeError):
+                    pass
+            await runner.cleanup()
+
+    async def run(self):
+        """Запускает бота"""
+        logger.info(f"Starting {self.venue_title} Bot...")
+        await self.api.get_session()
+        self.market_cache.start_refresher(self.refresh_interval)
+        try:
+            if self.webhook_url:
+                await self.run_webhook()
+            else:
+                # Вебхук от прошлого запуска в режиме вебхука не дал бы получать обновления
+                await self.bot.delete_webhook(drop_pending_updates=False)
+                await self.dp.start_polling(self.bot)
+        finally:
+            await self.market_cache.stop_refresher()
+            if self._prewarm_task is not None:
+                self._prewarm_task.cancel()
+            await self.send_scheduler.stop()
+            await self.api.close_session()
@@ -1,14 +1,16 @@
 import asyncio
 import logging
+import time
 import aiohttp
-from datetime import datetime, timezone
-from typing import Dict, List
-from aiogram import Bot, Dispatcher, types, F
+import numpy as np
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from aiogram import types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from core import MarketBot, MarketTable, RangeFilter, VenueAPI
 
 # Настройка логирования
 logging.basicConfig(
@@ -17,6 +19,172 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class KalshiAPI(VenueAPI):
+    """Клиент публичного API Kalshi: постраничная загрузка открытых рынков"""
+    
+    key_field = 'ticker'
+    
+    def __init__(self, delta_window_pages: int = 2, connection_limit: int = 20,
+                 keepalive_timeout: float = 30.0, dns_cache_ttl: int = 300):
+        super().__init__(connection_limit, keepalive_timeout, dns_cache_ttl)
+        self.api_url = "https://api.elections.kalshi.com/trade-api/v2/markets"
+        self.page_limit = 1000
+        
+        # Инкрементальное обновление: окно страниц, перекачиваемое по кругу
+        self.delta_window_pages = max(1, delta_window_pages)
+        self._page_cursors: List[Optional[str]] = []
+        self._delta_position = 0
+    
+    async def _fetch_markets_page(self, session: aiohttp.ClientSession, cursor: Optional[str]) -> Optional[Dict]:
+        """Загружает одну страницу рынков по курсору; None при ошибке"""
+        params = {
+            'limit': self.page_limit,
+            'status': 'open'
+        }
+        if cursor:
+            params['cursor'] = cursor
+        
+        try:
+            async with session.get(self.api_url, params=params) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    for market in data.get('markets', []):
+                        self.normalize_market(market)
+                    return data
+                else:
+                    raise Exception(f"API error: {response.status}")
+        except Exception as e:
+            logger.error(f"Error fetching markets: {e}")
+            return None
+    
+    async def iter_market_pages(self) -> AsyncIterator[List[Dict]]:
+        """Отдает открытые рынки постранично по мере загрузки; ошибка страницы прерывает загрузку"""
+        cursor = None
+        total = 0
+        # Курсоры начала каждой страницы, для инкрементального обновления
+        page_cursors = [None]
+        
+        session = await self.get_session()
+        while True:
+            data = await self._fetch_markets_page(session, cursor)
+            if data is None:
+                # Обрыв посреди каталога: прежний снимок и курсоры страниц остаются в силе
+                raise RuntimeError(f"Failed to fetch markets page after {total} markets")
+            
+            markets = data.get('markets', [])
+            total += len(markets)
+            if markets:
+                yield markets
+            
+            cursor = data.get('cursor')
+            if not cursor or len(markets) < self.page_limit:
+                break
+            page_cursors.append(cursor)
+        
+        if total:
+            self._page_cursors = page_cursors
+            self._delta_position = 0
+        
+        logger.info(f"Fetched {total} markets")
+    
+    async def fetch_changed_markets(self) -> Optional[List[Dict]]:
+        """Перекачивает очередное окно страниц каталога по кругу.
+        
+        Возвращает только рынки из этого окна; None, если курсоры страниц
+        еще неизвестны или все запросы окна завершились ошибкой.
+        """
+        if not self._page_cursors:
+            return None
+        
+        page_count = len(self._page_cursors)
+        window = min(self.delta_window_pages, page_count)
+        pages = [(self._delta_position + i) % page_count for i in range(window)]
+        self._delta_position = (self._delta_position + window) % page_count
+        
+        session = await self.get_session()
+        results = await asyncio.gather(
+            *[self._fetch_markets_page(session, self._page_cursors[page]) for page in pages]
+        )
+        
+        if all(data is None for data in results):
+            return None
+        
+        changed_markets = []
+        for data in results:
+            if data is not None:
+                changed_markets.extend(data.get('markets', []))
+        
+        logger.info(f"Delta fetch: pages {pages} of {page_count}, {len(changed_markets)} markets")
+        return changed_markets
+    
+    @staticmethod
+    def _to_float(value, default: float = 0.0) -> float:
+        """Приводит значение из API к числу"""
+        try:
+            return float(value) if value is not None else default
+        except (TypeError, ValueError):
+            return default
+    
+    def normalize_market(self, market: Dict) -> Dict:
+        """Один раз при загрузке дополняет рынок производными полями.
+        
+        close_ts - время окончания как Unix timestamp (None, если неизвестно),
+        best_price и spread - лучшая цена и спред в центах, liquidity и volume_24h - числа.
+        Фильтры, сортировка и вывод читают только эти поля.
+        """
+        close_ts = None
+        close_time_str = market.get('close_time')
+        if close_time_str:
+            try:
+                close_ts = datetime.fromisoformat(close_time_str.replace('Z', '+00:00')).timestamp()
+            except ValueError:
+                pass
+        
+        yes_bid = self._to_float(market.get('yes_bid'))
+        yes_ask = self._to_float(market.get('yes_ask'))
+        no_bid = self._to_float(market.get('no_bid'))
+        no_ask = self._to_float(market.get('no_ask'))
+        
+        # Спред по каждой стороне в процентах от ask, 100 - если котировок нет
+        if yes_ask > 0 and yes_bid > 0:
+            spread_yes = ((yes_ask - yes_bid) / yes_ask) * 100
+        else:
+            spread_yes = 100
+        
+        if no_ask > 0 and no_bid > 0:
+            spread_no = ((no_ask - no_bid) / no_ask) * 100
+        else:
+            spread_no = 100
+        
+        market.update({
+            'close_ts': close_ts,
+            'best_price': max(yes_bid, no_bid, yes_ask, no_ask),
+            'spread': min(spread_yes, spread_no),
+            'liquidity': self._to_float(market.get('liquidity')),
+            'volume_24h': self._to_float(market.get('volume_24h')),
+        })
+        return market
+    
+    def build_market_table(self, markets: List[Dict]) -> MarketTable:
+        """Строит колонковую таблицу рынков для векторной фильтрации"""
+        count = len(markets)
+        
+        def column(field: str) -> np.ndarray:
+            return np.fromiter((market[field] for market in markets), dtype=float, count=count)
+        
+        # Неизвестное время окончания становится NaN и не проходит фильтр времени
+        close_ts = np.fromiter(
+            (market['close_ts'] if market['close_ts'] is not None else np.nan for market in markets),
+            dtype=float, count=count
+        )
+        
+        return MarketTable(markets, {
+            'close_ts': close_ts,
+            'liquidity': column('liquidity'),
+            'best_price': column('best_price'),
+            'spread': column('spread'),
+        })
+
 # Состояния для FSM
 class FilterStates(StatesGroup):
     waiting_for_time_filter = State()
@@ -24,15 +192,23 @@ class FilterStates(StatesGroup):
     waiting_for_price_filter = State()
     waiting_for_spread_filter = State()
 
-class KalshiBot:
-    def __init__(self, token: str):
-        self.bot = Bot(token=token)
-        self.dp = Dispatcher(storage=MemoryStorage())
-        self.user_filters = {}
-        self.api_url = "https://api.elections.kalshi.com/trade-api/v2/markets"
-        
-        # Регистрация обработчиков
-        self.register_handlers()
+class KalshiBot(MarketBot):
+    venue_title = "Kalshi"
+    funnel_stages = ('liquidity', 'price', 'spread')
+    funnel_report = [
+        ('time', "⏰ После фильтра времени", "❌ Нет рынков, подходящих под фильтр времени"),
+        ('liquidity', "💰 После фильтра ликвидности", "❌ Нет рынков, подходящих под фильтр ликвидности"),
+        ('price', "💵 После фильтра цены", "❌ Нет рынков, подходящих под фильтр цены"),
+        ('spread', None, "❌ Нет рынков, подходящих под все фильтры"),
+    ]
+    
+    def __init__(self, token: str, cache_ttl: float = 60.0, refresh_interval: float = 45.0,
+                 full_refresh_every: int = 10, delta_window_pages: int = 2,
+                 connection_limit: int = 20, keepalive_timeout: float = 30.0, dns_cache_ttl: int = 300,
+                 **options):
+        api = KalshiAPI(delta_window_pages, connection_limit, keepalive_timeout, dns_cache_ttl)
+        super().__init__(token, api, 'kalshi', results_limit=50, cache_ttl=cache_ttl,
+                         refresh_interval=refresh_interval, full_refresh_every=full_refresh_every, **options)
     
     def register_handlers(self):
         """Регистрируем все обработчики команд"""
@@ -46,6 +222,7 @@ class KalshiBot:
                 "/search - Начать поиск по фильтрам\n"
                 "/current_filters - Показать текущие фильтры\n"
                 "/clear_filters - Сбросить фильтры\n"
+                "/compact - Компактный или подробный вид результатов\n"
                 "/help - Показать справку\n\n"
                 "Для начала настройте фильтры с помощью /filters"
             )
@@ -59,6 +236,7 @@ class KalshiBot:
                 "/search - Начать поиск по фильтрам\n"
                 "/current_filters - Показать текущие фильтры\n"
                 "/clear_filters - Сбросить фильтры\n"
+                "/compact - Компактный или подробный вид результатов\n"
                 "/help - Эта справка\n\n"
                 "📝 Форматы ввода фильтров:\n\n"
                 "⏰ Время до окончания (в часах):\n"
@@ -86,6 +264,7 @@ class KalshiBot:
         @self.dp.message(Command("filters"))
         async def cmd_filters(message: types.Message, state: FSMContext):
             """Начинаем процесс настройки фильтров"""
+            self.compiled_filters.pop(message.from_user.id, None)
             await state.set_state(FilterStates.waiting_for_time_filter)
             
             keyboard = ReplyKeyboardMarkup(
@@ -308,6 +487,7 @@ class KalshiBot:
             await state.clear()
             
             filters = self.user_filters[user_id]
+            self.compiled_filters[user_id] = self._compile_filters(filters)
             filters_text = self._format_filters_text(filters)
             
             await message.answer(
@@ -361,10 +541,13 @@ class KalshiBot:
             user_id = message.from_user.id
             if user_id in self.user_filters:
                 self.user_filters[user_id] = {}
+                self.compiled_filters.pop(user_id, None)
                 await message.answer("✅ Все фильтры успешно сброшены.")
             else:
                 await message.answer("ℹ️ У вас нет сохраненных фильтров.")
         
+        self._register_result_handlers()
+        
         @self.dp.message(Command("search"))
         async def cmd_search(message: types.Message):
             """Начинаем поиск по фильтрам"""
@@ -394,14 +577,15 @@ class KalshiBot:
             
             filters_text = self._format_filters_text(filters)
             
-            await message.answer(
-                f"🔍 Начинаю поиск рынков по вашим фильтрам:\n\n"
-                f"{filters_text}\n"
-                f"Поиск может занять до 10 минут..."
+            # Запускаем поиск; о фильтрах и ходе поиска сообщает одно сообщение
+            await self.perform_search(
+                message, filters,
+                intro=(
+                    f"🔍 Начинаю поиск рынков по вашим фильтрам:\n\n"
+                    f"{filters_text}\n"
+                    f"Поиск может занять до 10 минут...\n\n"
+                )
             )
-            
-            # Запускаем поиск
-            await self.perform_search(message, filters)
         
         @self.dp.message(F.text.lower() == "отмена")
         async def cancel_handler(message: types.Message, state: FSMContext):
@@ -461,6 +645,13 @@ class KalshiBot:
         
         raise ValueError("Неверный формат")
     
+    def _compile_filters(self, filters: Dict) -> Dict[str, RangeFilter]:
+        """Один раз разбирает строки фильтров пользователя в диапазоны"""
+        return {
+            name: RangeFilter.from_parsed(self._parse_filter_input(filters[name]))
+            for name in ('time', 'liquidity', 'price', 'spread')
+        }
+    
     def _format_filters_text(self, filters: Dict) -> str:
         """Форматирует текст с фильтрами"""
         if not filters:
@@ -499,329 +690,39 @@ class KalshiBot:
         
         return text
     
-    async def fetch_all_markets(self) -> List[Dict]:
-        """Получает все открытые рынки через API"""
-        all_markets = []
-        cursor = None
-        limit = 1000
-        
-        async with aiohttp.ClientSession() as session:
-            while True:
-                params = {
-                    'limit': limit,
-                    'status': 'open'
-                }
-                if cursor:
-                    params['cursor'] = cursor
-                
-                try:
-                    async with session.get(self.api_url, params=params) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            markets = data.get('markets', [])
-                            all_markets.extend(markets)
-                            
-                            cursor = data.get('cursor')
-                            if not cursor or len(markets) < limit:
-                                break
-                        else:
-                            raise Exception(f"API error: {response.status}")
-                except Exception as e:
-                    logger.error(f"Error fetching markets: {e}")
-                    break
-        
-        logger.info(f"Fetched {len(all_markets)} markets")
-        return all_markets
+    @staticmethod
+    def _filter_stages(table: MarketTable, compiled: Dict[str, RangeFilter]) -> List[Tuple[str, np.ndarray]]:
+        """Маски этапов после фильтра времени (для пачки фильтров - формы (F, N))"""
+        return [
+            ('liquidity', compiled['liquidity'].mask(table['liquidity'])),
+            ('price', compiled['price'].mask(table['best_price'])),
+            ('spread', compiled['spread'].mask(table['spread'])),
+        ]
     
-    def filter_markets(self, markets: List[Dict], filters: Dict) -> List[Dict]:
-        """Фильтрует рынки по заданным критериям"""
-        filtered_markets = []
-        
-        for market in markets:
-            try:
-                # Парсим фильтры
-                time_filter = self._parse_filter_input(filters['time'])
-                liquidity_filter = self._parse_filter_input(filters['liquidity'])
-                price_filter = self._parse_filter_input(filters['price'])
-                spread_filter = self._parse_filter_input(filters['spread'])
-                
-                # Проверка времени до окончания
-                close_time_str = market.get('close_time')
-                if not close_time_str:
-                    continue
-                
-                close_time = datetime.fromisoformat(close_time_str.replace('Z', '+00:00'))
-                now = datetime.now(timezone.utc)
-                hours_left = (close_time - now).total_seconds() / 3600
-                
-                if not self._check_value(hours_left, time_filter):
-                    continue
-                
-                # Проверка ликвидности
-                liquidity = market.get('liquidity', 0)
-                if not self._check_value(liquidity, liquidity_filter):
-                    continue
-                
-                # Проверка цены
-                yes_bid = market.get('yes_bid', 0)
-                yes_ask = market.get('yes_ask', 0)
-                no_bid = market.get('no_bid', 0)
-                no_ask = market.get('no_ask', 0)
-                
-                # Берем лучшую цену
-                best_price = max(yes_bid, no_bid, yes_ask, no_ask)
-                
-                if not self._check_value(best_price, price_filter):
-                    continue
-                
-                # Проверка спреда
-                if yes_ask > 0 and yes_bid > 0:
-                    spread_yes = ((yes_ask - yes_bid) / yes_ask) * 100
-                else:
-                    spread_yes = 100
-                
-                if no_ask > 0 and no_bid > 0:
-                    spread_no = ((no_ask - no_bid) / no_ask) * 100
-                else:
-                    spread_no = 100
-                
-                spread = min(spread_yes, spread_no)
-                print(spread)
-                print(spread_filter)
-                print("============================================")
-                if not self._check_value(spread, spread_filter):
-                    continue
-                
-                filtered_markets.append(market)
-                
-            except Exception as e:
-                logger.error(f"Error filtering market {market.get('ticker')}: {e}")
-                continue
-        
-        return filtered_markets
-    
-    def _check_value(self, value: float, filter_dict: Dict) -> bool:
-        """Проверяет значение по фильтру"""
-        min_val = filter_dict.get('min')
-        max_val = filter_dict.get('max')
-        
-        if min_val is not None and value < min_val:
-            return False
-        if max_val is not None and value > max_val:
-            return False
-        
-        return True
-    
-    async def perform_search(self, message: types.Message, filters: dict):
-        """Выполняет поиск рынков по фильтрам"""
-        try:
-            # Шаг 1: Получаем все рынки
-            status_msg = await message.answer("1️⃣ Получаю список всех активных рынков с Kalshi...")
-            all_markets = await self.fetch_all_markets()
-            
-            if not all_markets:
-                await status_msg.edit_text("❌ Не удалось получить список рынков. Попробуйте позже.")
-                return
-            
-            total_markets = len(all_markets)
-            await status_msg.edit_text(f"✅ Найдено {total_markets} активных рынков")
-            
-            # Шаг 2: Фильтруем по времени
-            status_msg = await message.answer("2️⃣ Фильтрую по времени окончания...")
-            time_filtered = []
-            time_filter = self._parse_filter_input(filters['time'])
-            
-            for market in all_markets:
-                close_time_str = market.get('close_time')
-                if not close_time_str:
-                    continue
-                
-                try:
-                    close_time = datetime.fromisoformat(close_time_str.replace('Z', '+00:00'))
-                    now = datetime.now(timezone.utc)
-                    hours_left = (close_time - now).total_seconds() / 3600
-                    
-                    if self._check_value(hours_left, time_filter):
-                        time_filtered.append(market)
-                except:
-                    continue
-            
-            if not time_filtered:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр времени")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
-            
-            time_filtered_count = len(time_filtered)
-            await status_msg.edit_text(f"✅ Осталось {time_filtered_count} рынков после фильтрации по времени")
-            
-            # Шаг 3: Фильтруем по ликвидности
-            status_msg = await message.answer("3️⃣ Фильтрую по ликвидности...")
-            liquidity_filtered = []
-            liquidity_filter = self._parse_filter_input(filters['liquidity'])
-            
-            for market in time_filtered:
-                liquidity = market.get('liquidity', 0)
-                if self._check_value(liquidity, liquidity_filter):
-                    liquidity_filtered.append(market)
-            
-            if not liquidity_filtered:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр ликвидности")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
-            
-            liquidity_filtered_count = len(liquidity_filtered)
-            await status_msg.edit_text(f"✅ Осталось {liquidity_filtered_count} рынков после фильтрации по ликвидности")
-            
-            # Шаг 4: Фильтруем по цене
-            status_msg = await message.answer("4️⃣ Фильтрую по цене...")
-            price_filtered = []
-            price_filter = self._parse_filter_input(filters['price'])
-            
-            for market in liquidity_filtered:
-                yes_bid = market.get('yes_bid', 0)
-                yes_ask = market.get('yes_ask', 0)
-                no_bid = market.get('no_bid', 0)
-                no_ask = market.get('no_ask', 0)
-                
-                best_price = max(yes_bid, no_bid, yes_ask, no_ask)
-                
-                if self._check_value(best_price, price_filter):
-                    price_filtered.append(market)
-            
-            if not price_filtered:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр цены")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
-            
-            price_filtered_count = len(price_filtered)
-            await status_msg.edit_text(f"✅ Осталось {price_filtered_count} рынков после фильтрации по цене")
-            
-            # Шаг 5: Фильтруем по спреду
-            status_msg = await message.answer("5️⃣ Фильтрую по спреду...")
-            final_markets = []
-            spread_filter = self._parse_filter_input(filters['spread'])
-            
-            for market in price_filtered:
-                yes_bid = market.get('yes_bid', 0)
-                yes_ask = market.get('yes_ask', 0)
-                no_bid = market.get('no_bid', 0)
-                no_ask = market.get('no_ask', 0)
-                
-                if yes_ask > 0 and yes_bid > 0:
-                    spread_yes = ((yes_ask - yes_bid) / yes_ask) * 100
-                else:
-                    spread_yes = 100
-                
-                if no_ask > 0 and no_bid > 0:
-                    spread_no = ((no_ask - no_bid) / no_ask) * 100
-                else:
-                    spread_no = 100
-                
-                spread = min(spread_yes, spread_no)
-                
-                if self._check_value(spread, spread_filter):
-                    final_markets.append(market)
-            
-            if not final_markets:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под все фильтры")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
-            
-            final_count = len(final_markets)
-            await status_msg.edit_text(f"🎉 Найдено {final_count} подходящих рынков!\n")
-            
-            # Шаг 6: Выводим результаты
-            if final_count == 0:
-                await message.answer("😔 Не найдено рынков, соответствующих всем вашим критериям.")
-                return
-            
-            # Сортируем по времени до окончания
-            final_markets.sort(key=lambda x: datetime.fromisoformat(
-                x.get('close_time', '').replace('Z', '+00:00')
-            ) if x.get('close_time') else datetime.max)
-            
-            # Отправляем сводку
-            filters_text = self._format_filters_text(filters)
-            
-            await message.answer(
-                f"📊 Результаты поиска:\n"
-                f"🔍 Всего проверено: {total_markets} рынков\n"
-                f"⏰ После фильтра времени: {time_filtered_count}\n"
-                f"💰 После фильтра ликвидности: {liquidity_filtered_count}\n"
-                f"💵 После фильтра цены: {price_filtered_count}\n"
-                f"✅ Итоговых результатов: {final_count}\n\n"
-                f"{filters_text}\n"
-                f"Вот лучшие результаты (макс. 10):"
-            )
-            
-            # Выводим результаты (максимум 10)
-            for i, market in enumerate(final_markets[:50]):
-                await self.send_market_info_simple(message, market, i+1)
-                await asyncio.sleep(0.3)  # Чтобы не превысить лимиты Telegram
-            
-            if final_count > 50:
-                await message.answer(f"\n📈 ... и еще {final_count - 50} рынков не показаны.")
-            
-            # Предложение изменить фильтры
-            await message.answer(
-                "🔍 Хотите найти другие рынки?\n"
-                "Используйте /filters для изменения критериев поиска\n"
-                "Используйте /search для повторного поиска с текущими фильтрами"
-            )
-            
-        except Exception as e:
-            logger.error(f"Search error: {e}", exc_info=True)
-            await message.answer(
-                f"❌ Произошла ошибка при поиске:\n\n"
-                f"Ошибка: {str(e)}\n\n"
-                f"Пожалуйста, попробуйте позже или измените фильтры."
-            )
-    
-    async def send_market_info_simple(self, message: types.Message, market: Dict, index: int):
-        """Отправляет упрощенную информацию о рынке"""
+    def format_market_card(self, market: Dict, index: int, detailed: bool = True) -> str:
+        """Форматирует карточку рынка: подробную или компактную, в несколько строк"""
         try:
             # Основная информация
             title = market.get('title', 'Без названия')
             ticker = market.get('ticker', 'N/A')
             
             # Время до окончания
-            close_time_str = market.get('close_time')
+            close_ts = market.get('close_ts')
             time_left_str = 'N/A'
-            if close_time_str:
-                try:
-                    close_time = datetime.fromisoformat(close_time_str.replace('Z', '+00:00'))
-                    now = datetime.now(timezone.utc)
-                    time_left = close_time - now
+            if close_ts is not None:
+                seconds_left = close_ts - time.time()
+                
+                if seconds_left > 0:
+                    hours_left = int(seconds_left / 3600)
+                    days_left = hours_left // 24
+                    remaining_hours = hours_left % 24
                     
-                    if time_left.total_seconds() > 0:
-                        hours_left = int(time_left.total_seconds() / 3600)
-                        days_left = hours_left // 24
-                        remaining_hours = hours_left % 24
-                        
-                        if days_left > 0:
-                            time_left_str = f"{days_left}д {remaining_hours}ч"
-                        else:
-                            time_left_str = f"{hours_left}ч"
+                    if days_left > 0:
+                        time_left_str = f"{days_left}д {remaining_hours}ч"
                     else:
-                        time_left_str = "Завершено"
-                except:
-                    pass
+                        time_left_str = f"{hours_left}ч"
+                else:
+                    time_left_str = "Завершено"
             
             # Цены
             yes_bid = market.get('yes_bid', 0)
@@ -830,25 +731,18 @@ class KalshiBot:
             no_ask = market.get('no_ask', 0)
             last_price = market.get('last_price', 0)
             
-            # Лучшая цена
-            best_price = max(yes_bid, no_bid, yes_ask, no_ask)
-            
-            # Спред
-            if yes_ask > 0 and yes_bid > 0:
-                spread_yes = ((yes_ask - yes_bid) / yes_ask) * 100
-            else:
-                spread_yes = 100
-            
-            if no_ask > 0 and no_bid > 0:
-                spread_no = ((no_ask - no_bid) / no_ask) * 100
-            else:
-                spread_no = 100
-            
-            spread = min(spread_yes, spread_no)
-            
-            # Ликвидность и объем
-            liquidity = market.get('liquidity', 0)
-            volume_24h = market.get('volume_24h', 0)
+            # Производные поля посчитаны при загрузке (normalize_market)
+            best_price = market['best_price']
+            spread = market['spread']
+            liquidity = market['liquidity']
+            volume_24h = market['volume_24h']
+            
+            if not detailed:
+                return (
+                    f"📊 #{index} {title}\n"
+                    f"🆔 {ticker} | ⏰ {time_left_str}\n"
+                    f"🎯 {best_price:g}¢ | 📈 {spread:.2f}¢ | 💧 ${liquidity:,.0f}"
+                )
             
             # Формируем сообщение
             response = f"📊 Рынок #{index}\n"
@@ -863,23 +757,23 @@ class KalshiBot:
             response += f"  ✅ YES: bid {yes_bid}¢ / ask {yes_ask}¢\n"
             response += f"  ❌ NO: bid {no_bid}¢ / ask {no_ask}¢\n"
             response += f"  💱 Последняя цена: {last_price}¢\n"
-            response += f"  🎯 Лучшая цена: {best_price}¢\n\n"
+            response += f"  🎯 Лучшая цена: {best_price:g}¢\n\n"
             
             # Спред
             response += f"📈 Спред: {spread:.2f}¢\n\n"
             
             # Ликвидность и объем
             response += "💵 Объем и ликвидность:\n"
-            response += f"  💧 Ликвидность: ${liquidity:,}\n"
+            response += f"  💧 Ликвидность: ${liquidity:,.0f}\n"
             if volume_24h:
-                response += f"  📊 24ч объем: {volume_24h:,}\n"
+                response += f"  📊 24ч объем: {volume_24h:,.0f}\n"
             
             response += "\n" + "─" * 40
             
-            await message.answer(response)
+            return response
             
         except Exception as e:
-            logger.error(f"Error sending market info #{index}: {e}", exc_info=True)
+            logger.error(f"Error formatting market info #{index}: {e}", exc_info=True)
             # Минимальная информация
             try:
                 basic_info = (
@@ -887,15 +781,10 @@ class KalshiBot:
                     f"📌 {market.get('title', 'Без названия')}\n"
                     f"🆔 Ticker: {market.get('ticker', 'N/A')}\n"
                 )
-                await message.answer(basic_info)
+                return basic_info
             except Exception as e2:
-                logger.error(f"Error sending minimal info: {e2}")
-                await message.answer(f"⚠️ Ошибка при отображении рынка #{index}")
-    
-    async def run(self):
-        """Запускает бота"""
-        logger.info("Starting Kalshi Bot...")
-        await self.dp.start_polling(self.bot)
+                logger.error(f"Error formatting minimal info: {e2}")
+                return f"⚠️ Ошибка при отображении рынка #{index}"
 
 # Точка входа
 if __name__ == "__main__":
@@ -919,8 +808,42 @@ if __name__ == "__main__":
         print("  2. Или запустите: python kalshi_bot.py ваш_токен")
         sys.exit(1)
     
+    # TTL общего снимка рынков в секундах
+    cache_ttl = float(os.getenv('CACHE_TTL', '60'))
+    
+    # Период фонового обновления каталога в секундах
+    refresh_interval = float(os.getenv('REFRESH_INTERVAL', '45'))
+    
+    # Каждое N-е обновление полное, остальные инкрементальные
+    full_refresh_every = int(os.getenv('FULL_REFRESH_EVERY', '10'))
+    
+    # Размер пула HTTP-соединений к API площадки
+    connection_limit = int(os.getenv('HTTP_CONNECTION_LIMIT', '20'))
+    
+    # Вебхук вместо long polling: публичный URL, путь и адрес встроенного сервера
+    webhook_url = os.getenv('WEBHOOK_URL') or None
+    webhook_path = os.getenv('WEBHOOK_PATH', '/webhook')
+    webhook_host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    webhook_port = int(os.getenv('WEBHOOK_PORT', '8080'))
+    webhook_secret = os.getenv('WEBHOOK_SECRET') or None
+    
+    # Альтернативный сервер Bot API (локальный или тестовый)
+    api_server = os.getenv('TELEGRAM_API_URL') or None
+    
     # Создаем и запускаем бота
-    bot = KalshiBot(bot_token)
+    bot = KalshiBot(
+        bot_token,
+        cache_ttl=cache_ttl,
+        refresh_interval=refresh_interval,
+        full_refresh_every=full_refresh_every,
+        connection_limit=connection_limit,
+        webhook_url=webhook_url,
+        webhook_path=webhook_path,
+        webhook_host=webhook_host,
+        webhook_port=webhook_port,
+        webhook_secret=webhook_secret,
+        api_server=api_server
+    )
     
     try:
         # Запуск бота
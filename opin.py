@@ -1,15 +1,17 @@
 import asyncio
 import logging
+import time
 import aiohttp
+import numpy as np
 import json
-from datetime import datetime, timezone
-from typing import Dict, List, Optional
-from aiogram import Bot, Dispatcher, types, F
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from aiogram import types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from core import MarketBot, MarketTable, RangeFilter, VenueAPI
 
 # Настройка логирования
 logging.basicConfig(
@@ -18,6 +20,361 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class RateLimiter:
+    """Ограничивает частоту запросов к API (запросов в секунду)"""
+    
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+    
+    async def wait(self):
+        """Ждет свободный слот; слоты выдаются по очереди без блокировок"""
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class OpinionAPI(VenueAPI):
+    """Клиент API Opinion Trade: постраничная загрузка событий и разбор их рынков"""
+    
+    def __init__(self, delta_window_pages: int = 8, page_concurrency: int = 4, requests_per_second: float = 6.0,
+                 connection_limit: int = 20, keepalive_timeout: float = 30.0, dns_cache_ttl: int = 300):
+        super().__init__(connection_limit, keepalive_timeout, dns_cache_ttl)
+        self.base_api_url = "https://proxy.opinion.trade:8443/api/bsc/api/v2/topic"
+        self.page_limit = 12
+        
+        # Параллельная загрузка страниц в пределах лимита запросов
+        self.page_concurrency = max(1, page_concurrency)
+        self.page_rate_limiter = RateLimiter(requests_per_second)
+        
+        # Инкрементальное обновление: окно страниц, перекачиваемое по кругу
+        self.delta_window_pages = max(1, delta_window_pages)
+        self._known_pages = 0
+        self._delta_position = 0
+    
+    async def _fetch_events_page(self, session: aiohttp.ClientSession, page: int, limit: int) -> Optional[List[Dict]]:
+        """Загружает одну страницу событий; None при ошибке"""
+        params = {
+            'labelId': '',
+            'keywords': '',
+            'sortBy': '5',  # Сортировка
+            'chainId': '56',  # BSC
+            'limit': str(limit),
+            'status': '2',  # Активные рынки
+            'isShow': '1',
+            'topicType': '2',
+            'page': str(page),
+            'indicatorType': '0',
+            'excludePin': '1'
+        }
+        
+        await self.page_rate_limiter.wait()
+        
+        try:
+            async with session.get(self.base_api_url, params=params, ssl=False) as response:
+                if response.status != 200:
+                    logger.error(f"API error on page {page}: {response.status}")
+                    return None
+                
+                data = await response.json()
+                
+                # Получаем список событий
+                events = []
+                if isinstance(data, dict):
+                    if 'result' in data and 'list' in data['result']:
+                        events = data['result']['list']
+                    elif 'list' in data:
+                        events = data['list']
+                return events
+        except Exception as e:
+            logger.error(f"Error fetching markets from page {page}: {e}")
+            return None
+    
+    def _flatten_events(self, events: List[Dict]) -> List[Dict]:
+        """Собирает childList элементы событий с информацией о родителе"""
+        child_markets = []
+        
+        for event in events:
+            parent_event = {
+                'topicId': event.get('topicId'),
+                'parent_title': event.get('title', ''),
+                'parent_rules': event.get('rules', ''),
+                'parent_cutoffTime': event.get('cutoffTime', 0),
+                'parent_labelName': event.get('labelName', []),
+                'parent_totalPrice': event.get('totalPrice', 0),
+                'parent_volume': event.get('volume', 0),
+                'parent_volume24h': event.get('volume24h', 0)
+            }
+            
+            if 'childList' in event and isinstance(event['childList'], list):
+                children = event['childList']
+            else:
+                children = [event]
+            
+            for child_index, child in enumerate(children):
+                child_with_parent = child.copy()
+                child_with_parent['parent_event'] = parent_event
+                child_with_parent['child_index'] = child_index
+                child_markets.append(child_with_parent)
+        
+        return child_markets
+    
+    async def iter_market_pages(self) -> AsyncIterator[List[Dict]]:
+        """Отдает рынки Opinion Trade постранично по мере загрузки.
+        
+        Страницы запрашиваются пачками по page_concurrency штук и отдаются
+        в порядке номеров; загрузка останавливается на первой пустой
+        или неполной странице, а ошибка страницы прерывает ее исключением.
+        """
+        page = 1
+        pages_fetched = 0
+        total = 0
+        limit = self.page_limit
+        started = time.monotonic()
+        
+        session = await self.get_session()
+        while True:
+            pages = list(range(page, page + self.page_concurrency))
+            results = await asyncio.gather(
+                *[self._fetch_events_page(session, p, limit) for p in pages]
+            )
+            
+            # gather сохраняет порядок, поэтому рынки отдаются в порядке страниц
+            last_page_reached = False
+            for page_number, events in zip(pages, results):
+                if events is None:
+                    # Обрыв посреди каталога: прежний снимок и число страниц остаются в силе
+                    raise RuntimeError(f"Failed to fetch page {page_number}")
+                
+                if not events:
+                    logger.info(f"Page {page_number}: No events found")
+                    last_page_reached = True
+                    break
+                
+                child_markets = self._ingest_events(events)
+                pages_fetched += 1
+                total += len(child_markets)
+                logger.info(f"Page {page_number}: Found {len(events)} events, total child markets: {total}")
+                yield child_markets
+                
+                # Если получили меньше лимита событий, значит это последняя страница
+                if len(events) < limit:
+                    last_page_reached = True
+                    break
+            
+            if last_page_reached:
+                break
+            
+            page += self.page_concurrency
+        
+        if pages_fetched:
+            self._known_pages = pages_fetched
+            self._delta_position = 0
+        
+        elapsed = time.monotonic() - started
+        logger.info(f"Total fetched {total} child markets from {pages_fetched} pages in {elapsed:.1f}s")
+    
+    async def fetch_changed_markets(self) -> Optional[List[Dict]]:
+        """Перекачивает очередное окно страниц каталога по кругу.
+        
+        Возвращает только рынки из этого окна; None, если число страниц
+        еще неизвестно или все запросы окна завершились ошибкой.
+        """
+        if not self._known_pages:
+            return None
+        
+        window = min(self.delta_window_pages, self._known_pages)
+        pages = [(self._delta_position + i) % self._known_pages + 1 for i in range(window)]
+        self._delta_position = (self._delta_position + window) % self._known_pages
+        
+        session = await self.get_session()
+        results = await asyncio.gather(
+            *[self._fetch_events_page(session, page, self.page_limit) for page in pages]
+        )
+        
+        if all(events is None for events in results):
+            return None
+        
+        changed_markets = []
+        for events in results:
+            if events:
+                changed_markets.extend(self._ingest_events(events))
+        
+        logger.info(f"Delta fetch: pages {pages} of {self._known_pages}, {len(changed_markets)} child markets")
+        return changed_markets
+    
+    def _ingest_events(self, events: List[Dict]) -> List[Dict]:
+        """Разворачивает события в рынки и один раз нормализует каждый через extract_market_data;
+        рынки без ключа пропускаются"""
+        markets = (self.extract_market_data(child_market) for child_market in self._flatten_events(events))
+        return [market for market in markets if market is not None]
+    
+    @staticmethod
+    def market_key(child_market: Dict) -> Optional[str]:
+        """Уникальный ключ рынка для слияния снимков: topicId дочернего рынка, а без него -
+        topicId события и номер рынка в childList; None - если рынок не опознать"""
+        topic_id = child_market.get('topicId')
+        if topic_id is not None:
+            return topic_id
+        parent_id = child_market.get('parent_event', {}).get('topicId')
+        if parent_id is None:
+            return None
+        return f"{parent_id}:{child_market.get('child_index', 0)}"
+    
+    def extract_market_data(self, child_market: Dict) -> Optional[Dict]:
+        """Извлекает нужные данные из childList элемента; None - у рынка нет ключа"""
+        market_id = self.market_key(child_market)
+        if market_id is None:
+            logger.warning(f"Skipping market without topicId: {child_market.get('title', '')}")
+            return None
+        
+        try:
+            # Основные данные
+            title = child_market.get('title', '')
+            
+            # Если title короткий, используем его, иначе создаем комбинацию
+            parent_title = child_market.get('parent_event', {}).get('parent_title', '')
+            full_title = f"{parent_title}: {title}" if parent_title and title else title or parent_title
+            
+            # Цены (конвертируем в центы)
+            yes_buy_price_str = child_market.get('yesBuyPrice', '0')
+            #yes_market_price_str = child_market.get('yesMarketPrice', '0')
+            no_buy_price_str = child_market.get('noBuyPrice', '0')
+            
+            # Парсим цены
+            try:
+                yes_buy_price = float(yes_buy_price_str) * 100  # В центы
+            except:
+                yes_buy_price = 0
+            
+            try:
+                yes_market_price = float(yes_buy_price_str) * 100  # В центы
+            except:
+                yes_market_price = 0
+                
+            try:
+                no_buy_price = float(no_buy_price_str) * 100  # В центы
+            except:
+                no_buy_price = 0
+            
+            # Лучшая цена YES (используем market price если есть, иначе buy price)
+            best_yes_price = yes_market_price if yes_market_price > 0 else yes_buy_price
+            
+            # Рассчитываем спред между YES и NO
+            # Для бинарных рынков спред = (цена NO - цена YES) / цена NO * 100
+            if no_buy_price > 0 and yes_buy_price > 0:
+                spread = no_buy_price + yes_buy_price - 100
+            else:
+                spread = 100  # Максимальный спред по умолчанию
+            
+            # Объемы
+            try:
+                volume = float(child_market.get('volume', '0'))
+            except:
+                volume = 0
+                
+            try:
+                volume24h = float(child_market.get('volume24h', '0'))
+            except:
+                volume24h = 0
+                
+            try:
+                total_price = float(child_market.get('totalPrice', '0'))
+            except:
+                total_price = volume  # Используем volume как fallback
+            
+            # Время окончания (из родительского события) как Unix timestamp;
+            # часы до окончания считаются от него в момент поиска или вывода
+            cutoff_time = child_market.get('parent_event', {}).get('parent_cutoffTime', 0)
+            close_ts = float(cutoff_time) if cutoff_time and cutoff_time > 0 else None
+            
+            # Дополнительная информация
+            category = ', '.join(child_market.get('parent_event', {}).get('parent_labelName', [])) or 'Без категории'
+            rules = child_market.get('parent_event', {}).get('parent_rules', '')
+            
+            # Информация о изменениях цены
+            inc_rate_str = child_market.get('incRate', '0')
+            try:
+                inc_rate = float(inc_rate_str) * 100  # В проценты
+            except:
+                inc_rate = 0
+            
+            return {
+                'id': market_id,
+                'title': full_title,
+                'short_title': title,
+                'parent_title': parent_title,
+                'category': category,
+                'rules': rules,
+                
+                # Цены в центах
+                'yes_buy_price': yes_buy_price,
+                'yes_market_price': yes_market_price,
+                'best_yes_price': best_yes_price,
+                'no_buy_price': no_buy_price,
+                
+                # Спред и изменения
+                'spread': spread,
+                'price_change': inc_rate,
+                
+                # Объемы
+                'volume': volume,
+                'volume24h': volume24h,
+                'total_price': total_price,
+                
+                # Время
+                'close_ts': close_ts,
+                'cutoff_time': cutoff_time,
+                
+                # Дополнительно
+                'question_id': child_market.get('questionId', ''),
+                'create_time': child_market.get('createTime', 0),
+                'status': child_market.get('status', 0),
+                
+                # Для отображения
+                'yes_label': child_market.get('yesLabel', 'YES'),
+                'no_label': child_market.get('noLabel', 'NO'),
+                'thumbnail_url': child_market.get('thumbnailUrl', ''),
+            }
+            
+        except Exception as e:
+            logger.error(f"Error extracting market data: {e}")
+            # Возвращаем минимальные данные
+            return {
+                'id': market_id,
+                'title': child_market.get('title', 'Без названия'),
+                'category': 'Ошибка',
+                'best_yes_price': 0,
+                'no_buy_price': 0,
+                'spread': 100,
+                'volume': 0,
+                'volume24h': 0,
+                'close_ts': None,
+                'price_change': 0
+            }
+    
+    def build_market_table(self, markets: List[Dict]) -> MarketTable:
+        """Строит колонковую таблицу рынков (записей extract_market_data) для векторной фильтрации"""
+        count = len(markets)
+        
+        def column(field: str) -> np.ndarray:
+            return np.fromiter((market.get(field, 0) for market in markets), dtype=float, count=count)
+        
+        # Неизвестное время окончания становится NaN и не проходит фильтр времени
+        close_ts = np.fromiter(
+            (market['close_ts'] if market.get('close_ts') is not None else np.nan for market in markets),
+            dtype=float, count=count
+        )
+        
+        return MarketTable(markets, {
+            'close_ts': close_ts,
+            'volume': column('volume'),
+            'best_yes_price': column('best_yes_price'),
+            'no_buy_price': column('no_buy_price'),
+            'spread': column('spread'),
+        })
+
 # Состояния для FSM
 class FilterStates(StatesGroup):
     waiting_for_time_filter = State()
@@ -25,15 +382,26 @@ class FilterStates(StatesGroup):
     waiting_for_price_filter = State()
     waiting_for_spread_filter = State()
 
-class OpinionBot:
-    def __init__(self, token: str):
-        self.bot = Bot(token=token)
-        self.dp = Dispatcher(storage=MemoryStorage())
-        self.user_filters = {}
-        self.base_api_url = "https://proxy.opinion.trade:8443/api/bsc/api/v2/topic"
-        
-        # Регистрация обработчиков
-        self.register_handlers()
+class OpinionBot(MarketBot):
+    venue_title = "Opinion Trade"
+    funnel_stages = ('volume', 'price', 'spread')
+    results_title = "📊 Результаты поиска на Opinion Trade:"
+    funnel_report = [
+        ('time', "⏰ После фильтра времени", "❌ Нет рынков, подходящих под фильтр времени"),
+        ('volume', "💰 После фильтра объема", "❌ Нет рынков, подходящих под фильтр объема"),
+        ('price', "💵 После фильтра цены", "❌ Нет рынков, подходящих под фильтр цены"),
+        ('spread', None, "❌ Нет рынков, подходящих под все фильтры"),
+    ]
+    
+    def __init__(self, token: str, cache_ttl: float = 120.0, refresh_interval: float = 90.0,
+                 full_refresh_every: int = 10, delta_window_pages: int = 8,
+                 page_concurrency: int = 4, requests_per_second: float = 6.0,
+                 connection_limit: int = 20, keepalive_timeout: float = 30.0,
+                 dns_cache_ttl: int = 300, **options):
+        api = OpinionAPI(delta_window_pages, page_concurrency, requests_per_second,
+                         connection_limit, keepalive_timeout, dns_cache_ttl)
+        super().__init__(token, api, 'opinion', results_limit=10, cache_ttl=cache_ttl,
+                         refresh_interval=refresh_interval, full_refresh_every=full_refresh_every, **options)
     
     def register_handlers(self):
         """Регистрируем все обработчики команд"""
@@ -47,6 +415,7 @@ class OpinionBot:
                 "/search - Начать поиск по фильтрам\n"
                 "/current_filters - Показать текущие фильтры\n"
                 "/clear_filters - Сбросить фильтры\n"
+                "/compact - Компактный или подробный вид результатов\n"
                 "/help - Показать справку\n\n"
                 "Для начала настройте фильтры с помощью /filters"
             )
@@ -60,6 +429,7 @@ class OpinionBot:
                 "/search - Начать поиск по фильтрам\n"
                 "/current_filters - Показать текущие фильтры\n"
                 "/clear_filters - Сбросить фильтры\n"
+                "/compact - Компактный или подробный вид результатов\n"
                 "/help - Эта справка\n\n"
                 "📝 Форматы ввода фильтров:\n\n"
                 "⏰ Время до окончания (в часах):\n"
@@ -87,6 +457,7 @@ class OpinionBot:
         @self.dp.message(Command("filters"))
         async def cmd_filters(message: types.Message, state: FSMContext):
             """Начинаем процесс настройки фильтров"""
+            self.compiled_filters.pop(message.from_user.id, None)
             await state.set_state(FilterStates.waiting_for_time_filter)
             
             keyboard = ReplyKeyboardMarkup(
@@ -298,6 +669,7 @@ class OpinionBot:
             await state.clear()
             
             filters = self.user_filters[user_id]
+            self.compiled_filters[user_id] = self._compile_filters(filters)
             filters_text = self._format_filters_text(filters)
             
             await message.answer(
@@ -351,10 +723,13 @@ class OpinionBot:
             user_id = message.from_user.id
             if user_id in self.user_filters:
                 self.user_filters[user_id] = {}
+                self.compiled_filters.pop(user_id, None)
                 await message.answer("✅ Все фильтры успешно сброшены.")
             else:
                 await message.answer("ℹ️ У вас нет сохраненных фильтров.")
         
+        self._register_result_handlers()
+        
         @self.dp.message(Command("search"))
         async def cmd_search(message: types.Message):
             """Начинаем поиск по фильтрам"""
@@ -384,14 +759,15 @@ class OpinionBot:
             
             filters_text = self._format_filters_text(filters)
             
-            await message.answer(
-                f"🔍 Начинаю поиск рынков по вашим фильтрам:\n\n"
-                f"{filters_text}\n"
-                f"Поиск может занять до 2 минут..."
+            # Запускаем поиск; о фильтрах и ходе поиска сообщает одно сообщение
+            await self.perform_search(
+                message, filters,
+                intro=(
+                    f"🔍 Начинаю поиск рынков по вашим фильтрам:\n\n"
+                    f"{filters_text}\n"
+                    f"Поиск может занять до 2 минут...\n\n"
+                )
             )
-            
-            # Запускаем поиск
-            await self.perform_search(message, filters)
         
         @self.dp.message(F.text.lower() == "отмена")
         async def cancel_handler(message: types.Message, state: FSMContext):
@@ -451,6 +827,13 @@ class OpinionBot:
         
         raise ValueError("Неверный формат")
     
+    def _compile_filters(self, filters: Dict) -> Dict[str, RangeFilter]:
+        """Один раз разбирает строки фильтров пользователя в диапазоны"""
+        return {
+            name: RangeFilter.from_parsed(self._parse_filter_input(filters[name]))
+            for name in ('time', 'volume', 'price', 'spread')
+        }
+    
     def _format_filters_text(self, filters: Dict) -> str:
         """Форматирует текст с фильтрами"""
         if not filters:
@@ -489,464 +872,27 @@ class OpinionBot:
         
         return text
     
-    async def fetch_all_markets(self) -> List[Dict]:
-        """Получает все активные рынки через API Opinion Trade"""
-        all_child_markets = []  # Будем собирать все childList элементы
-        page = 1
-        limit = 12
-        
-        async with aiohttp.ClientSession() as session:
-            while True:
-                params = {
-                    'labelId': '',
-                    'keywords': '',
-                    'sortBy': '5',  # Сортировка
-                    'chainId': '56',  # BSC
-                    'limit': str(limit),
-                    'status': '2',  # Активные рынки
-                    'isShow': '1',
-                    'topicType': '2',
-                    'page': str(page),
-                    'indicatorType': '0',
-                    'excludePin': '1'
-                }
-                
-                try:
-                    async with session.get(self.base_api_url, params=params, ssl=False) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            
-                            # Получаем список событий
-                            events = []
-                            if isinstance(data, dict):
-                                if 'result' in data and 'list' in data['result']:
-                                    events = data['result']['list']
-                                elif 'list' in data:
-                                    events = data['list']
-                            
-                            if not events:
-                                logger.info(f"Page {page}: No events found")
-                                break
-                            
-                            # Собираем все childList элементы из каждого события
-                            for event in events:
-                                if 'childList' in event and isinstance(event['childList'], list):
-                                    # Добавляем информацию о родительском событии в каждый child
-                                    for child in event['childList']:
-                                        # Добавляем информацию о родительском событии
-                                        child_with_parent = child.copy()
-                                        child_with_parent['parent_event'] = {
-                                            'topicId': event.get('topicId'),
-                                            'parent_title': event.get('title', ''),
-                                            'parent_rules': event.get('rules', ''),
-                                            'parent_cutoffTime': event.get('cutoffTime', 0),
-                                            'parent_labelName': event.get('labelName', []),
-                                            'parent_totalPrice': event.get('totalPrice', 0),
-                                            'parent_volume': event.get('volume', 0),
-                                            'parent_volume24h': event.get('volume24h', 0)
-                                        }
-                                        #print(child_with_parent)
-                                        all_child_markets.append(child_with_parent)
-                                else:
-                                    child_with_parent = event.copy()
-                                    child_with_parent['parent_event'] = {
-                                        'topicId': event.get('topicId'),
-                                        'parent_title': event.get('title', ''),
-                                        'parent_rules': event.get('rules', ''),
-                                        'parent_cutoffTime': event.get('cutoffTime', 0),
-                                        'parent_labelName': event.get('labelName', []),
-                                        'parent_totalPrice': event.get('totalPrice', 0),
-                                        'parent_volume': event.get('volume', 0),
-                                        'parent_volume24h': event.get('volume24h', 0)
-                                    }
-                                    #print(child_with_parent)
-                                    all_child_markets.append(child_with_parent)
-                            logger.info(f"Page {page}: Found {len(events)} events, total child markets: {len(all_child_markets)}")
-                            
-                            # Если получили меньше лимита событий, значит это последняя страница
-                            if len(events) < limit:
-                                break
-                            
-                            page += 1
-                            await asyncio.sleep(0.5)  # Небольшая задержка между запросами
-                            
-                        else:
-                            logger.error(f"API error: {response.status}")
-                            break
-                except Exception as e:
-                    logger.error(f"Error fetching markets from page {page}: {e}")
-                    break
-        
-        logger.info(f"Total fetched {len(all_child_markets)} child markets from {page-1} pages")
-        return all_child_markets
-    
-    def extract_market_data(self, child_market: Dict) -> Dict:
-        """Извлекает нужные данные из childList элемента"""
-        try:
-            # Основные данные
-            market_id = child_market.get('topicId', 'N/A')
-            title = child_market.get('title', '')
-            
-            # Если title короткий, используем его, иначе создаем комбинацию
-            parent_title = child_market.get('parent_event', {}).get('parent_title', '')
-            full_title = f"{parent_title}: {title}" if parent_title and title else title or parent_title
-            
-            # Цены (конвертируем в центы)
-            yes_buy_price_str = child_market.get('yesBuyPrice', '0')
-            #yes_market_price_str = child_market.get('yesMarketPrice', '0')
-            no_buy_price_str = child_market.get('noBuyPrice', '0')
-            
-            # Парсим цены
-            try:
-                yes_buy_price = float(yes_buy_price_str) * 100  # В центы
-            except:
-                yes_buy_price = 0
-            
-            try:
-                yes_market_price = float(yes_buy_price_str) * 100  # В центы
-            except:
-                yes_market_price = 0
-                
-            try:
-                no_buy_price = float(no_buy_price_str) * 100  # В центы
-            except:
-                no_buy_price = 0
-            
-            # Лучшая цена YES (используем market price если есть, иначе buy price)
-            best_yes_price = yes_market_price if yes_market_price > 0 else yes_buy_price
-            
-            # Рассчитываем спред между YES и NO
-            # Для бинарных рынков спред = (цена NO - цена YES) / цена NO * 100
-            if no_buy_price > 0 and yes_buy_price > 0:
-                spread = no_buy_price + yes_buy_price - 100
-            else:
-                spread = 100  # Максимальный спред по умолчанию
-            
-            # Объемы
-            try:
-                volume = float(child_market.get('volume', '0'))
-            except:
-                volume = 0
-                
-            try:
-                volume24h = float(child_market.get('volume24h', '0'))
-            except:
-                volume24h = 0
-                
-            try:
-                total_price = float(child_market.get('totalPrice', '0'))
-            except:
-                total_price = volume  # Используем volume как fallback
-            
-            # Время окончания (из родительского события)
-            cutoff_time = child_market.get('parent_event', {}).get('parent_cutoffTime', 0)
-            #print(cutoff_time)
-            hours_left = None
-            
-            if cutoff_time and cutoff_time > 0:
-     #           print(cutoff_time)
-                try:
-                    # Предполагаем, что это Unix timestamp
-                    end_time = datetime.fromtimestamp(cutoff_time).replace(tzinfo=timezone.utc)
-                    now = datetime.now(timezone.utc)
-           #         .replace(tzinfo=timezone.utc)
-                    time_left = end_time - now
-        #            print(end_time)
-         #           print(now)
-         #           print(time_left)
-            #        print("==================================================")
-                    hours_left = time_left.total_seconds() / 3600
-          #          print(hours_left)
-          #          print("==================================================")
-                except Exception as e:
-                    print(e)
-                    hours_left = None
-            
-            # Дополнительная информация
-            category = ', '.join(child_market.get('parent_event', {}).get('parent_labelName', [])) or 'Без категории'
-            rules = child_market.get('parent_event', {}).get('parent_rules', '')
-            
-            # Информация о изменениях цены
-            inc_rate_str = child_market.get('incRate', '0')
-            try:
-                inc_rate = float(inc_rate_str) * 100  # В проценты
-            except:
-                inc_rate = 0
-            
-            return {
-                'id': market_id,
-                'title': full_title,
-                'short_title': title,
-                'parent_title': parent_title,
-                'category': category,
-                'rules': rules,
-                
-                # Цены в центах
-                'yes_buy_price': yes_buy_price,
-                'yes_market_price': yes_market_price,
-                'best_yes_price': best_yes_price,
-                'no_buy_price': no_buy_price,
-                
-                # Спред и изменения
-                'spread': spread,
-                'price_change': inc_rate,
-                
-                # Объемы
-                'volume': volume,
-                'volume24h': volume24h,
-                'total_price': total_price,
-                
-                # Время
-                'hours_left': hours_left,
-                'cutoff_time': cutoff_time,
-                
-                # Дополнительно
-                'question_id': child_market.get('questionId', ''),
-                'create_time': child_market.get('createTime', 0),
-                'status': child_market.get('status', 0),
-                
-                # Для отображения
-                'yes_label': child_market.get('yesLabel', 'YES'),
-                'no_label': child_market.get('noLabel', 'NO'),
-                'thumbnail_url': child_market.get('thumbnailUrl', ''),
-            }
-            
-        except Exception as e:
-            logger.error(f"Error extracting market data: {e}")
-            # Возвращаем минимальные данные
-            return {
-                'id': child_market.get('topicId', 'N/A'),
-                'title': child_market.get('title', 'Без названия'),
-                'category': 'Ошибка',
-                'best_yes_price': 0,
-                'no_buy_price': 0,
-                'spread': 100,
-                'volume': 0,
-                'volume24h': 0,
-                'hours_left': None,
-                'price_change': 0
-            }
-    
-    def filter_markets(self, markets: List[Dict], filters: Dict) -> List[Dict]:
-        """Фильтрует рынки по заданным критериям"""
-        filtered_markets = []
-        
-        # Парсим фильтры
-        time_filter = self._parse_filter_input(filters['time'])
-        volume_filter = self._parse_filter_input(filters['volume'])
-        price_filter = self._parse_filter_input(filters['price'])
-        spread_filter = self._parse_filter_input(filters['spread'])
-        
-        for market in markets:
-            try:
-                # Проверка времени до окончания
-                hours_left = market.get('hours_left')
-                if hours_left is None:
-                    continue  # Пропускаем рынки без времени окончания
-                
-                if not self._check_value(hours_left, time_filter):
-                    continue
-                
-                # Проверка объема
-                volume = market.get('volume', 0)
-                
-                if not self._check_value(volume, volume_filter):
-                    continue
-                
-                # Проверка цены YES
-                best_yes_price = market.get('best_yes_price', 0)
-                
-                if not self._check_value(best_yes_price, price_filter):
-                    continue
-                
-                # Проверка спреда
-                spread = market.get('spread', 100)
-                
-                if not self._check_value(spread, spread_filter):
-                    continue
-                
-                filtered_markets.append(market)
-                
-            except Exception as e:
-                logger.error(f"Error filtering market {market.get('id')}: {e}")
-                continue
-        
-        return filtered_markets
-    
-    def _check_value(self, value: float, filter_dict: Dict) -> bool:
-        """Проверяет значение по фильтру"""
-        min_val = filter_dict.get('min')
-        max_val = filter_dict.get('max')
-        
-        if min_val is not None and value < min_val:
-            return False
-        if max_val is not None and value > max_val:
-            return False
-        
-        return True
+    @staticmethod
+    def _hours_left(market: Dict) -> Optional[float]:
+        """Часы до окончания рынка на текущий момент, None - если время неизвестно"""
+        close_ts = market.get('close_ts')
+        if close_ts is None:
+            return None
+        return (close_ts - time.time()) / 3600
     
-    async def perform_search(self, message: types.Message, filters: dict):
-        """Выполняет поиск рынков по фильтрам"""
-        try:
-            # Шаг 1: Получаем все рынки
-            status_msg = await message.answer("1️⃣ Получаю список всех активных рынков с Opinion Trade...")
-            all_child_markets = await self.fetch_all_markets()
-            
-            if not all_child_markets:
-                await status_msg.edit_text("❌ Не удалось получить список рынков. Попробуйте позже.")
-                return
-            
-            total_markets = len(all_child_markets)
-            await status_msg.edit_text(f"✅ Найдено {total_markets} активных рынков")
-            
-            # Шаг 2: Извлекаем данные и фильтруем по времени
-            status_msg = await message.answer("2️⃣ Обрабатываю данные и фильтрую по времени окончания...")
-            
-            # Извлекаем данные
-            processed_markets = []
-            for child_market in all_child_markets:
-                market = self.extract_market_data(child_market)
-                if market.get('hours_left') is not None:  # Только рынки с известным временем окончания
-                    processed_markets.append(market)
-            
-            # Фильтруем по времени
-            time_filter = self._parse_filter_input(filters['time'])
-            time_filtered = []
-            
-            for market in processed_markets:
-                hours_left = market.get('hours_left')
-                if hours_left is not None and self._check_value(hours_left, time_filter):
-                    time_filtered.append(market)
-            
-            if not time_filtered:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр времени")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
-            
-            time_filtered_count = len(time_filtered)
-            await status_msg.edit_text(f"✅ Осталось {time_filtered_count} рынков после фильтрации по времени")
-            
-            # Шаг 3: Фильтруем по объему
-            status_msg = await message.answer("3️⃣ Фильтрую по объему торгов...")
-            volume_filter = self._parse_filter_input(filters['volume'])
-            volume_filtered = []
-            
-            for market in time_filtered:
-                volume = market.get('volume', 0)
-                
-                if self._check_value(volume, volume_filter):
-                    volume_filtered.append(market)
-            
-            if not volume_filtered:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр объема")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
-            
-            volume_filtered_count = len(volume_filtered)
-            await status_msg.edit_text(f"✅ Осталось {volume_filtered_count} рынков после фильтрации по объему")
-            
-            # Шаг 4: Фильтруем по цене
-            status_msg = await message.answer("4️⃣ Фильтрую по цене...")
-            price_filter = self._parse_filter_input(filters['price'])
-            price_filtered = []
-            
-            for market in volume_filtered:
-                best_yes_price = market.get('best_yes_price', 0)
-                no_buy_price = market.get('no_buy_price', 0)
-                if self._check_value(best_yes_price, price_filter):
-                    price_filtered.append(market)
-                elif self._check_value(no_buy_price, price_filter):
-                    price_filtered.append(market)
-            if not price_filtered:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр цены")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
-            
-            price_filtered_count = len(price_filtered)
-            await status_msg.edit_text(f"✅ Осталось {price_filtered_count} рынков после фильтрации по цене")
-            
-            # Шаг 5: Фильтруем по спреду
-            status_msg = await message.answer("5️⃣ Фильтрую по спреду...")
-            spread_filter = self._parse_filter_input(filters['spread'])
-            final_markets = []
-            
-            for market in price_filtered:
-                spread = market.get('spread', 100)
-                print(spread)
-                if self._check_value(spread, spread_filter):
-                    final_markets.append(market)
-            
-            if not final_markets:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под все фильтры")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
-            
-            final_count = len(final_markets)
-            await status_msg.edit_text(f"🎉 Найдено {final_count} подходящих рынков!\n")
-            
-            # Шаг 6: Выводим результаты
-            if final_count == 0:
-                await message.answer("😔 Не найдено рынков, соответствующих всем вашим критериям.")
-                return
-            
-            # Сортируем по времени до окончания
-            final_markets.sort(key=lambda x: x.get('hours_left', float('inf')))
-            
-            # Отправляем сводку
-            filters_text = self._format_filters_text(filters)
-            
-            await message.answer(
-                f"📊 Результаты поиска на Opinion Trade:\n"
-                f"🔍 Всего проверено: {total_markets} рынков\n"
-                f"⏰ После фильтра времени: {time_filtered_count}\n"
-                f"💰 После фильтра объема: {volume_filtered_count}\n"
-                f"💵 После фильтра цены: {price_filtered_count}\n"
-                f"✅ Итоговых результатов: {final_count}\n\n"
-                f"{filters_text}\n"
-                f"Вот лучшие результаты (макс. 10):"
-            )
-            
-            # Выводим результаты (максимум 10)
-            for i, market in enumerate(final_markets[:10]):
-                await self.send_market_info_simple(message, market, i+1)
-                await asyncio.sleep(0.3)
-            
-            if final_count > 10:
-                await message.answer(f"\n📈 ... и еще {final_count - 10} рынков не показаны.")
-            
-            # Предложение изменить фильтры
-            await message.answer(
-                "🔍 Хотите найти другие рынки?\n"
-                "Используйте /filters для изменения критериев поиска\n"
-                "Используйте /search для повторного поиска с текущими фильтрами"
-            )
-            
-        except Exception as e:
-            logger.error(f"Search error: {e}", exc_info=True)
-            await message.answer(
-                f"❌ Произошла ошибка при поиске:\n\n"
-                f"Ошибка: {str(e)}\n\n"
-                f"Пожалуйста, попробуйте позже или измените фильтры."
-            )
+    @staticmethod
+    def _filter_stages(table: MarketTable, compiled: Dict[str, RangeFilter]) -> List[Tuple[str, np.ndarray]]:
+        """Маски этапов после фильтра времени (для пачки фильтров - формы (F, N))"""
+        price_filter = compiled['price']
+        return [
+            ('volume', compiled['volume'].mask(table['volume'])),
+            # Цена YES или NO
+            ('price', price_filter.mask(table['best_yes_price']) | price_filter.mask(table['no_buy_price'])),
+            ('spread', compiled['spread'].mask(table['spread'])),
+        ]
     
-    async def send_market_info_simple(self, message: types.Message, market: Dict, index: int):
-        """Отправляет упрощенную информацию о рынке"""
+    def format_market_card(self, market: Dict, index: int, detailed: bool = True) -> str:
+        """Форматирует карточку рынка: подробную или компактную, в несколько строк"""
         try:
             # Основная информация
             title = market.get('title', 'Без названия')
@@ -954,7 +900,7 @@ class OpinionBot:
             market_id = market.get('id', 'N/A')
             
             # Время до окончания
-            hours_left = market.get('hours_left')
+            hours_left = self._hours_left(market)
             time_left_str = 'N/A'
             if hours_left is not None:
                 if hours_left > 0:
@@ -984,6 +930,14 @@ class OpinionBot:
             volume = market.get('volume', 0)
             volume24h = market.get('volume24h', 0)
             
+            if not detailed:
+                return (
+                    f"📊 #{index} {title}\n"
+                    f"🆔 {market_id} | ⏰ {time_left_str}\n"
+                    f"✅ {market.get('yes_label', 'YES')} {best_yes_price:.1f}¢ | "
+                    f"❌ {market.get('no_label', 'NO')} {no_buy_price:.1f}¢ | 📈 {spread:.2f} | 💰 ${volume:,.0f}"
+                )
+            
             # Формируем сообщение
             response = f"📊 Рынок #{index}\n"
             response += "─" * 40 + "\n"
@@ -1032,10 +986,10 @@ class OpinionBot:
             
             response += "\n" + "─" * 40
             
-            await message.answer(response)
+            return response
             
         except Exception as e:
-            logger.error(f"Error sending market info #{index}: {e}", exc_info=True)
+            logger.error(f"Error formatting market info #{index}: {e}", exc_info=True)
             # Минимальная информация
             try:
                 basic_info = (
@@ -1045,27 +999,10 @@ class OpinionBot:
                     f"💰 Цена YES: {market.get('best_yes_price', 0):.1f}¢\n"
                     f"📈 Спред: {market.get('spread', 100):.2f}\n"
                 )
-                mid = market.get('topicId', '0')
-                if mid == 2382:
-                    print('==========================================')
-                    print('topicId')
-                    print(mid)
-                    print('==========================================')
-                mid = market.get('id', '0')
-                if mid == 2382:
-                    print('==========================================')
-                    print('Id')
-                    print(mid)
-                    print('==========================================')
-                await message.answer(basic_info)
+                return basic_info
             except Exception as e2:
-                logger.error(f"Error sending minimal info: {e2}")
-                await message.answer(f"⚠️ Ошибка при отображении рынка #{index}")
-    
-    async def run(self):
-        """Запускает бота"""
-        logger.info("Starting Opinion Trade Bot...")
-        await self.dp.start_polling(self.bot)
+                logger.error(f"Error formatting minimal info: {e2}")
+                return f"⚠️ Ошибка при отображении рынка #{index}"
 
 # Точка входа
 if __name__ == "__main__":
@@ -1089,8 +1026,48 @@ if __name__ == "__main__":
         print("  2. Или запустите: python opinion_bot.py ваш_токен")
         sys.exit(1)
     
+    # TTL общего снимка рынков в секундах
+    cache_ttl = float(os.getenv('CACHE_TTL', '120'))
+    
+    # Период фонового обновления каталога в секундах
+    refresh_interval = float(os.getenv('REFRESH_INTERVAL', '90'))
+    
+    # Каждое N-е обновление полное, остальные инкрементальные
+    full_refresh_every = int(os.getenv('FULL_REFRESH_EVERY', '10'))
+    
+    # Параллельность загрузки страниц и лимит запросов в секунду
+    page_concurrency = int(os.getenv('PAGE_CONCURRENCY', '4'))
+    requests_per_second = float(os.getenv('REQUESTS_PER_SECOND', '6'))
+    
+    # Размер пула HTTP-соединений к API площадки
+    connection_limit = int(os.getenv('HTTP_CONNECTION_LIMIT', '20'))
+    
+    # Вебхук вместо long polling: публичный URL, путь и адрес встроенного сервера
+    webhook_url = os.getenv('WEBHOOK_URL') or None
+    webhook_path = os.getenv('WEBHOOK_PATH', '/webhook')
+    webhook_host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    webhook_port = int(os.getenv('WEBHOOK_PORT', '8080'))
+    webhook_secret = os.getenv('WEBHOOK_SECRET') or None
+    
+    # Альтернативный сервер Bot API (локальный или тестовый)
+    api_server = os.getenv('TELEGRAM_API_URL') or None
+    
     # Создаем и запускаем бота
-    bot = OpinionBot(bot_token)
+    bot = OpinionBot(
+        bot_token,
+        cache_ttl=cache_ttl,
+        refresh_interval=refresh_interval,
+        full_refresh_every=full_refresh_every,
+        page_concurrency=page_concurrency,
+        requests_per_second=requests_per_second,
+        connection_limit=connection_limit,
+        webhook_url=webhook_url,
+        webhook_path=webhook_path,
+        webhook_host=webhook_host,
+        webhook_port=webhook_port,
+        webhook_secret=webhook_secret,
+        api_server=api_server
+    )
     
     try:
         # Запуск бота
@@ -1,17 +1,19 @@
 import logging
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 import aiohttp
 import asyncio
+import time
 from typing import List, Dict, Any, Optional
 import pytz
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Optional, Tuple, AsyncIterator
 import json
+import numpy as np
+from core import SEARCH_AGAIN_TEXT, MarketBot, MarketTable, ProgressMessage, RangeFilter, TopK, VenueAPI
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,286 +22,321 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-
 class MarketFilters:
 
     @staticmethod
-    def parse_time_filter(hours_range: str) -> Tuple[Optional[datetime], Optional[datetime]]:
-        """Парсит фильтр времени и возвращает диапазон"""
-        now = datetime.utcnow().replace(tzinfo=None)
+    def compile_time_filter(hours_range: str) -> RangeFilter:
+        """Компилирует фильтр времени в диапазон часов до окончания"""
+        if '-' in hours_range:
+            # Диапазон часов, например "6-12"
+            start_h, end_h = map(int, hours_range.split('-'))
+            return RangeFilter(start_h, end_h)
 
-        try:
-            if '-' in hours_range:
-                # Диапазон часов, например "6-12"
-                start_h, end_h = map(int, hours_range.split('-'))
-                start_time = now + timedelta(hours=start_h)
-                end_time = now + timedelta(hours=end_h)
-            else:
-                # Одно значение часов, например "12"
-                hours = int(hours_range)
-                start_time = now + timedelta(hours=hours - 1)
-                end_time = now + timedelta(hours=hours)
+        # Одно значение часов, например "12"
+        hours = int(hours_range)
+        return RangeFilter(hours - 1, hours)
 
-            return start_time, end_time
-        except Exception as e:
-            print(f"Error parsing time filter: {e}")
-            return None, None
+    @staticmethod
+    def compile_range_filter(value_range: str, divisor: float = 1.0) -> RangeFilter:
+        """Компилирует фильтр вида "мин-макс", деля границы на divisor"""
+        min_value, max_value = map(float, value_range.split('-'))
+        return RangeFilter(min_value / divisor, max_value / divisor)
 
     @staticmethod
-    def filter_by_time_range(markets: List[Dict], hours_range: str) -> List[Dict]:
-        """Фильтрует рынки по диапазону времени до окончания"""
-        start_time, end_time = MarketFilters.parse_time_filter(hours_range)
-        if not start_time or not end_time:
-            return markets
+    def compile_liquidity_filter(liquidity_filter: str) -> RangeFilter:
+        """Компилирует фильтр ликвидности в диапазон"""
+        if '-' in liquidity_filter and '+' not in liquidity_filter and not liquidity_filter.endswith('-'):
+            # Диапазон: "10000-50000"
+            return MarketFilters.compile_range_filter(liquidity_filter)
 
-        filtered_markets = []
+        if '+' in liquidity_filter:
+            # Больше чем: "10000+"
+            return RangeFilter(float(liquidity_filter.replace('+', '').strip()), float('inf'))
 
-        for market in markets:
-            end_date_str = market.get('endDate')
-            if not end_date_str:
-                continue
+        if liquidity_filter.endswith('-'):
+            # Меньше чем: "10000-"
+            return RangeFilter(float('-inf'), float(liquidity_filter.replace('-', '').strip()))
 
-            try:
-                # Парсим дату окончания
-                if end_date_str.endswith('Z'):
-                    dt_str = end_date_str[:-1] + '+00:00'
-                else:
-                    dt_str = end_date_str
+        # Диапазон с одним значением: "5000" -> 4000-6000
+        target_liquidity = float(liquidity_filter)
+        return RangeFilter(target_liquidity * 0.8, target_liquidity * 1.2)
 
-                market_end = datetime.fromisoformat(dt_str)
-                market_end_utc = market_end.replace(tzinfo=None)
+    @staticmethod
+    def compile_filters(filters: Dict) -> Dict[str, Any]:
+        """Один раз разбирает строки фильтров пользователя в диапазоны"""
+        liquidity_filter = filters.get('liquidity')
+        slippage_filter = filters.get('slippage')
+        return {
+            'time': MarketFilters.compile_time_filter(filters['time']),
+            'spread': MarketFilters.compile_range_filter(filters['spread']),
+            # Цены вводятся в центах, а в рынках хранятся в долларах
+            'price': MarketFilters.compile_range_filter(filters['price'], divisor=100),
+            'liquidity': MarketFilters.compile_liquidity_filter(liquidity_filter) if liquidity_filter else None,
+            'slippage': MarketFilters.parse_slippage_filter(slippage_filter) if slippage_filter else None
+        }
 
-                if start_time <= market_end_utc <= end_time:
-                    filtered_markets.append(market)
-            except Exception as e:
-                print(f"Error parsing end date {end_date_str}: {e}")
-                continue
+    @staticmethod
+    def spread_mask(table: MarketTable, spread_range: RangeFilter) -> np.ndarray:
+        """Маска рынков по спреду из данных markets API (в процентах)"""
+        return spread_range.mask(table['spread'])
 
-        return filtered_markets
+    @staticmethod
+    def combined_price_mask(table: MarketTable, price_range: RangeFilter) -> np.ndarray:
+        """Маска рынков, у которых цена YES ИЛИ NO попадает в диапазон"""
+        return price_range.mask(table['yes_price']) | price_range.mask(table['no_price'])
 
     @staticmethod
-    def filter_by_spread(markets: List[Dict], spread_range: str) -> List[Dict]:
-        """Фильтрует рынки по спреду из данных markets API"""
-        try:
-            min_spread, max_spread = map(float, spread_range.split('-'))
-            # Конвертируем в проценты, если spread в десятичных (например, 0.003 = 0.3%)
-            min_spread_percent = min_spread
-            max_spread_percent = max_spread
-
-            filtered_markets = []
-            for market in markets:
-                try:
-                    # Получаем спред из данных markets
-                    spread_str = market.get('spread')
-                    if spread_str is None:
-                        continue
-
-                    spread = float(spread_str) * 100  # Конвертируем в проценты
-
-                    # Проверяем, попадает ли спред в диапазон
-                    print("============================================")
-                    print(min_spread_percent)
-                    print(spread)
-                    print(max_spread_percent)
-                    if min_spread_percent <= spread <= max_spread_percent:
-                        filtered_markets.append(market)
-                except Exception as e:
-                    print(f"Error filtering market by spread: {e}")
-                    continue
+    def liquidity_mask(table: MarketTable, liquidity_range: RangeFilter) -> np.ndarray:
+        """Маска рынков по ликвидности"""
+        return liquidity_range.mask(table['liquidity'])
 
-        except Exception as e:
-            print(f"Error parsing spread filter: {e}")
-            return markets
+    @staticmethod
+    def parse_slippage_filter(slippage_filter: str) -> Tuple[float, float]:
+        """Парсит фильтр проскальзывания "сумма:макс_центов", например "500:2" """
+        notional, max_slippage = map(float, slippage_filter.split(':'))
+        return notional, max_slippage
 
-        return filtered_markets
 
-    @staticmethod
-    def filter_by_combined_price(markets: List[Dict], price_range: str) -> List[Dict]:
-        """Фильтрует рынки по цене YES ИЛИ NO"""
-        try:
-            min_price, max_price = map(float, price_range.split('-'))
-            # Конвертируем в десятичные дроби
-            min_price_decimal = min_price / 100
-            max_price_decimal = max_price / 100
-
-            filtered_markets = []
-            for market in markets:
-                try:
-                    # Получаем цены YES и NO
-                    outcome_prices_str = market.get('outcomePrices', '[]')
-                    if outcome_prices_str.startswith('"') and outcome_prices_str.endswith('"'):
-                        outcome_prices_str = outcome_prices_str[1:-1]
-                    outcome_prices_str = outcome_prices_str.replace('\\"', '"')
-                    outcome_prices = json.loads(outcome_prices_str)
-
-                    if not outcome_prices or len(outcome_prices) < 2:
-                        continue
-
-                    yes_price = float(outcome_prices[0])
-                    no_price = float(outcome_prices[1])
-
-                    # Проверяем, попадает ли YES ИЛИ NO в диапазон
-                    if (min_price_decimal <= yes_price <= max_price_decimal or
-                            min_price_decimal <= no_price <= max_price_decimal):
-                        filtered_markets.append(market)
-                except Exception as e:
-                    print(f"Error filtering market by combined price: {e}")
-                    continue
+class PolymarketAPI(VenueAPI):
+    def __init__(self, page_concurrency: int = 8, delta_window_pages: int = 8, connection_limit: int = 20,
+                 keepalive_timeout: float = 30.0, dns_cache_ttl: int = 300, orderbook_concurrency: int = 4,
+                 orderbook_timeout: float = 5.0, orderbook_ttl: float = 10.0):
+        super().__init__(connection_limit, keepalive_timeout, dns_cache_ttl)
+        self.markets_url = "https://gamma-api.polymarket.com/markets"
+        self.orderbook_url = "https://clob.polymarket.com/books"
+        self.page_limit = 100
+        # Сколько окон offset запрашивается одновременно (1 = последовательно)
+        self.page_concurrency = max(1, page_concurrency)
+        self.last_fetch_stats: Dict[str, Any] = {}
+
+        # Стаканы CLOB: группы по 100 токенов запрашиваются параллельно, с ограничением по времени
+        self.orderbook_semaphore = asyncio.Semaphore(max(1, orderbook_concurrency))
+        self.orderbook_timeout = aiohttp.ClientTimeout(total=orderbook_timeout)
+        # Недавно полученные стаканы по токенам: (время получения, стакан или None, если его нет)
+        self.orderbook_ttl = orderbook_ttl
+        self._orderbook_cache: Dict[str, Tuple[float, Optional[Dict]]] = {}
+
+        # Инкрементальное обновление: окна offset, перекачиваемые по кругу
+        self.delta_window_pages = max(1, delta_window_pages)
+        self._known_pages = 0
+        self._delta_position = 0
+
+    async def _fetch_markets_page(self, session: aiohttp.ClientSession, offset: int,
+                                  limit: int) -> Tuple[Optional[List[Dict]], float]:
+        """Получает одно окно рынков; возвращает (рынки или None при ошибке, задержку)"""
+        params = {
+            'limit': limit,
+            'offset': offset,
+            'closed': 'false'  # Получаем только активные рынки
+        }
+        started = time.monotonic()
 
+        try:
+            async with session.get(self.markets_url, params=params) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    # API возвращает список markets напрямую
+                    markets = data if isinstance(data, list) else []
+                    malformed = sum(not self.normalize_market(market) for market in markets)
+                    if malformed:
+                        logger.warning(f"{malformed} markets at offset {offset} have malformed JSON list fields")
+                    return markets, time.monotonic() - started
+                else:
+                    print(f"Error fetching markets at offset {offset}: {response.status}")
         except Exception as e:
-            print(f"Error parsing price filter: {e}")
-            return markets
+            print(f"Exception fetching markets at offset {offset}: {e}")
 
-        return filtered_markets
+        return None, time.monotonic() - started
 
-    @staticmethod
-    def filter_by_liquidity(markets: List[Dict], liquidity_filter: str) -> List[Dict]:
-        """Фильтрует рынки по ликвидности"""
-        try:
-            filtered_markets = []
+    async def iter_market_pages(self) -> AsyncIterator[List[Dict]]:
+        """Отдает рынки постранично по мере загрузки.
 
-            for market in markets:
-                try:
-                    # Получаем ликвидность из рынка
-                    liquidity_str = market.get('liquidity')
-                    if not liquidity_str:
-                        continue
+        Окна offset запрашиваются пачками по page_concurrency штук до первой
+        неполной страницы; ошибка окна прерывает загрузку исключением.
+        Рынки, сдвинувшиеся между окнами, убираются по id.
+        """
+        seen_ids = set()
+        page_latencies = []
+        offset = 0
+        limit = self.page_limit
+        started = time.monotonic()
+        pages_fetched = 0
+        total = 0
+
+        session = await self.get_session()
+        while True:
+            offsets = [offset + i * limit for i in range(self.page_concurrency)]
+            results = await asyncio.gather(
+                *[self._fetch_markets_page(session, page_offset, limit) for page_offset in offsets]
+            )
 
-                    liquidity = float(liquidity_str)
+            last_page_reached = False
+            for page_offset, (markets, latency) in zip(offsets, results):
+                page_latencies.append((page_offset, latency))
 
-                    # Применяем фильтр в зависимости от формата
-                    if '-' in liquidity_filter and '+' not in liquidity_filter:
-                        # Диапазон: "10000-50000"
-                        min_liquidity, max_liquidity = map(float, liquidity_filter.split('-'))
+                if markets is None:
+                    # Обрыв посреди каталога: прежний снимок и число окон остаются в силе
+                    raise RuntimeError(f"Failed to fetch markets at offset {page_offset}")
 
-                        if min_liquidity <= liquidity <= max_liquidity:
-                            filtered_markets.append(market)
+                if not markets:
+                    last_page_reached = True
+                    break
 
-                    elif '+' in liquidity_filter:
-                        # Больше чем: "10000+"
-                        min_liquidity = float(liquidity_filter.replace('+', '').strip())
+                pages_fetched += 1
+                page = []
+                for market in markets:
+                    market_id = market.get('id')
+                    if market_id is not None:
+                        if market_id in seen_ids:
+                            continue
+                        seen_ids.add(market_id)
+                    page.append(market)
 
-                        if liquidity >= min_liquidity:
-                            filtered_markets.append(market)
+                total += len(page)
+                if page:
+                    yield page
 
-                    elif liquidity_filter.endswith('-'):
-                        # Меньше чем: "10000-"
-                        max_liquidity = float(liquidity_filter.replace('-', '').strip())
+                if len(markets) < limit:
+                    last_page_reached = True
+                    break
 
-                        if liquidity <= max_liquidity:
-                            filtered_markets.append(market)
+            if last_page_reached:
+                break
 
-                    else:
-                        # Диапазон с одним значением: "5000" -> 4000-6000
-                        try:
-                            target_liquidity = float(liquidity_filter)
-                            min_liquidity = target_liquidity * 0.8  # -20%
-                            max_liquidity = target_liquidity * 1.2  # +20%
-
-                            if min_liquidity <= liquidity <= max_liquidity:
-                                filtered_markets.append(market)
-                        except:
-                            continue
+            offset += limit * self.page_concurrency
 
-                except Exception as e:
-                    print(f"Error filtering market by liquidity: {e}")
-                    continue
+        if pages_fetched:
+            self._known_pages = pages_fetched
+            self._delta_position = 0
 
-            return filtered_markets
+        wall_time = time.monotonic() - started
+        latencies = [latency for _, latency in page_latencies]
+        self.last_fetch_stats = {
+            'markets': total,
+            'pages': len(page_latencies),
+            'wall_time': wall_time,
+            'page_latencies': page_latencies,
+            'avg_page_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+            'max_page_latency': max(latencies) if latencies else 0.0,
+        }
+        logger.info(
+            f"Fetched {total} markets from {len(page_latencies)} pages in {wall_time:.2f}s "
+            f"(page latency avg {self.last_fetch_stats['avg_page_latency']:.2f}s, "
+            f"max {self.last_fetch_stats['max_page_latency']:.2f}s)"
+        )
+
+    async def fetch_changed_markets(self) -> Optional[List[Dict]]:
+        """Перекачивает очередное окно страниц каталога по кругу.
+
+        Возвращает только рынки из этих окон; None, если число страниц
+        еще неизвестно или все запросы завершились ошибкой.
+        """
+        if not self._known_pages:
+            return None
 
-        except Exception as e:
-            print(f"Error parsing liquidity filter: {e}")
-            return markets
+        window = min(self.delta_window_pages, self._known_pages)
+        pages = [(self._delta_position + i) % self._known_pages for i in range(window)]
+        self._delta_position = (self._delta_position + window) % self._known_pages
 
+        session = await self.get_session()
+        results = await asyncio.gather(
+            *[self._fetch_markets_page(session, page * self.page_limit, self.page_limit) for page in pages]
+        )
 
-class PolymarketAPI:
-    def __init__(self):
-        self.markets_url = "https://gamma-api.polymarket.com/markets"
-        self.orderbook_url = "https://clob.polymarket.com/books"
+        if all(markets is None for markets, _ in results):
+            return None
 
-    async def fetch_all_markets(self) -> List[Dict]:
-        """Получает все рынки с учетом пагинации"""
-        all_markets = []
-        offset = 0
-        limit = 100
-
-        async with aiohttp.ClientSession() as session:
-            while True:
-                params = {
-                    'limit': limit,
-                    'offset': offset,
-                    'closed': 'false'  # Получаем только активные рынки
-                }
+        changed_markets = []
+        for markets, _ in results:
+            if markets:
+                changed_markets.extend(markets)
 
-                try:
-                    async with session.get(self.markets_url, params=params) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            # API возвращает список markets напрямую
-                            markets = data if isinstance(data, list) else []
-
-                            if not markets:
-                                break
-
-                            all_markets.extend(markets)
-                            offset += len(markets)
-
-                            if len(markets) < limit:
-                                break
-                        else:
-                            print(f"Error fetching markets: {response.status}")
-                            break
-                except Exception as e:
-                    print(f"Exception fetching markets: {e}")
-                    break
+        logger.info(f"Delta fetch: pages {pages} of {self._known_pages}, {len(changed_markets)} markets")
+        return changed_markets
 
-        return all_markets
+    async def _fetch_orderbook_chunk(self, session: aiohttp.ClientSession, chunk: List[str]) -> Optional[List[Dict]]:
+        """Получает стаканы для одной группы токенов (не более 100); None - запрос не удался"""
+        # Создаем payload в правильном формате
+        payload = [{"token_id": token_id} for token_id in chunk]
+
+        async with self.orderbook_semaphore:
+            try:
+                async with session.post(self.orderbook_url, json=payload, timeout=self.orderbook_timeout) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        return data if isinstance(data, list) else []
+                    logger.warning(f"Orderbook chunk of {len(chunk)} tokens failed: HTTP {response.status}")
+            except Exception:
+                logger.exception(f"Orderbook chunk of {len(chunk)} tokens failed")
+        return None
 
     async def fetch_orderbooks(self, token_ids: List[str]) -> Dict[str, Dict]:
-        """Получает стаканы ордеров для списка токенов"""
+        """Получает стаканы ордеров для списка токенов; стаканы моложе orderbook_ttl берутся из кэша"""
         if not token_ids:
             return {}
 
-        # Разбиваем на группы по 100 токенов
-        chunks = [token_ids[i:i + 100] for i in range(0, len(token_ids), 100)]
-        all_orderbooks = {}
+        started = time.monotonic()
+        self._orderbook_cache = {
+            token: entry for token, entry in self._orderbook_cache.items()
+            if started - entry[0] < self.orderbook_ttl
+        }
 
-        async with aiohttp.ClientSession() as session:
-            for chunk in chunks:
-                # Создаем payload в правильном формате
-                payload = [{"token_id": token_id} for token_id in chunk]
-
-                try:
-                    async with session.post(self.orderbook_url, json=payload) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            # Ответ - это список словарей, нужно преобразовать в удобный формат
-                            for book in data:
-                                if isinstance(book, dict) and 'asset_id' in book:
-                                    all_orderbooks[book['asset_id']] = book
-                except Exception as e:
-                    print(f"Error fetching orderbook for chunk: {e}")
+        all_orderbooks = {}
+        missing = []
+        for token in token_ids:
+            entry = self._orderbook_cache.get(token)
+            if entry is None:
+                missing.append(token)
+            elif entry[1] is not None:
+                all_orderbooks[token] = entry[1]
+
+        # Разбиваем на группы по 100 токенов и запрашиваем их одновременно
+        chunks = [missing[i:i + 100] for i in range(0, len(missing), 100)]
+        if chunks:
+            session = await self.get_session()
+            results = await asyncio.gather(*(self._fetch_orderbook_chunk(session, chunk) for chunk in chunks))
+
+            fetched_at = time.monotonic()
+            for chunk, books in zip(chunks, results):
+                # Неудавшиеся группы не кэшируем, чтобы следующий поиск запросил их снова
+                if books is None:
                     continue
-
+                # Ответ - это список словарей, нужно преобразовать в удобный формат
+                chunk_books = {
+                    book['asset_id']: book for book in books
+                    if isinstance(book, dict) and 'asset_id' in book
+                }
+                all_orderbooks.update(chunk_books)
+                for token in chunk:
+                    self._orderbook_cache[token] = (fetched_at, chunk_books.get(token))
+
+        logger.info(
+            f"Orderbooks: {len(all_orderbooks)}/{len(token_ids)} available, {len(missing)} requested "
+            f"in {len(chunks)} chunks in {time.monotonic() - started:.2f}s"
+        )
         return all_orderbooks
 
+    @staticmethod
+    def best_prices(orderbook: Dict) -> Tuple[Optional[float], Optional[float]]:
+        """Возвращает лучшие bid и ask стакана (порядок уровней в ответе CLOB не важен)"""
+        bids = orderbook.get('bids') or []
+        asks = orderbook.get('asks') or []
+        best_bid = max((float(level['price']) for level in bids), default=None)
+        best_ask = min((float(level['price']) for level in asks), default=None)
+        return best_bid, best_ask
+
     def calculate_spread(self, orderbook: Dict) -> Optional[float]:
         """Рассчитывает спред между лучшим bid и ask в процентах"""
         try:
             if not orderbook:
                 return None
 
-            bids = orderbook.get('bids', [])
-            asks = orderbook.get('asks', [])
+            # Лучший bid - самая высокая цена покупки, лучший ask - самая низкая цена продажи
+            best_bid, best_ask = self.best_prices(orderbook)
 
-            if not bids or not asks:
+            if best_bid is None or best_ask is None:
                 return None
 
-            # Лучший bid (самая высокая цена покупки)
-            best_bid = float(bids[0]['price']) if bids else 0
-            # Лучший ask (самая низкая цена продажи)
-            best_ask = float(asks[0]['price']) if asks else 1
-
             # Спред в процентах
             spread = (best_ask - best_bid) * 100
             return round(spread, 2)
@@ -308,33 +345,228 @@ class PolymarketAPI:
             print(f"Error calculating spread: {e}")
             return None
 
-    def get_market_tokens(self, market: Dict) -> List[str]:
-        """Извлекает clobTokenIds из рынка"""
+    @staticmethod
+    def _walk_side(book_index: np.ndarray, prices: np.ndarray, sizes: np.ndarray, n_books: int,
+                   notional: float, buy: bool) -> Tuple[np.ndarray, np.ndarray]:
+        """Проходит одну сторону всех стаканов сразу; возвращает (средняя цена исполнения, исполненная сумма)"""
+        # Уровни каждого стакана от лучшей цены к худшей: asks по возрастанию, bids по убыванию
+        order = np.lexsort((prices if buy else -prices, book_index))
+        book_index, prices, sizes = book_index[order], prices[order], sizes[order]
+
+        # Накопленная стоимость уровней внутри каждого стакана
+        level_cost = prices * sizes
+        cumulative = np.cumsum(level_cost)
+        book_start = np.searchsorted(book_index, np.arange(n_books))
+        book_base = np.concatenate(([0.0], cumulative))[book_start]
+        cost_before = cumulative - level_cost - book_base[book_index]
+
+        # Сколько долларов забирается с каждого уровня и сколько акций это дает
+        taken = np.clip(notional - cost_before, 0.0, level_cost)
+        shares = np.divide(taken, prices, out=np.zeros_like(taken), where=prices > 0)
+
+        filled = np.bincount(book_index, weights=taken, minlength=n_books)
+        total_shares = np.bincount(book_index, weights=shares, minlength=n_books)
+        avg_price = np.divide(filled, total_shares, out=np.full(n_books, np.nan), where=total_shares > 0)
+        return avg_price, filled
+
+    @staticmethod
+    def calculate_slippage(orderbooks: List[Dict], notional: float) -> Dict[str, np.ndarray]:
+        """Векторно рассчитывает среднюю цену исполнения и проскальзывание (в центах) для суммы notional
+        на покупку (по asks) и продажу (по bids) для каждого стакана. Если глубины не хватает,
+        проскальзывание равно inf."""
+        n_books = len(orderbooks)
+        result = {}
+
+        for side, buy in (('asks', True), ('bids', False)):
+            levels = [
+                (i, level['price'], level['size'])
+                for i, book in enumerate(orderbooks)
+                for level in (book.get(side) or [])
+            ]
+            best = np.full(n_books, np.nan)
+            avg_price = np.full(n_books, np.nan)
+            filled = np.zeros(n_books)
+
+            if levels:
+                book_index = np.fromiter((level[0] for level in levels), dtype=np.int64, count=len(levels))
+                prices = np.fromiter((float(level[1]) for level in levels), dtype=float, count=len(levels))
+                sizes = np.fromiter((float(level[2]) for level in levels), dtype=float, count=len(levels))
+
+                avg_price, filled = PolymarketAPI._walk_side(book_index, prices, sizes, n_books, notional, buy)
+
+                # Лучшая цена стороны: минимальный ask или максимальный bid
+                best_price = np.minimum if buy else np.maximum
+                best = np.full(n_books, np.inf if buy else -np.inf)
+                best_price.at(best, book_index, prices)
+                best[np.isinf(best)] = np.nan
+
+            slippage = (avg_price - best) if buy else (best - avg_price)
+            slippage = np.where(filled >= notional * (1 - 1e-9), slippage * 100, np.inf)
+
+            name = 'buy' if buy else 'sell'
+            result[f'{name}_price'] = avg_price
+            result[f'{name}_slippage'] = slippage
+
+        return result
+
+    async def apply_orderbook_metrics(self, markets: List[Dict], live_spread: bool = True,
+                                      notional: Optional[float] = None) -> List[Dict]:
+        """Возвращает копии рынков с данными живых стаканов YES-токена: bid/ask/спред и,
+        если задана сумма сделки, цены исполнения и проскальзывание"""
+        yes_tokens = {}
+        for market in markets:
+            tokens = self.get_market_tokens(market)
+            if tokens:
+                yes_tokens[market.get('id')] = tokens[0]
+
+        orderbooks = await self.fetch_orderbooks(list(set(yes_tokens.values())))
+
+        # Проскальзывание считается одним векторным проходом по всем стаканам
+        slippage = {}
+        if notional:
+            token_order = list(orderbooks)
+            metrics = self.calculate_slippage([orderbooks[token] for token in token_order], notional)
+            for i, token in enumerate(token_order):
+                slippage[token] = {
+                    'fillPriceBuy': float(metrics['buy_price'][i]),
+                    'slippageBuy': float(metrics['buy_slippage'][i]),
+                    'fillPriceSell': float(metrics['sell_price'][i]),
+                    'slippageSell': float(metrics['sell_slippage'][i]),
+                    'slippageNotional': notional
+                }
+
+        live_markets = []
+        for market in markets:
+            token = yes_tokens.get(market.get('id'))
+            orderbook = orderbooks.get(token)
+            if not orderbook:
+                # Стакан не получен - остаемся на данных gamma API; исполнить объем в нем
+                # нельзя, поэтому проверенный рынок не проходит фильтр проскальзывания
+                live_markets.append({**market, 'slippageBuy': float('inf')} if notional else market)
+                continue
+
+            live_market = {**market, **slippage.get(token, {})}
+
+            try:
+                best_bid, best_ask = self.best_prices(orderbook)
+            except Exception:
+                logger.exception(f"Malformed orderbook for market {market.get('id')}")
+                live_markets.append(live_market)
+                continue
+
+            # Одностороннего стакана недостаточно для спреда
+            if live_spread and best_bid is not None and best_ask is not None:
+                live_market.update({
+                    'bestBid': best_bid,
+                    'bestAsk': best_ask,
+                    'spread': round(best_ask - best_bid, 4),
+                    'liveSpread': True
+                })
+
+            live_markets.append(live_market)
+
+        return live_markets
+
+    @staticmethod
+    def _parse_end_timestamp(end_date_str: Optional[str]) -> Optional[float]:
+        """Переводит endDate в Unix timestamp (дата без зоны считается UTC), None - если не разобрать"""
+        if not end_date_str:
+            return None
         try:
-            clob_token_ids_str = market.get('clobTokenIds', '[]')
-            # Удаляем лишние кавычки и преобразуем JSON строку
-            clob_token_ids_str = clob_token_ids_str.replace('\\"', '"').strip('"')
-            clob_token_ids = json.loads(clob_token_ids_str)
-            return clob_token_ids
-        except Exception as e:
-            print(f"Error parsing clobTokenIds: {e}")
+            if end_date_str.endswith('Z'):
+                end_date_str = end_date_str[:-1] + '+00:00'
+            market_end = datetime.fromisoformat(end_date_str)
+            if market_end.tzinfo is None:
+                market_end = market_end.replace(tzinfo=timezone.utc)
+            return market_end.timestamp()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _decode_json_list(value) -> Optional[List]:
+        """Декодирует поле-список, которое API отдает JSON-строкой (иногда в лишних кавычках).
+
+        None - значение не разобрать; ошибки считает и пишет в лог вызывающий код.
+        """
+        if isinstance(value, list):
+            return value
+        if not value:
             return []
+        try:
+            if value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            decoded = json.loads(value.replace('\\"', '"'))
+            return decoded if isinstance(decoded, list) else []
+        except (AttributeError, ValueError):
+            return None
 
-    def parse_market_prices(self, market: Dict) -> Dict[str, float]:
-        """Парсит цены outcomes из рынка"""
+    @staticmethod
+    def _optional_float(value) -> Optional[float]:
+        """Приводит значение из API к числу, None - если значения нет"""
+        if value is None:
+            return None
         try:
-            outcome_prices_str = market.get('outcomePrices', '[]')
-            outcome_prices_str = outcome_prices_str.replace('\\"', '"').strip('"')
-            outcome_prices = json.loads(outcome_prices_str)
+            return float(value)
+        except (TypeError, ValueError):
+            return None
 
-            outcomes_str = market.get('outcomes', '[]')
-            outcomes_str = outcomes_str.replace('\\"', '"').strip('"')
-            outcomes = json.loads(outcomes_str)
+    def normalize_market(self, market: Dict) -> bool:
+        """Один раз при загрузке приводит поля рынка к числам.
+
+        close_ts - время окончания как Unix timestamp; spread, bestBid, bestAsk,
+        lastTradePrice, liquidity и volume24hr - числа (None, если значения нет).
+        JSON-строки outcomes, outcomePrices и clobTokenIds декодируются в списки
+        (пустые, если строку не разобрать), а цены YES/NO выносятся в yes_price и no_price.
+        Фильтры и вывод читают только эти поля и больше не разбирают JSON.
+        Возвращает False, если какое-то из полей-списков не удалось разобрать.
+        """
+        market['close_ts'] = self._parse_end_timestamp(market.get('endDate'))
+
+        decoded = {
+            field: self._decode_json_list(market.get(field))
+            for field in ('outcomes', 'clobTokenIds', 'outcomePrices')
+        }
+        market['outcomes'] = [str(outcome) for outcome in decoded['outcomes'] or []]
+        market['clobTokenIds'] = [str(token) for token in decoded['clobTokenIds'] or []]
+        outcome_prices = [self._optional_float(price) for price in decoded['outcomePrices'] or []]
+        market['outcomePrices'] = outcome_prices
+        has_prices = len(outcome_prices) >= 2
+        market['yes_price'] = outcome_prices[0] if has_prices else None
+        market['no_price'] = outcome_prices[1] if has_prices else None
+
+        for field in ('spread', 'bestBid', 'bestAsk', 'lastTradePrice', 'volume24hr'):
+            market[field] = self._optional_float(market.get(field))
+        # Пустая или нулевая ликвидность считается отсутствующей
+        market['liquidity'] = self._optional_float(market.get('liquidity') or None)
+        return all(values is not None for values in decoded.values())
+
+    def build_market_table(self, markets: List[Dict]) -> MarketTable:
+        """Строит колонковую таблицу рынков для векторной фильтрации"""
+        count = len(markets)
+
+        def column(field: str) -> np.ndarray:
+            # Отсутствующие значения становятся NaN и не проходят фильтры
+            return np.fromiter(
+                (market[field] if market[field] is not None else np.nan for market in markets),
+                dtype=float, count=count
+            )
 
-            return {outcomes[i]: float(outcome_prices[i]) for i in range(len(outcomes))}
-        except Exception as e:
-            print(f"Error parsing market prices: {e}")
-            return {}
+        return MarketTable(markets, {
+            'close_ts': column('close_ts'),
+            # Спред в API в долях, в таблице - в процентах
+            'spread': column('spread') * 100,
+            'yes_price': column('yes_price'),
+            'no_price': column('no_price'),
+            'liquidity': column('liquidity'),
+        })
+
+    def get_market_tokens(self, market: Dict) -> List[str]:
+        """Извлекает clobTokenIds из рынка (декодированы при загрузке)"""
+        return market.get('clobTokenIds') or []
+
+    def parse_market_prices(self, market: Dict) -> Dict[str, float]:
+        """Возвращает цены outcomes рынка (декодированы при загрузке)"""
+        return dict(zip(market.get('outcomes') or [], market.get('outcomePrices') or []))
 
     def parse_end_time(self, end_time_str: str) -> Optional[datetime]:
         """Парсит время окончания события"""
@@ -377,15 +609,28 @@ class FilterStates(StatesGroup):
     waiting_for_liquidity_filter = State()
 
 
-class PolymarketBot:
-    def __init__(self, token: str):
-        self.bot = Bot(token=token)
-        self.dp = Dispatcher(storage=MemoryStorage())
-        self.api = PolymarketAPI()
-        self.user_filters = {}
-
-        # Регистрация обработчиков
-        self.register_handlers()
+class PolymarketBot(MarketBot):
+    venue_title = "Polymarket"
+    funnel_stages = ('spread', 'price', 'liquidity', 'slippage')
+
+    def __init__(self, token: str, cache_ttl: float = 60.0, refresh_interval: float = 45.0,
+                 full_refresh_every: int = 10, page_concurrency: int = 8, connection_limit: int = 20,
+                 keepalive_timeout: float = 30.0, dns_cache_ttl: int = 300, live_spread: bool = True,
+                 orderbook_concurrency: int = 4, live_markets_limit: int = 400, **options):
+        # Фильтровать спред по живым стаканам CLOB, а не по полю spread из gamma API
+        self.live_spread = live_spread
+        # Сколько рынков за поиск проверять по живым стаканам (ограничивает время поиска)
+        self.live_markets_limit = max(1, live_markets_limit)
+
+        api = PolymarketAPI(
+            page_concurrency=page_concurrency,
+            connection_limit=connection_limit,
+            keepalive_timeout=keepalive_timeout,
+            dns_cache_ttl=dns_cache_ttl,
+            orderbook_concurrency=orderbook_concurrency
+        )
+        super().__init__(token, api, 'polymarket', results_limit=50, cache_ttl=cache_ttl,
+                         refresh_interval=refresh_interval, full_refresh_every=full_refresh_every, **options)
 
     def register_handlers(self):
         """Регистрируем все обработчики команд"""
@@ -400,6 +645,8 @@ class PolymarketBot:
                 "/search - Начать поиск по фильтрам\n"
                 "/current_filters - Показать текущие фильтры\n"
                 "/clear_filters - Сбросить фильтры\n"
+                "/slippage - Фильтр по проскальзыванию для суммы сделки\n"
+                "/compact - Компактный или подробный вид результатов\n"
                 "/help - Показать справка\n\n"
                 "Для начала настройте фильтры с помощью /filters"
             )
@@ -413,6 +660,8 @@ class PolymarketBot:
                 "/search - Начать поиск по фильтрам\n"
                 "/current_filters - Показать текущие фильтры\n"
                 "/clear_filters - Сбросить фильтры\n"
+                "/slippage - Фильтр по проскальзыванию для суммы сделки\n"
+                "/compact - Компактный или подробный вид результатов\n"
                 "/help - Эта справка\n\n"
                 "📝 Форматы ввода фильтров:\n\n"
                 "⏰ Время до окончания (в часах):\n"
@@ -432,6 +681,10 @@ class PolymarketBot:
                 "• '10000+' - ликвидность от $10K и выше\n"
                 "• '10000-' - ликвидность до $10K\n"
                 "• '5000' - ликвидность около $5K (±20%)\n\n"
+                "🌊 Проскальзывание (необязательно, по живым стаканам):\n"
+                "• '/slippage 500 2' - купить на $500 со средней ценой не хуже лучшего ask + 2¢\n"
+                "• '/slippage off' - отключить фильтр\n"
+                "Результаты сортируются по проскальзыванию.\n\n"
                 "🔍 Поиск может занять некоторое время, так как я анализирую все активные рынки."
             )
             await message.answer(help_text)
@@ -439,6 +692,7 @@ class PolymarketBot:
         @self.dp.message(Command("filters"))
         async def cmd_filters(message: types.Message, state: FSMContext):
             """Начинаем процесс настройки фильтров"""
+            self.compiled_filters.pop(message.from_user.id, None)
             await state.set_state(FilterStates.waiting_for_time_filter)
 
             keyboard = ReplyKeyboardMarkup(
@@ -670,6 +924,7 @@ class PolymarketBot:
                 await state.clear()
 
                 filters = self.user_filters[user_id]
+                self.compiled_filters[user_id] = MarketFilters.compile_filters(filters)
                 await message.answer(
                     "🎉 Все фильтры успешно сохранены!\n\n"
                     f"📊 Ваши фильтры:\n"
@@ -748,6 +1003,7 @@ class PolymarketBot:
             await state.clear()
 
             filters = self.user_filters[user_id]
+            self.compiled_filters[user_id] = MarketFilters.compile_filters(filters)
             liquidity_filter = filters.get('liquidity', 'без фильтра')
 
             await message.answer(
@@ -789,6 +1045,10 @@ class PolymarketBot:
             else:
                 response += f"💵 Ликвидность: {liquidity_filter}\n"
 
+            if filters.get('slippage'):
+                notional, max_slippage = MarketFilters.parse_slippage_filter(filters['slippage'])
+                response += f"🌊 Проскальзывание: до {max_slippage:g}¢ на ${notional:g}\n"
+
             # Проверяем, все ли обязательные фильтры заданы
             required_filters = ['time', 'spread', 'price']
             missing_filters = []
@@ -808,16 +1068,56 @@ class PolymarketBot:
 
             await message.answer(response)
 
+        @self.dp.message(Command("slippage"))
+        async def cmd_slippage(message: types.Message):
+            """Настраиваем фильтр проскальзывания для суммы сделки"""
+            user_id = message.from_user.id
+            args = (message.text or '').split()[1:]
+
+            if len(args) == 1 and args[0].lower() in ('off', 'выкл'):
+                self.user_filters.setdefault(user_id, {}).pop('slippage', None)
+                self.compiled_filters.pop(user_id, None)
+                await message.answer("✅ Фильтр проскальзывания отключен.")
+                return
+
+            try:
+                if len(args) != 2:
+                    raise ValueError("Нужно два числа")
+
+                notional = float(args[0])
+                max_slippage = float(args[1])
+
+                if notional <= 0 or max_slippage < 0:
+                    raise ValueError("Неверные значения")
+
+            except ValueError:
+                await message.answer(
+                    "❌ Неверный формат. Используйте: /slippage <сумма в $> <макс. проскальзывание в центах>\n"
+                    "Пример: '/slippage 500 2' или '/slippage off'"
+                )
+                return
+
+            self.user_filters.setdefault(user_id, {})['slippage'] = f"{notional:g}:{max_slippage:g}"
+            self.compiled_filters.pop(user_id, None)
+            await message.answer(
+                f"✅ Фильтр проскальзывания сохранен: покупка на ${notional:g} "
+                f"не дороже лучшего ask + {max_slippage:g}¢.\n"
+                "Результаты поиска будут отсортированы по проскальзыванию."
+            )
+
         @self.dp.message(Command("clear_filters"))
         async def cmd_clear_filters(message: types.Message):
             """Сбрасываем фильтры пользователя"""
             user_id = message.from_user.id
             if user_id in self.user_filters:
                 self.user_filters[user_id] = {}
+                self.compiled_filters.pop(user_id, None)
                 await message.answer("✅ Все фильтры успешно сброшены.")
             else:
                 await message.answer("ℹ️ У вас нет сохраненных фильтров.")
 
+        self._register_result_handlers()
+
         @self.dp.message(Command("search"))
         async def cmd_search(message: types.Message):
             """Начинаем поиск по фильтрам"""
@@ -857,12 +1157,14 @@ class PolymarketBot:
             else:
                 filters_text += "💵 Ликвидность: без фильтра\n"
 
-            filters_text += "\nПоиск может занять до 30 секунд..."
+            if filters.get('slippage'):
+                notional, max_slippage = MarketFilters.parse_slippage_filter(filters['slippage'])
+                filters_text += f"🌊 Проскальзывание: до {max_slippage:g}¢ на ${notional:g}\n"
 
-            await message.answer(filters_text)
+            filters_text += "\nПоиск может занять до 30 секунд...\n\n"
 
-            # Запускаем поиск
-            await self.perform_search(message, filters)
+            # Запускаем поиск; о фильтрах и ходе поиска сообщает одно сообщение
+            await self.perform_search(message, filters, intro=filters_text)
 
         @self.dp.message(F.text.lower() == "отмена")
         async def cancel_handler(message: types.Message, state: FSMContext):
@@ -881,238 +1183,222 @@ class PolymarketBot:
                 "Я не понимаю эту команду. Используйте /help для просмотра доступных команд."
             )
 
-    async def perform_search(self, message: types.Message, filters: dict):
-        """Выполняет поиск рынков по фильтрам"""
-        try:
-            # Шаг 1: Получаем все рынки
-            status_msg = await message.answer("1️⃣ Получаю список всех активных рынков...")
-            all_markets = await self.api.fetch_all_markets()
+    def _compile_filters(self, filters: Dict) -> Dict[str, Any]:
+        """Один раз разбирает строки фильтров пользователя в диапазоны"""
+        return MarketFilters.compile_filters(filters)
 
-            if not all_markets:
-                await status_msg.edit_text("❌ Не удалось получить список рынков. Попробуйте позже.")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
+    @staticmethod
+    def _slippage_key(market: Dict) -> float:
+        """Ключ сортировки по проскальзыванию покупки на заданный объем.
 
-            total_markets = len(all_markets)
-            await status_msg.edit_text(f"✅ Найдено {total_markets} активных рынков")
+        Рынки, стаканы которых не проверялись (сверх live_markets_limit), идут после
+        проверенных по времени окончания: timestamp больше любого проскальзывания в центах.
+        """
+        if 'slippageBuy' in market:
+            return market['slippageBuy']
+        return MarketBot._close_key(market)
 
-            # Шаг 2: Фильтруем по времени
-            status_msg = await message.answer("2️⃣ Фильтрую по времени окончания...")
-            time_filtered = MarketFilters.filter_by_time_range(
-                all_markets,
-                filters['time']
-            )
+    def _filter_stages(self, table: MarketTable, compiled: Dict[str, Any]) -> List[Tuple[str, np.ndarray]]:
+        """Маски этапов после фильтра времени (для пачки фильтров - формы (F, N))"""
+        stages = []
 
-            if not time_filtered:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр времени")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
+        # Живой спред проверяется позже, одним пакетом стаканов для всех выживших рынков
+        if not self.live_spread:
+            stages.append(('spread', MarketFilters.spread_mask(table, compiled['spread'])))
 
-            time_filtered_count = len(time_filtered)
-            await status_msg.edit_text(f"✅ Осталось {time_filtered_count} рынков после фильтрации по времени")
+        stages.append(('price', MarketFilters.combined_price_mask(table, compiled['price'])))
 
-            # Шаг 3: Фильтруем по спреду
-            status_msg = await message.answer("3️⃣ Фильтрую по спреду...")
-            spread_filtered = MarketFilters.filter_by_spread(
-                time_filtered,
-                filters['spread']
-            )
+        if compiled['liquidity'] is not None:
+            stages.append(('liquidity', MarketFilters.liquidity_mask(table, compiled['liquidity'])))
 
-            if not spread_filtered:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр спреда")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
+        return stages
+
+    def _filter_live(self, markets: List[Dict], compiled: Dict[str, Any], counts: Dict[str, int]) -> List[Dict]:
+        """Проверяет живой спред и проскальзывание за один проход по рынкам со стаканами"""
+        min_spread, max_spread = compiled['spread']
+        max_slippage = compiled['slippage'][1] if compiled['slippage'] else None
 
-            spread_filtered_count = len(spread_filtered)
-            await status_msg.edit_text(f"✅ Осталось {spread_filtered_count} рынков после фильтрации по спреду")
+        final_markets = []
+        for market in markets:
+            if self.live_spread:
+                # Спред в API в долях, фильтр - в процентах
+                spread = market.get('spread')
+                if spread is None or not min_spread <= spread * 100 <= max_spread:
+                    continue
+                counts['spread'] += 1
 
-            # Шаг 4: Фильтруем по цене
-            status_msg = await message.answer("4️⃣ Фильтрую по цене...")
-            final_markets = MarketFilters.filter_by_combined_price(
-                spread_filtered,
-                filters['price']
+            if max_slippage is not None:
+                # Проверенные рынки без стакана или с недостаточной глубиной имеют проскальзывание inf;
+                # рынки сверх live_markets_limit стаканы не запрашивали, и они проходят без проверки
+                if market.get('slippageBuy', 0.0) > max_slippage:
+                    continue
+                counts['slippage'] += 1
+
+            final_markets.append(market)
+
+        return final_markets
+
+    async def _search(self, message: types.Message, filters: dict, progress: ProgressMessage, intro: str):
+        """Поиск с проверкой живых стаканов для рынков, прошедших фильтры снимка"""
+        # Шаг 1: Получаем рынки и фильтруем их постранично, по мере загрузки
+        await progress.start(intro + "1️⃣ Получаю список активных рынков и фильтрую их по мере загрузки...")
+
+        compiled = self._get_compiled_filters(message.from_user.id, filters)
+        # Живые стаканы ниже запрашиваются заново и для готового результата из result_cache
+        final_markets, counts = await self._collect_matches(compiled, progress)
+
+        total_markets = counts['total']
+        if not total_markets:
+            await progress.finish(f"❌ Не удалось получить список рынков. Попробуйте позже.\n\n{SEARCH_AGAIN_TEXT}")
+            return
+
+        # Шаг 2: Проверяем спред и проскальзывание по живым стаканам для оставшихся рынков
+        slippage_filter = compiled['slippage']
+        notional, max_slippage = slippage_filter if slippage_filter else (None, None)
+
+        live_capped = False
+        if (self.live_spread or notional) and final_markets:
+            live_candidates, other_markets = final_markets, []
+            if len(final_markets) > self.live_markets_limit:
+                # Стаканы запрашиваются только для ближайших к окончанию рынков,
+                # остальные остаются на данных gamma API
+                nearest = TopK(self.live_markets_limit, self._close_key)
+                nearest.push(final_markets)
+                live_candidates = nearest.result()
+                chosen = {id(market) for market in live_candidates}
+                other_markets = [market for market in final_markets if id(market) not in chosen]
+                live_capped = True
+
+            progress.update(
+                f"📡 Проверяю живые стаканы для {len(live_candidates)} рынков..."
+            )
+            final_markets = await self.api.apply_orderbook_metrics(
+                live_candidates,
+                live_spread=self.live_spread,
+                notional=notional
+            ) + other_markets
+
+            final_markets = self._filter_live(final_markets, compiled, counts)
+
+        # Лучшие по исполнению рынки (если задан объем) или ближайшие к окончанию - первыми
+        top_markets = TopK(self.results_limit, self._slippage_key if notional else self._close_key)
+        top_markets.push(final_markets)
+
+        checked_text = self._checked_text(total_markets)
+
+        # Шаг 3: Сообщаем, на каком этапе не осталось рынков (в порядке применения фильтров)
+        stages = [('time', "⏰ После фильтра времени", "❌ Нет рынков, подходящих под фильтр времени")]
+        spread_stage = ('spread', "📈 После фильтра спреда", "❌ Нет рынков, подходящих под фильтр спреда")
+        if not self.live_spread:
+            stages.append(spread_stage)
+        stages.append(('price', "💰 После фильтра цены", "❌ Нет рынков, подходящих под фильтр цены"))
+        if compiled['liquidity'] is not None:
+            stages.append(
+                ('liquidity', "💵 После фильтра ликвидности", "❌ Нет рынков, подходящих под фильтр ликвидности")
+            )
+        if self.live_spread:
+            stages.append(spread_stage)
+        if slippage_filter:
+            stages.append(
+                ('slippage', "🌊 После фильтра проскальзывания", "❌ Нет рынков с достаточной глубиной стакана")
             )
 
-            if not final_markets:
-                await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр цены")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
+        for stage, _, stage_message in stages:
+            if counts[stage] == 0:
+                await progress.finish(f"{checked_text}\n{stage_message}\n\n{SEARCH_AGAIN_TEXT}")
                 return
 
-            price_filtered_count = len(final_markets)
-            await status_msg.edit_text(f"✅ Осталось {price_filtered_count} рынков после фильтрации по цене")
-
-            # Шаг 5: Фильтруем по ликвидности (если задан фильтр)
-            if 'liquidity' in filters and filters['liquidity'] is not None:
-                status_msg = await message.answer("5️⃣ Фильтрую по ликвидности...")
-                liquidity_filtered = MarketFilters.filter_by_liquidity(
-                    final_markets,
-                    filters['liquidity']
-                )
-
-                if not liquidity_filtered:
-                    await status_msg.edit_text("❌ Нет рынков, подходящих под фильтр ликвидности")
-                    await message.answer(
-                        "🔍 Хотите найти другие рынки?\n"
-                        "Используйте /filters для изменения критериев поиска\n"
-                        "Используйте /search для повторного поиска с текущими фильтрами"
-                    )
-                    return
-
-                final_markets = liquidity_filtered
+        final_count = len(final_markets)
 
-            final_count = len(final_markets)
-
-            if 'liquidity' in filters and filters['liquidity'] is not None:
-                await status_msg.edit_text(f"✅ Осталось {final_count} рынков после фильтрации по ликвидности")
-            else:
-                await status_msg.edit_text(f"✅ Итоговых результатов: {final_count}")
+        # Итог и воронка - в том же сообщении о прогрессе
+        summary_text = (
+            f"{checked_text}\n✅ Итоговых результатов: {final_count}\n\n"
+            f"📊 Результаты поиска:\n"
+            f"🔍 Всего проверено: {total_markets} рынков\n"
+        )
+        for stage, label, _ in stages:
+            summary_text += f"{label}: {counts[stage]}\n"
 
-            # Шаг 6: Выводим результаты
-            if final_count == 0:
-                await message.answer("😔 Не найдено рынков, соответствующих всем вашим критериям.")
-                await message.answer(
-                    "🔍 Хотите найти другие рынки?\n"
-                    "Используйте /filters для изменения критериев поиска\n"
-                    "Используйте /search для повторного поиска с текущими фильтрами"
-                )
-                return
+        spread_source = "живые стаканы" if self.live_spread else "данные рынков"
+        summary_text += (
+            f"\n📋 Ваши фильтры:\n"
+            f"⏰ Время: {filters['time']} часов\n"
+            f"📈 Спред: {filters['spread']}% ({spread_source})\n"
+            f"💰 Цена: {filters['price']} центов\n"
+        )
 
-            # Отправляем сводку
-            summary_text = (
-                f"📊 Результаты поиска:\n"
-                f"🔍 Всего проверено: {total_markets} рынков\n"
-                f"⏰ После фильтра времени: {time_filtered_count}\n"
-                f"📈 После фильтра спреда: {spread_filtered_count}\n"
-                f"💰 После фильтра цены: {price_filtered_count}\n"
-            )
+        if 'liquidity' in filters and filters['liquidity'] is not None:
+            summary_text += f"💵 Ликвидность: {filters['liquidity']}\n"
 
-            if 'liquidity' in filters and filters['liquidity'] is not None:
-                summary_text += f"💵 После фильтра ликвидности: {final_count}\n"
-            else:
-                summary_text += f"✅ Итоговых результатов: {final_count}\n"
+        if slippage_filter:
+            summary_text += f"🌊 Проскальзывание: до {max_slippage:g}¢ на ${notional:g}\n"
 
+        if live_capped:
             summary_text += (
-                f"\n📋 Ваши фильтры:\n"
-                f"⏰ Время: {filters['time']} часов\n"
-                f"📈 Спред: {filters['spread']}%\n"
-                f"💰 Цена: {filters['price']} центов\n"
+                f"📡 Живые стаканы запрошены только для {self.live_markets_limit} "
+                f"ближайших к окончанию рынков\n"
             )
 
-            if 'liquidity' in filters and filters['liquidity'] is not None:
-                summary_text += f"💵 Ликвидность: {filters['liquidity']}\n"
-
-            summary_text += f"\nВот лучшие результаты (макс. 50 пока):"
-
-            await message.answer(summary_text)
+        summary_text += f"\n{SEARCH_AGAIN_TEXT}\n\nВот лучшие результаты:"
 
-            # Выводим результаты (максимум 10)
-            for i, market in enumerate(final_markets[:50]):
-                await self.send_market_info_simple(message, market, i + 1)
-                await asyncio.sleep(0.3)  # Чтобы не превысить лимиты Telegram
+        await progress.finish(summary_text)
 
-            if final_count > 50:
-                await message.answer(f"\n📈 ... и еще {final_count - 50} рынков не показаны.")
-
-            # Предложение изменить фильтры
-            await message.answer(
-                "🔍 Хотите найти другие рынки?\n"
-                "Используйте /filters для изменения критериев поиска\n"
-                "Используйте /search для повторного поиска с текущими фильтрами"
-            )
-
-        except Exception as e:
-            logger.error(f"Search error: {e}", exc_info=True)
-            await message.answer(
-                f"❌ Произошла ошибка при поиске:\n\n"
-                f"Ошибка: {str(e)}\n\n"
-                f"Пожалуйста, попробуйте позже или измените фильтры."
-            )
+        # Выводим результаты постранично: одно сообщение с кнопками листания
+        await self.send_result_pages(message, final_markets, top_markets.result(), top_markets.key)
 
-    async def send_market_info_simple(self, message: types.Message, market: Dict, index: int):
-        """Отправляет упрощенную информацию о рынке"""
+    def format_market_card(self, market: Dict, index: int, detailed: bool = True) -> str:
+        """Форматирует карточку рынка: подробную или компактную, в несколько строк"""
         try:
             # Получаем основные данные
             question = market.get('question', 'Без названия')
             market_id = market.get('id', 'N/A')
             slug = market["events"][0]["slug"]
 
-            # Получаем цены YES/NO
-            yes_price = None
-            no_price = None
-            try:
-                outcome_prices_str = market.get('outcomePrices', '[]')
-                if outcome_prices_str.startswith('"') and outcome_prices_str.endswith('"'):
-                    outcome_prices_str = outcome_prices_str[1:-1]
-                outcome_prices_str = outcome_prices_str.replace('\\"', '"')
-                outcome_prices = json.loads(outcome_prices_str)
-
-                if len(outcome_prices) >= 2:
-                    yes_price = float(outcome_prices[0])
-                    no_price = float(outcome_prices[1])
-            except Exception as e:
-                logger.debug(f"Error parsing prices: {e}")
-                yes_price = None
-                no_price = None
-
-            # Получаем лучшие bid/ask и спред
+            # Цены YES/NO (декодированы при загрузке)
+            yes_price = market.get('yes_price')
+            no_price = market.get('no_price')
+
+            # Лучшие bid/ask, спред, ликвидность и объем уже числа (normalize_market)
             best_bid = market.get('bestBid')
             best_ask = market.get('bestAsk')
             spread = market.get('spread')
             last_trade = market.get('lastTradePrice')
-
-            # Получаем ликвидность
-            liquidity = market.get('liquidity')
-            liquidity_num = None
-            if liquidity:
-                try:
-                    liquidity_num = float(liquidity)
-                except:
-                    pass
+            liquidity_num = market.get('liquidity')
+            volume_24h = market.get('volume24hr')
 
             # Время окончания
             time_left_str = 'N/A'
-            end_date = market.get('endDate')
-            if end_date:
-                try:
-                    market_end = self.api.parse_end_time(end_date)
-                    if market_end:
-                        now = datetime.utcnow().replace(tzinfo=None)
-                        market_end_utc = market_end.replace(tzinfo=None)
-                        time_left = market_end_utc - now
-
-                        if time_left.total_seconds() > 0:
-                            hours_left = int(time_left.total_seconds() / 3600)
-                            days_left = hours_left // 24
-                            remaining_hours = hours_left % 24
-
-                            if days_left > 0:
-                                time_left_str = f"{days_left}д {remaining_hours}ч"
-                            else:
-                                time_left_str = f"{hours_left}ч"
-                        else:
-                            time_left_str = "Завершено"
-                except Exception as e:
-                    logger.debug(f"Error parsing end date: {e}")
-                    pass
-
-            # Объем
-            volume_24h = market.get('volume24hr')
+            close_ts = market.get('close_ts')
+            if close_ts is not None:
+                seconds_left = close_ts - time.time()
+
+                if seconds_left > 0:
+                    hours_left = int(seconds_left / 3600)
+                    days_left = hours_left // 24
+                    remaining_hours = hours_left % 24
+
+                    if days_left > 0:
+                        time_left_str = f"{days_left}д {remaining_hours}ч"
+                    else:
+                        time_left_str = f"{hours_left}ч"
+                else:
+                    time_left_str = "Завершено"
+
+            if not detailed:
+                prices = []
+                if yes_price is not None:
+                    prices.append(f"✅ {yes_price * 100:.1f}¢")
+                if no_price is not None:
+                    prices.append(f"❌ {no_price * 100:.1f}¢")
+                if spread:
+                    prices.append(f"📈 {spread * 100:.2f}¢")
+                if market.get('slippageNotional') and market.get('slippageBuy', float('inf')) != float('inf'):
+                    prices.append(f"🌊 {market['slippageBuy']:.2f}¢")
+
+                response = f"📊 #{index} {question}\n⏰ {time_left_str} | {' | '.join(prices)}"
+                if slug:
+                    response += f"\n🔗 https://polymarket.com/event/{slug}"
+                return response
 
             # Формируем сообщение
             response = f"📊 Рынок #{index}\n"
@@ -1134,32 +1420,27 @@ class PolymarketBot:
                 response += "\n📊 Торговая информация:\n"
 
                 if best_bid:
-                    try:
-                        bid_value = float(best_bid)
-                        response += f"  🔺 Лучший bid: {bid_value:.3f} ({bid_value * 100:.1f}¢)\n"
-                    except:
-                        pass
+                    response += f"  🔺 Лучший bid: {best_bid:.3f} ({best_bid * 100:.1f}¢)\n"
 
                 if best_ask:
-                    try:
-                        ask_value = float(best_ask)
-                        response += f"  🔻 Лучший ask: {ask_value:.3f} ({ask_value * 100:.1f}¢)\n"
-                    except:
-                        pass
+                    response += f"  🔻 Лучший ask: {best_ask:.3f} ({best_ask * 100:.1f}¢)\n"
 
                 if spread:
-                    try:
-                        spread_value = float(spread) * 100
-                        response += f"  📈 Спред: {spread_value:.2f}¢\n"
-                    except:
-                        pass
+                    response += f"  📈 Спред: {spread * 100:.2f}¢\n"
 
                 if last_trade:
-                    try:
-                        trade_value = float(last_trade)
-                        response += f"  💱 Последняя сделка: {trade_value:.3f} ({trade_value * 100:.1f}¢)\n"
-                    except:
-                        pass
+                    response += f"  💱 Последняя сделка: {last_trade:.3f} ({last_trade * 100:.1f}¢)\n"
+
+            # Исполнение на заданную сумму по живому стакану
+            if market.get('slippageNotional'):
+                response += f"\n🌊 Исполнение на ${market['slippageNotional']:g}:\n"
+                for side, label in (('Buy', 'Покупка'), ('Sell', 'Продажа')):
+                    side_slippage = market.get(f'slippage{side}', float('inf'))
+                    if side_slippage == float('inf'):
+                        response += f"  {label}: недостаточно глубины\n"
+                    else:
+                        fill_price = market[f'fillPrice{side}']
+                        response += f"  {label}: в среднем {fill_price * 100:.1f}¢, проскальзывание {side_slippage:.2f}¢\n"
 
             # Ликвидность и объем
             if liquidity_num or volume_24h:
@@ -1172,14 +1453,10 @@ class PolymarketBot:
                         response += f"  💧 Ликвидность: ${liquidity_num:,.2f}\n"
 
                 if volume_24h:
-                    try:
-                        volume_value = float(volume_24h)
-                        if volume_value >= 1000:
-                            response += f"  📊 24ч объем: ${volume_value:,.0f}\n"
-                        else:
-                            response += f"  📊 24ч объем: ${volume_value:,.2f}\n"
-                    except:
-                        pass
+                    if volume_24h >= 1000:
+                        response += f"  📊 24ч объем: ${volume_24h:,.0f}\n"
+                    else:
+                        response += f"  📊 24ч объем: ${volume_24h:,.2f}\n"
 
             # Ссылка
             if slug:
@@ -1187,10 +1464,10 @@ class PolymarketBot:
 
             response += "\n" + "─" * 40
 
-            await message.answer(response)
+            return response
 
         except Exception as e:
-            logger.error(f"Error sending market info #{index}: {e}", exc_info=True)
+            logger.error(f"Error formatting market info #{index}: {e}", exc_info=True)
             # Минимальная информация
             try:
                 basic_info = (
@@ -1203,15 +1480,10 @@ class PolymarketBot:
                 if slug:
                     basic_info += f"\n🔗 https://polymarket.com/event/{slug}"
 
-                await message.answer(basic_info)
+                return basic_info
             except Exception as e2:
-                logger.error(f"Error sending minimal info: {e2}")
-                await message.answer(f"⚠️ Ошибка при отображении рынка #{index}")
-
-    async def run(self):
-        """Запускает бота"""
-        logger.info("Starting Polymarket Bot...")
-        await self.dp.start_polling(self.bot)
+                logger.error(f"Error formatting minimal info: {e2}")
+                return f"⚠️ Ошибка при отображении рынка #{index}"
 
 
 # Точка входа
@@ -1236,8 +1508,56 @@ if __name__ == "__main__":
         print("  2. Или запустите: python main.py ваш_токен")
         sys.exit(1)
 
+    # TTL общего снимка рынков в секундах
+    cache_ttl = float(os.getenv('CACHE_TTL', '60'))
+
+    # Период фонового обновления каталога в секундах
+    refresh_interval = float(os.getenv('REFRESH_INTERVAL', '45'))
+
+    # Каждое N-е обновление полное, остальные инкрементальные
+    full_refresh_every = int(os.getenv('FULL_REFRESH_EVERY', '10'))
+
+    # Сколько страниц рынков запрашивать одновременно
+    page_concurrency = int(os.getenv('PAGE_CONCURRENCY', '8'))
+
+    # Размер пула HTTP-соединений к API площадки
+    connection_limit = int(os.getenv('HTTP_CONNECTION_LIMIT', '20'))
+
+    # Проверять спред по живым стаканам CLOB и сколько групп стаканов запрашивать одновременно
+    live_spread = os.getenv('LIVE_SPREAD', '1') not in ('0', 'false', 'no')
+    orderbook_concurrency = int(os.getenv('ORDERBOOK_CONCURRENCY', '4'))
+
+    # Сколько рынков за поиск проверять по живым стаканам
+    live_markets_limit = int(os.getenv('LIVE_MARKETS_LIMIT', '400'))
+
+    # Вебхук вместо long polling: публичный URL, путь и адрес встроенного сервера
+    webhook_url = os.getenv('WEBHOOK_URL') or None
+    webhook_path = os.getenv('WEBHOOK_PATH', '/webhook')
+    webhook_host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    webhook_port = int(os.getenv('WEBHOOK_PORT', '8080'))
+    webhook_secret = os.getenv('WEBHOOK_SECRET') or None
+
+    # Альтернативный сервер Bot API (локальный или тестовый)
+    api_server = os.getenv('TELEGRAM_API_URL') or None
+
     # Создаем и запускаем бота
-    bot = PolymarketBot(bot_token)
+    bot = PolymarketBot(
+        bot_token,
+        cache_ttl=cache_ttl,
+        refresh_interval=refresh_interval,
+        full_refresh_every=full_refresh_every,
+        page_concurrency=page_concurrency,
+        connection_limit=connection_limit,
+        live_spread=live_spread,
+        orderbook_concurrency=orderbook_concurrency,
+        live_markets_limit=live_markets_limit,
+        webhook_url=webhook_url,
+        webhook_path=webhook_path,
+        webhook_host=webhook_host,
+        webhook_port=webhook_port,
+        webhook_secret=webhook_secret,
+        api_server=api_server
+    )
 
     try:
         # Запуск бота
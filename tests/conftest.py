@@ -0,0 +1,100 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Боты и core.py лежат в корне репозитория, а не в пакете
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core
+from core import MarketTable, RangeFilter
+
+NOW = 1_700_000_000.0
+
+
+@pytest.fixture
+def frozen_time(monkeypatch):
+    """Фильтр времени считается от time.time(): фиксируем его, чтобы границы совпадали"""
+    monkeypatch.setattr(core.time, 'time', lambda: NOW)
+    return NOW
+
+
+def close_timestamps(rng, n, horizon_hours=200):
+    """Времена окончания от 5 часов назад до horizon_hours вперед, около 5% неизвестны"""
+    close = NOW + rng.uniform(-3600 * 5, 3600 * horizon_hours, n)
+    return [None if rng.random() < 0.05 else float(ts) for ts in close]
+
+
+def random_markets(rng, n):
+    """Рынки с колонками тестовой таблицы build_table()"""
+    return [
+        {'id': i, 'close_ts': ts, 'liquidity': float(rng.uniform(0, 1e4)), 'price': float(rng.uniform(0, 100))}
+        for i, ts in enumerate(close_timestamps(rng, n, horizon_hours=300))
+    ]
+
+
+def build_table(markets):
+    def column(field):
+        return np.array([m[field] if m[field] is not None else np.nan for m in markets], dtype=float)
+    return MarketTable(markets, {
+        'close_ts': column('close_ts'),
+        'liquidity': column('liquidity'),
+        'price': column('price'),
+    })
+
+
+def stages_for(compiled):
+    """Этапы тестовой таблицы после фильтра времени, как _filter_stages у ботов"""
+    return lambda table: [
+        ('liquidity', compiled['liquidity'].mask(table['liquidity'])),
+        ('price', compiled['price'].mask(table['price'])),
+    ]
+
+
+def random_filters(rng):
+    low = float(rng.uniform(-10, 250))
+    liquidity_low = float(rng.uniform(0, 1e4))
+    price_low = float(rng.uniform(0, 100))
+    return {
+        'time': RangeFilter(low, low + float(rng.uniform(1, 400))),
+        'liquidity': RangeFilter(liquidity_low, liquidity_low + float(rng.uniform(0, 1e4))),
+        'price': RangeFilter(price_low, price_low + float(rng.uniform(0, 100))),
+    }
+
+
+def naive_filter(markets, stages):
+    """Проход по рынкам с проверкой этапов по очереди, как до перехода на маски.
+
+    stages - пары (этап, проверка(часы до окончания, рынок)), первым идет время.
+    Возвращает рынки по возрастанию времени окончания и воронку.
+    """
+    counts = {'total': 0}
+    counts.update((name, 0) for name, _ in stages)
+    result = []
+    for market in markets:
+        counts['total'] += 1
+        if market['close_ts'] is None:
+            continue
+        hours_left = (market['close_ts'] - NOW) / 3600
+        for name, check in stages:
+            if not check(hours_left, market):
+                break
+            counts[name] += 1
+        else:
+            result.append(market)
+    result.sort(key=lambda m: m['close_ts'])
+    return result, counts
+
+
+def naive_search(markets, compiled):
+    """naive_filter() с этапами тестовой таблицы"""
+    return naive_filter(markets, [
+        ('time', lambda hours, m: compiled['time'].contains(hours)),
+        ('liquidity', lambda _, m: compiled['liquidity'].contains(m['liquidity'])),
+        ('price', lambda _, m: compiled['price'].contains(m['price'])),
+    ])
+
+
+def ids(markets):
+    return [market['id'] for market in markets]
@@ -0,0 +1,301 @@
+import asyncio
+
+import numpy as np
+import pytest
+from aiogram import methods, types
+from aiohttp.test_utils import TestClient, TestServer
+
+import kalsh
+import opin
+import poly
+from conftest import NOW, close_timestamps, ids, naive_filter
+
+
+def test_opinion_page_error_keeps_known_pages():
+    api = opin.OpinionAPI(page_concurrency=2, requests_per_second=0)
+    failing_page = None
+
+    async def get_session():
+        return None
+
+    async def fetch_events_page(session, page, limit):
+        if page == failing_page:
+            return None
+        if page > 3:
+            return []
+        return [{'topicId': page * 100 + i, 'title': 'Event'} for i in range(limit)]
+
+    api.get_session = get_session
+    api._fetch_events_page = fetch_events_page
+
+    async def load():
+        return [market async for page in api.iter_market_pages() for market in page]
+
+    assert len(asyncio.run(load())) == 3 * api.page_limit
+    assert api._known_pages == 3
+
+    failing_page = 2
+    with pytest.raises(RuntimeError):
+        asyncio.run(load())
+    assert api._known_pages == 3
+
+
+def test_polymarket_window_error_keeps_known_pages():
+    api = poly.PolymarketAPI(page_concurrency=2)
+    failing_offset = None
+
+    async def get_session():
+        return None
+
+    async def fetch_markets_page(session, offset, limit):
+        if offset == failing_offset:
+            return None, 0.0
+        if offset >= 3 * limit:
+            return [], 0.0
+        return [{'id': f"{offset}:{i}"} for i in range(limit)], 0.0
+
+    api.get_session = get_session
+    api._fetch_markets_page = fetch_markets_page
+
+    async def load():
+        return [market async for page in api.iter_market_pages() for market in page]
+
+    assert len(asyncio.run(load())) == 3 * api.page_limit
+    assert api._known_pages == 3
+
+    failing_offset = api.page_limit
+    with pytest.raises(RuntimeError):
+        asyncio.run(load())
+    assert api._known_pages == 3
+
+
+def test_opinion_child_markets_get_unique_keys():
+    api = opin.OpinionAPI()
+    events = [
+        {'topicId': 10, 'title': 'Event', 'childList': [{'title': 'a'}, {'title': 'b', 'topicId': 77}, {'title': 'c'}]},
+        {'title': 'No id', 'childList': [{'title': 'x'}]},
+        {'topicId': 11, 'title': 'Single'},
+    ]
+    assert ids(api._ingest_events(events)) == ['10:0', 77, '10:2', 11]
+
+
+def test_polymarket_slippage_filter_skips_markets_past_live_cap(frozen_time):
+    api = poly.PolymarketAPI()
+    deep = {'asks': [{'price': '0.50', 'size': '1000'}], 'bids': [{'price': '0.48', 'size': '1000'}]}
+
+    async def fetch_orderbooks(token_ids):
+        # Для токена 'missing' стакан не получен
+        return {token: deep for token in token_ids if token != 'missing'}
+
+    api.fetch_orderbooks = fetch_orderbooks
+    booked = [
+        {'id': 'deep', 'clobTokenIds': ['deep'], 'close_ts': NOW + 7200, 'spread': 0.02},
+        {'id': 'missing', 'clobTokenIds': ['missing'], 'close_ts': NOW + 3600, 'spread': 0.02},
+    ]
+    # Рынки сверх live_markets_limit стаканы не запрашивают
+    unbooked = [
+        {'id': 'late', 'close_ts': NOW + 9000, 'spread': 0.02},
+        {'id': 'later', 'close_ts': NOW + 8000, 'spread': 0.02},
+    ]
+    live = asyncio.run(api.apply_orderbook_metrics(booked, live_spread=False, notional=10.0))
+    assert live[1]['slippageBuy'] == float('inf')
+
+    bot = poly.PolymarketBot.__new__(poly.PolymarketBot)
+    bot.live_spread = False
+    compiled = bot._compile_filters({'time': '0-100', 'spread': '0-4', 'price': '0-100', 'slippage': '10:1'})
+    counts = bot._new_counts()
+    found = bot._filter_live(live + unbooked, compiled, counts)
+    assert ids(found) == ['deep', 'late', 'later']
+    assert counts['slippage'] == 3
+
+    # Проверенные по стакану рынки - первыми, затем остальные по времени окончания
+    assert ids(sorted(found, key=bot._slippage_key)) == ['deep', 'later', 'late']
+
+
+def walk_book(levels, notional, buy):
+    """Исполнение суммы notional по уровням стакана от лучшей цены к худшей"""
+    levels = sorted(((float(l['price']), float(l['size'])) for l in levels), reverse=not buy)
+    if not levels:
+        return float('nan'), float('inf')
+    remaining, shares = notional, 0.0
+    for price, size in levels:
+        taken = min(remaining, price * size)
+        shares += taken / price if price > 0 else 0.0
+        remaining -= taken
+        if remaining <= 0:
+            break
+    filled = notional - remaining
+    average = filled / shares if shares > 0 else float('nan')
+    if filled < notional * (1 - 1e-9):
+        return average, float('inf')
+    best = levels[0][0]
+    return average, ((average - best) if buy else (best - average)) * 100
+
+
+@pytest.mark.parametrize('notional', [1.0, 50.0, 500.0])
+def test_polymarket_slippage_matches_level_walk(notional):
+    rng = np.random.default_rng(int(notional))
+    books = []
+    for _ in range(300):
+        book = {}
+        for side in ('bids', 'asks'):
+            book[side] = [
+                {'price': f"{rng.uniform(0.01, 0.99):.2f}", 'size': f"{rng.uniform(1, 200):.1f}"}
+                for _ in range(int(rng.integers(0, 8)))
+            ]
+        books.append(book)
+
+    metrics = poly.PolymarketAPI.calculate_slippage(books, notional)
+    for i, book in enumerate(books):
+        for side, buy, name in (('asks', True, 'buy'), ('bids', False, 'sell')):
+            price, slippage = walk_book(book[side], notional, buy)
+            np.testing.assert_allclose(metrics[f'{name}_slippage'][i], slippage, rtol=1e-9, atol=1e-9)
+            if not np.isinf(slippage):
+                np.testing.assert_allclose(metrics[f'{name}_price'][i], price, rtol=1e-9)
+
+
+def test_opinion_compiled_filters_match_naive_loop(frozen_time):
+    rng = np.random.default_rng(12)
+    markets = [
+        {'id': i, 'close_ts': ts, 'volume': float(rng.uniform(0, 1e4)),
+         'best_yes_price': float(rng.uniform(0, 100)), 'no_buy_price': float(rng.uniform(0, 100)),
+         'spread': float(rng.uniform(-5, 10))}
+        for i, ts in enumerate(close_timestamps(rng, 3000))
+    ]
+    filters = {'time': '0-72', 'volume': '>500', 'price': '20-40', 'spread': '<4'}
+    bot = opin.OpinionBot.__new__(opin.OpinionBot)
+    bot.api = opin.OpinionAPI()
+    compiled = bot._compile_filters(filters)
+
+    counts = bot._new_counts()
+    found = bot._filter_table(bot.build_market_table(markets), compiled, counts)
+
+    # Цена проходит, если в диапазоне цена YES или цена NO
+    expected, expected_counts = naive_filter(markets, [
+        ('time', lambda hours, m: compiled['time'].contains(hours)),
+        ('volume', lambda _, m: compiled['volume'].contains(m['volume'])),
+        ('price', lambda _, m: compiled['price'].contains(m['best_yes_price'])
+                               or compiled['price'].contains(m['no_buy_price'])),
+        ('spread', lambda _, m: compiled['spread'].contains(m['spread'])),
+    ])
+    assert expected
+    assert ids(found) == ids(expected)
+    assert counts == expected_counts
+    assert ids(bot.filter_markets(markets, filters)) == ids(expected)
+
+
+@pytest.mark.parametrize('filters', [
+    {'time': '0-48', 'liquidity': '>1000', 'price': '10-60', 'spread': '<5'},
+    {'time': '24-200', 'liquidity': '500-5000', 'price': '>50', 'spread': '0-3'},
+    {'time': '<12', 'liquidity': '2000+', 'price': '<30', 'spread': '2'},
+])
+def test_kalshi_compiled_filters_match_naive_loop(frozen_time, filters):
+    rng = np.random.default_rng(11)
+    markets = [
+        {'id': i, 'close_ts': ts, 'liquidity': float(rng.uniform(0, 1e4)),
+         'best_price': float(rng.uniform(0, 100)), 'spread': float(rng.integers(0, 10))}
+        for i, ts in enumerate(close_timestamps(rng, 3000))
+    ]
+    bot = kalsh.KalshiBot.__new__(kalsh.KalshiBot)
+    bot.api = kalsh.KalshiAPI()
+    compiled = bot._compile_filters(filters)
+
+    counts = bot._new_counts()
+    found = bot._filter_table(bot.build_market_table(markets), compiled, counts)
+
+    expected, expected_counts = naive_filter(markets, [
+        ('time', lambda hours, m: compiled['time'].contains(hours)),
+        ('liquidity', lambda _, m: compiled['liquidity'].contains(m['liquidity'])),
+        ('price', lambda _, m: compiled['price'].contains(m['best_price'])),
+        ('spread', lambda _, m: compiled['spread'].contains(m['spread'])),
+    ])
+    assert expected
+    assert ids(found) == ids(expected)
+    assert counts == expected_counts
+    assert ids(bot.filter_markets(markets, filters)) == ids(expected)
+
+
+@pytest.mark.parametrize('liquidity', ['1000+', '500-5000', None])
+def test_polymarket_compiled_filters_match_naive_loop(frozen_time, liquidity):
+    rng = np.random.default_rng(13)
+    markets = []
+    for i, ts in enumerate(close_timestamps(rng, 3000)):
+        yes = float(rng.uniform(0, 1))
+        markets.append({
+            'id': str(i), 'close_ts': ts, 'spread': float(rng.uniform(0, 0.1)),
+            'yes_price': yes, 'no_price': 1 - yes,
+            'liquidity': None if rng.random() < 0.1 else float(rng.uniform(0, 1e4)),
+        })
+    filters = {'time': '0-100', 'spread': '0-4', 'price': '10-30', 'liquidity': liquidity, 'slippage': None}
+    bot = poly.PolymarketBot.__new__(poly.PolymarketBot)
+    bot.api = poly.PolymarketAPI()
+    bot.live_spread = False
+    compiled = bot._compile_filters(filters)
+
+    counts = bot._new_counts()
+    found = bot._filter_table(bot.build_market_table(markets), compiled, counts)
+
+    stages = [
+        ('time', lambda hours, m: compiled['time'].contains(hours)),
+        # Спред в рынках в долях, в фильтре - в процентах; цены - в долларах
+        ('spread', lambda _, m: compiled['spread'].contains(m['spread'] * 100)),
+        ('price', lambda _, m: compiled['price'].contains(m['yes_price'])
+                               or compiled['price'].contains(m['no_price'])),
+    ]
+    if liquidity is not None:
+        stages.append(('liquidity', lambda _, m: m['liquidity'] is not None
+                                                 and compiled['liquidity'].contains(m['liquidity'])))
+    expected, expected_counts = naive_filter(markets, stages)
+
+    assert expected
+    assert ids(found) == ids(expected)
+    assert {name: counts[name] for name in expected_counts} == expected_counts
+
+
+def test_webhook_app_dispatches_update_to_handler():
+    sent = []
+
+    async def make_request(bot, method, timeout=None):
+        # Заглушка Bot API: запоминаем запрос и отвечаем как Telegram
+        sent.append(method)
+        return types.Message(
+            message_id=2, date=0, chat=types.Chat(id=method.chat_id, type='private'), text=method.text
+        )
+
+    update = {
+        'update_id': 1,
+        'message': {
+            'message_id': 1, 'date': 0, 'text': '/start',
+            'chat': {'id': 42, 'type': 'private'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'Test'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+    async def run():
+        bot = kalsh.KalshiBot('123456:TEST', webhook_url='https://example.com', webhook_secret='secret')
+        bot.bot.session.make_request = make_request
+        client = TestClient(TestServer(bot.build_webhook_app()))
+        await client.start_server()
+        try:
+            response = await client.post(bot.webhook_path, json=update)
+            assert response.status == 401
+
+            response = await client.post(
+                bot.webhook_path, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'}
+            )
+            assert response.status == 200
+            # Обновление обрабатывается в фоне после ответа на запрос вебхука
+            for _ in range(100):
+                if sent:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await client.close()
+            await bot.send_scheduler.stop()
+
+    asyncio.run(run())
+    assert len(sent) == 1
+    assert isinstance(sent[0], methods.SendMessage)
+    assert sent[0].chat_id == 42
+    assert "Kalshi Scanner Bot" in sent[0].text
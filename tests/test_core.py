@@ -0,0 +1,359 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+import core
+from core import (
+    MarketSnapshotCache, ProgressMessage, RangeFilter, ResultCursor, SearchResultCache, SendScheduler,
+    TokenBucket, TopK, telegram_length
+)
+from conftest import NOW, build_table, ids, naive_search, random_filters, random_markets, stages_for
+
+
+def test_failed_full_load_keeps_previous_snapshot():
+    pages = [[{'id': 1, 'close_ts': NOW, 'liquidity': 1.0, 'price': 1.0}],
+             [{'id': 2, 'close_ts': NOW, 'liquidity': 1.0, 'price': 1.0}]]
+    fail_after = None
+
+    async def page_source():
+        for number, page in enumerate(pages):
+            if number == fail_after:
+                raise RuntimeError("page failed")
+            yield page
+
+    async def scenario():
+        nonlocal fail_after
+        cache = MarketSnapshotCache(page_source, key_field='id', table_builder=build_table)
+        first = await cache.refresh()
+        fail_after = 1
+        assert await cache.refresh() is first
+        return cache, first
+
+    cache, first = asyncio.run(scenario())
+    assert cache.snapshot is first and cache.version == 1
+    assert ids(cache.snapshot.markets) == [1, 2]
+    assert cache._positions == {1: 0, 2: 1}
+
+
+def test_delta_merge_matches_full_rebuild():
+    rng = np.random.default_rng(5)
+    markets = random_markets(rng, 200)
+
+    async def no_pages():
+        return
+        yield
+
+    cache = MarketSnapshotCache(no_pages, key_field='id', table_builder=build_table)
+    cache._positions = {m['id']: i for i, m in enumerate(markets)}
+    cache._publish(list(markets), 0.0, 'full', len(markets))
+
+    changed = rng.choice(np.arange(1, 200), 30, replace=False)
+    updates = [dict(markets[i], price=float(rng.uniform(0, 100))) for i in changed]
+    updates += [dict(markets[0])]  # без изменений
+    updates += [{'id': 1000 + i, 'close_ts': NOW + 3600, 'liquidity': 1.0, 'price': 50.0} for i in range(5)]
+    snapshot = cache._publish_delta(updates, 0.0)
+
+    expected = {m['id']: m for m in markets}
+    expected.update((m['id'], m) for m in updates)
+    assert {m['id']: m for m in snapshot.markets} == expected
+    assert len(snapshot.markets) == len(expected)
+
+    rebuilt = build_table(snapshot.markets)
+    for name, values in rebuilt.columns.items():
+        np.testing.assert_array_equal(snapshot.table[name], values)
+    np.testing.assert_array_equal(snapshot.table.close_order, rebuilt.close_order)
+
+
+def test_range_filter_from_parsed_and_mask():
+    assert RangeFilter.from_parsed({'min': None, 'max': 5}) == RangeFilter(float('-inf'), 5)
+    assert RangeFilter.from_parsed({'min': 2, 'max': None}) == RangeFilter(2, float('inf'))
+
+    values = np.array([0.0, 1.0, 2.5, 4.0, np.nan, 9.0])
+    flt = RangeFilter(1.0, 4.0)
+    expected = [not np.isnan(v) and flt.contains(v) for v in values]
+    assert flt.mask(values).tolist() == expected
+
+
+def test_search_matches_naive_loop(frozen_time):
+    rng = np.random.default_rng(1)
+    markets = random_markets(rng, 2000)
+    table = build_table(markets)
+    for _ in range(50):
+        compiled = random_filters(rng)
+        counts = {'total': 0, 'time': 0, 'liquidity': 0, 'price': 0}
+        found = table.search(compiled['time'], stages_for(compiled), counts)
+
+        expected, expected_counts = naive_search(markets, compiled)
+        assert ids(found) == ids(expected)
+        assert counts == expected_counts
+
+
+def test_funnel_counts_first_failed_stage():
+    table = build_table([{'id': i, 'close_ts': NOW, 'liquidity': 0.0, 'price': 0.0} for i in range(4)])
+    counts = {'total': 0, 'a': 0, 'b': 0}
+    passed = table.funnel([
+        ('a', np.array([True, True, False, True])),
+        ('b', np.array([True, False, True, True])),
+    ], counts)
+    # Третий рынок не прошел этап a, поэтому не учитывается на этапе b, хотя его маска там True
+    assert passed.tolist() == [True, False, False, True]
+    assert counts == {'total': 4, 'a': 3, 'b': 2}
+
+
+def test_closing_within_matches_hours_left(frozen_time):
+    rng = np.random.default_rng(6)
+    markets = random_markets(rng, 1000)
+    table = build_table(markets)
+    for _ in range(30):
+        hours = random_filters(rng)['time']
+        expected = [m['close_ts'] is not None and hours.contains((m['close_ts'] - NOW) / 3600) for m in markets]
+        assert table.closing_within(hours).tolist() == expected
+
+
+def test_search_scan_path_matches_naive_loop(frozen_time):
+    """Широкое окно времени идет через полный скан масками, а не через срез индекса"""
+    rng = np.random.default_rng(2)
+    markets = random_markets(rng, 500)
+    table = build_table(markets)
+    compiled = {
+        'time': RangeFilter(-10, 1000),
+        'liquidity': RangeFilter(1000, 8000),
+        'price': RangeFilter(10, 90),
+    }
+    counts = {'total': 0, 'time': 0, 'liquidity': 0, 'price': 0}
+    found = table.search(compiled['time'], stages_for(compiled), counts)
+
+    expected, expected_counts = naive_search(markets, compiled)
+    assert ids(found) == ids(expected)
+    assert counts == expected_counts
+
+
+def test_search_ahead_resolves_to_search_within_horizon(monkeypatch, frozen_time):
+    rng = np.random.default_rng(7)
+    markets = random_markets(rng, 2000)
+    table = build_table(markets)
+    filter_sets = [random_filters(rng) for _ in range(20)]
+    horizon = 600.0
+
+    ahead = [table.search_ahead(compiled['time'], stages_for(compiled), horizon) for compiled in filter_sets]
+    batched = dict(pair for batch in table.iter_batch_search(
+        filter_sets, lambda candidates, compiled: stages_for(compiled)(candidates), horizon) for pair in batch)
+
+    for delay in (0.0, 1.0, 299.5, horizon):
+        now = NOW + delay
+        monkeypatch.setattr(core.time, 'time', lambda: now)
+        for index, compiled in enumerate(filter_sets):
+            counts = {'total': 0, 'time': 0, 'liquidity': 0, 'price': 0}
+            expected = table.search(compiled['time'], stages_for(compiled), counts)
+            for result in (ahead[index], batched[index]):
+                found, found_counts = result.resolve(compiled['time'])
+                assert ids(found) == ids(expected)
+                assert found_counts == counts
+
+    monkeypatch.setattr(core.time, 'time', lambda: NOW + horizon + 1)
+    assert ahead[0].resolve(filter_sets[0]['time']) is None
+
+
+def test_result_cache_key_ignores_time(monkeypatch, frozen_time):
+    rng = np.random.default_rng(8)
+    table = build_table(random_markets(rng, 500))
+    compiled = random_filters(rng)
+    cache = SearchResultCache('venue', horizon=600.0)
+    key = cache.key(1, compiled)
+    cache.put(key, table.search_ahead(compiled['time'], stages_for(compiled), cache.horizon))
+
+    # Запись, положенная прогревом, находится и через несколько минут
+    monkeypatch.setattr(core.time, 'time', lambda: NOW + 300)
+    assert cache.key(1, compiled) == key
+    assert cache.get(key, compiled['time']) is not None
+
+    monkeypatch.setattr(core.time, 'time', lambda: NOW + 601)
+    assert cache.get(key, compiled['time']) is None
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+
+def test_batch_search_matches_naive_loop(frozen_time):
+    rng = np.random.default_rng(3)
+    markets = random_markets(rng, 3000)
+    table = build_table(markets)
+    filter_sets = [random_filters(rng) for _ in range(150)]
+
+    results = table.batch_search(filter_sets, lambda candidates, compiled: stages_for(compiled)(candidates))
+    for compiled, (found, counts) in zip(filter_sets, results):
+        expected, expected_counts = naive_search(markets, compiled)
+        assert ids(found) == ids(expected)
+        assert counts == expected_counts
+
+
+@pytest.mark.parametrize('k', [1, 5, 50, 500])
+def test_top_k_matches_stable_sort(k):
+    rng = np.random.default_rng(k)
+    markets = [{'id': i, 'score': int(rng.integers(0, 20))} for i in range(300)]
+    top = TopK(k, lambda m: m['score'])
+    for offset in range(0, len(markets), 37):
+        top.push(markets[offset:offset + 37])
+
+    expected = sorted(markets, key=lambda m: m['score'])[:k]
+    assert ids(top.result()) == ids(expected)
+
+
+def test_telegram_length_counts_utf16_units():
+    assert telegram_length("abc") == 3
+    assert telegram_length("📊") == 2
+    assert telegram_length("ё📊x") == 4
+
+
+def test_result_pages_pack_cards_up_to_limit():
+    rng = np.random.default_rng(4)
+    alphabet = ["a", "ж", "📊", " "]
+    cards = ["".join(rng.choice(alphabet, size=int(rng.integers(1, 300)))) for _ in range(200)]
+    cursor = ResultCursor(cards, cards, key=lambda card: 0, detailed=True)
+    render = lambda card, index, detailed: card
+    limit = 1000
+
+    page, end = 0, 0
+    while end < len(cursor):
+        text, start, end = cursor.render_page(page, render, limit)
+        assert start < end
+        assert telegram_length(text) <= limit
+        assert text == core.PAGE_SEPARATOR.join(cards[start:end])
+        # Страница заполняется жадно: следующая карточка в нее бы не поместилась
+        if end < len(cursor):
+            assert telegram_length(text + core.PAGE_SEPARATOR + cards[end]) > limit
+        page += 1
+
+
+def test_result_page_truncates_oversized_card():
+    cursor = ResultCursor(["📊" * 3000, "next"], [], key=lambda card: 0, detailed=True)
+    render = lambda card, index, detailed: card
+    text, start, end = cursor.render_page(0, render)
+    assert (start, end) == (0, 1)
+    assert telegram_length(text) == 4096
+    assert cursor.render_page(1, render) == ("next", 1, 2)
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=2.0, capacity=2.0)
+    now = bucket.updated
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0.0
+    assert bucket.is_full(now + 10)
+
+
+def test_send_scheduler_serves_chats_round_robin():
+    async def scenario():
+        scheduler = SendScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000)
+        order = []
+
+        async def send(chat_id):
+            await scheduler.acquire(chat_id)
+            order.append(chat_id)
+
+        # Длинная очередь одного чата не должна задерживать второй
+        tasks = [asyncio.create_task(send('a')) for _ in range(10)]
+        tasks.append(asyncio.create_task(send('b')))
+        await asyncio.gather(*tasks)
+        await scheduler.stop()
+        return order
+
+    order = asyncio.run(scenario())
+    assert sorted(order) == ['a'] * 10 + ['b']
+    assert order.index('b') <= 1
+
+
+def test_send_scheduler_throttles_per_chat():
+    async def scenario():
+        scheduler = SendScheduler(global_rate=1000, chat_rate=20, chat_burst=1)
+        started = time.monotonic()
+        for _ in range(5):
+            await scheduler.acquire('chat')
+        elapsed = time.monotonic() - started
+        await scheduler.stop()
+        return elapsed
+
+    # Первая отправка из корзины, еще четыре - по 1/20 с
+    assert asyncio.run(scenario()) >= 4 / 20 * 0.9
+
+
+def test_send_scheduler_stop_fails_pending_sends():
+    async def scenario():
+        scheduler = SendScheduler(chat_rate=0.01, chat_burst=1)
+        await scheduler.acquire('chat')
+        pending = asyncio.create_task(scheduler.acquire('chat'))
+        await asyncio.sleep(0.01)
+        await scheduler.stop()
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(pending, 1)
+        with pytest.raises(RuntimeError):
+            await scheduler.acquire('chat')
+
+    asyncio.run(scenario())
+
+
+def test_result_cursor_pages_cover_all_markets():
+    markets = [{'id': i, 'text': "x" * (i % 7 * 50 + 10)} for i in range(120)]
+    cursor = ResultCursor(markets, markets[:10], key=lambda m: m['id'], detailed=True)
+    render = lambda market, index, detailed: f"#{index} {market['text']}"
+
+    seen, page = [], 0
+    while True:
+        text, start, end = cursor.render_page(page, render, limit=500)
+        assert telegram_length(text) <= 500
+        seen.extend(range(start, end))
+        if end >= len(cursor):
+            break
+        page += 1
+    assert seen == list(range(len(markets)))
+
+
+def test_result_cursor_empty_and_out_of_range_pages():
+    render = lambda market, index, detailed: "card"
+    empty = ResultCursor([], [], key=lambda m: 0, detailed=True)
+    assert empty.render_page(0, render) == (core.NO_RESULTS_TEXT, 0, 0)
+
+    cursor = ResultCursor([{'id': 1}], [], key=lambda m: 0, detailed=True)
+    assert cursor.render_page(5, render) == (core.NO_RESULTS_TEXT, 0, 0)
+
+
+def test_progress_message_coalesces_updates_without_blocking():
+    class Status:
+        def __init__(self, log):
+            self.log = log
+
+        async def edit_text(self, text, reply_markup=None):
+            await asyncio.sleep(0.01)
+            self.log.append(text)
+
+    class Message:
+        def __init__(self):
+            self.log = []
+
+        async def answer(self, text, reply_markup=None):
+            self.log.append(text)
+            return Status(self.log)
+
+    async def run():
+        message = Message()
+        progress = ProgressMessage(message, min_interval=0.05)
+        await progress.start("start")
+
+        started = time.monotonic()
+        for i in range(200):
+            progress.update(f"step {i}")
+            await asyncio.sleep(0.001)
+        # Правки не задерживают поиск: update() только запоминает текст
+        assert time.monotonic() - started < 1.0
+
+        await progress.finish("done")
+        await asyncio.sleep(0.1)
+        return message.log
+
+    log = asyncio.run(run())
+    assert log[0] == "start"
+    assert log[-1] == "done"
+    assert 2 <= len(log) < 20
+    assert all(text.startswith("step") for text in log[1:-1])